@@ -1,11 +1,194 @@
 import os
-from openai import OpenAI
+import time
+import asyncio
+from collections import deque
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+import generation_cache
+import message_templates
+import prompt_budget
+import llm_usage
 
 load_dotenv()
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+LLM_MODEL = "gpt-4o-mini"
+
+# Bulk generation (generate_many): parallel calls and the account's per-minute limits
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "150000"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+
+
+def _request_params(max_tokens, response_format=None):
+    params = {'max_tokens': max_tokens}
+    if response_format:
+        params['response_format'] = response_format
+    return params
+
+
+def request_cache_key(req):
+    """generation_cache key of a request dict (as built by the _*_request helpers)."""
+    params = _request_params(req['max_tokens'], req.get('response_format'))
+    return generation_cache.make_key(req['function'], LLM_MODEL, req['temperature'], req['messages'], **params)
+
+
+def _with_history(system_prompt, user_prompt, history, head_lines=0):
+    """
+    Chat messages with `history` filled into the {history} slot of
+    `user_prompt`, trimmed (oldest lines first) so the whole prompt stays
+    within the prompt_budget limits however long the conversation gets.
+    """
+    fixed = prompt_budget.count_message_tokens([{'content': system_prompt}, {'content': user_prompt}])
+    history = prompt_budget.fit_history(history or '', fixed, head_lines=head_lines)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt.replace('{history}', history)}
+    ]
+
+
+def _complete(function, messages, max_tokens, temperature, response_format=None, use_cache=True, meta=None):
+    """
+    One chat completion (response text), served from generation_cache when the
+    exact same request was answered before. API errors propagate to the caller.
+    Every real call is logged to llm_usage (`meta`: lead_id, prompt_version).
+    """
+    params = _request_params(max_tokens, response_format)
+    key = generation_cache.make_key(function, LLM_MODEL, temperature, messages, **params)
+
+    if use_cache:
+        cached = generation_cache.get(function, key)
+        if cached is not None:
+            return cached
+
+    estimated = prompt_budget.count_message_tokens(messages)
+    started = time.monotonic()
+    try:
+        response = client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=messages,
+            temperature=temperature,
+            **params
+        )
+    except Exception as e:
+        llm_usage.record(function, LLM_MODEL, 'live', meta, estimated_prompt_tokens=estimated,
+                         latency_ms=(time.monotonic() - started) * 1000, error=repr(e))
+        raise
+    llm_usage.record(function, LLM_MODEL, 'live', meta, getattr(response, 'usage', None), estimated,
+                     (time.monotonic() - started) * 1000)
+    content = response.choices[0].message.content.strip()
+    generation_cache.put(function, key, LLM_MODEL, temperature, content)
+    return content
+
+
+class _MinuteBudget:
+    """
+    Sliding 60s window of requests and tokens. acquire() waits (FIFO) until
+    one more request of `tokens` fits; settle() swaps the estimate for the
+    real usage once the response arrives.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque() # [started_at, tokens]
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    self._window.popleft()
+                used = sum(entry[1] for entry in self._window)
+                if not self._window or (
+                    len(self._window) < self.requests_per_minute and used + tokens <= self.tokens_per_minute
+                ):
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    return entry
+                await asyncio.sleep(60 - (now - self._window[0][0]))
+
+    def settle(self, entry, tokens):
+        entry[1] = tokens
+
+
+async def _acomplete(aclient, budget, semaphore, function, messages, max_tokens, temperature, response_format=None, use_cache=True, meta=None):
+    """Async _complete() (cache already checked by the caller), under the concurrency limit and the per-minute budget."""
+    params = _request_params(max_tokens, response_format)
+    key = generation_cache.make_key(function, LLM_MODEL, temperature, messages, **params)
+    estimated = prompt_budget.count_message_tokens(messages)
+
+    async with semaphore:
+        entry = await budget.acquire(estimated + max_tokens)
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                aclient.chat.completions.create(model=LLM_MODEL, messages=messages, temperature=temperature, **params),
+                timeout=LLM_TIMEOUT_SECONDS
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            llm_usage.record(function, LLM_MODEL, 'async', meta, estimated_prompt_tokens=estimated,
+                             latency_ms=(time.monotonic() - started) * 1000, error=repr(e))
+            raise
+        if getattr(response, 'usage', None):
+            budget.settle(entry, response.usage.total_tokens)
+        llm_usage.record(function, LLM_MODEL, 'async', meta, getattr(response, 'usage', None), estimated,
+                         (time.monotonic() - started) * 1000)
+
+    content = response.choices[0].message.content.strip()
+    generation_cache.put(function, key, LLM_MODEL, temperature, content)
+    return content
+
+
+async def generate_many_async(requests, concurrency=None, deadline=None):
+    """
+    Runs many completion requests concurrently. Each request is a dict of
+    _complete() arguments (function, messages, max_tokens, temperature, ...).
+    Returns the response texts in request order; None for a failed or timed
+    out call, or one still pending when `deadline` seconds pass (cancelled).
+    """
+    results = [
+        generation_cache.get(req['function'], request_cache_key(req)) if req.get('use_cache', True) else None
+        for req in requests
+    ]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    semaphore = asyncio.Semaphore(max(1, concurrency or LLM_CONCURRENCY))
+    budget = _MinuteBudget(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
+    async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=LLM_TIMEOUT_SECONDS) as aclient:
+        tasks = {
+            i: asyncio.ensure_future(_acomplete(aclient, budget, semaphore, **requests[i]))
+            for i in misses
+        }
+        done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"[LLM] Deadline reached: cancelled {len(pending)} of {len(tasks)} generations.")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    for i, task in tasks.items():
+        if task.cancelled():
+            continue
+        if task.exception():
+            print(f"Error generating ({requests[i]['function']}): {task.exception()!r}")
+        else:
+            results[i] = task.result()
+    return results
+
+
+def generate_many(requests, concurrency=None, deadline=None):
+    """Sync entry point of generate_many_async() for the scheduler / Flask / Streamlit threads."""
+    return asyncio.run(generate_many_async(requests, concurrency, deadline))
+
 SYSTEM_PROMPT = """
 Ivair, você é o representante comercial da 100fronteiras — portal de comunicação e eventos culturais da região da Tríplice Fronteira. Sua missão é prospectar e converter clientes corporativos que desejam aumentar sua visibilidade na região através de parcerias editoriais e patrocínios.
 
@@ -81,24 +264,42 @@ PROMPT_TEMPLATES = {
 }
 
 
-def generate_message(lead_data, website_content=None, version='A'):
+_COMPILED_TEMPLATES = message_templates.compile_templates(PROMPT_TEMPLATES)
+
+
+def resolve_version(version, language='pt'):
+    """Template key for a version in the lead's language ('B' + 'es' -> 'B_ES'), falling back to A."""
+    final_version = version or 'A'
+    if language == 'es' and not final_version.endswith('_ES'):
+        final_version = f"{final_version}_ES"
+    if final_version not in PROMPT_TEMPLATES:
+        # Fallback logic
+        final_version = 'A_ES' if language == 'es' else 'A'
+    return final_version
+
+
+def render_message_parts(lead_data, version='A', now=None):
+    """First-contact bubbles rendered locally from the templates (no LLM call)."""
+    language = lead_data.get('language') or 'pt'
+    final_version = resolve_version(version, language)
+    return message_templates.render(_COMPILED_TEMPLATES[final_version], lead_data, language, now)
+
+
+def generate_message(lead_data, website_content=None, version='A', use_cache=True, personalize=False):
+    """
+    First-contact message with bubbles separated by "|||".
+    Rendered locally by default; personalize=True asks the LLM to adapt the
+    template (and use the website content).
+    """
+    if not personalize:
+        return '|||'.join(render_message_parts(lead_data, version))
     
     # Language Detection/Selection
     language = lead_data.get('language', 'pt')
     
     # Adjust version for language
-    final_version = version
-    if language == 'es' and not version.endswith('_ES'):
-        final_version = f"{version}_ES"
-        
-    # Check if template exists, fallback to A or A_ES
-    template = PROMPT_TEMPLATES.get(final_version)
-    if not template:
-        # Fallback logic
-        if language == 'es':
-             template = PROMPT_TEMPLATES['A_ES']
-        else:
-             template = PROMPT_TEMPLATES['A']
+    final_version = resolve_version(version, language)
+    template = PROMPT_TEMPLATES[final_version]
     
     context_info = ""
     if website_content:
@@ -129,21 +330,22 @@ def generate_message(lead_data, website_content=None, version='A'):
     """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        return _complete(
+            'generate_message',
+            [
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt}
             ],
             max_tokens=300, # Increased for multiple bubbles
-            temperature=0.3
+            temperature=0.3,
+            use_cache=use_cache,
+            meta={'lead_id': lead_data.get('id'), 'prompt_version': final_version}
         )
-        return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"Error generating message: {e}")
         return None
 
-def generate_followup_message(lead_data, stage):
+def _followup_request(lead_data, stage):
     instructions = {
         1: "O cliente não respondeu ao primeiro contato feito há 3 dias. Gere uma mensagem curta e educada perguntando se ele conseguiu ver a mensagem anterior. Mantenha o tom profissional e amigável de Ivair.",
         2: "O cliente não respondeu há uma semana. Gere uma mensagem trazendo uma novidade ou um benefício específico da 100fronteiras (ex: audiência qualificada, networking). Algo para despertar interesse.",
@@ -157,32 +359,34 @@ def generate_followup_message(lead_data, stage):
     Nome: {lead_data.get('name')}
     
     Histórico da conversa:
-    {lead_data.get('conversation_history', '')}
+    {{history}}
     
     Instrução: {instruction}
     """
     
+    return {
+        'function': 'generate_followup_message',
+        'messages': _with_history(SYSTEM_PROMPT, user_prompt, lead_data.get('conversation_history')),
+        'max_tokens': 100,
+        'temperature': 0.4,
+        'meta': {'lead_id': lead_data.get('id'), 'prompt_version': f"FOLLOWUP_{stage}"}
+    }
+
+
+def generate_followup_message(lead_data, stage):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=100,
-            temperature=0.4
-        )
-        return response.choices[0].message.content.strip()
+        return _complete(**_followup_request(lead_data, stage))
     except Exception as e:
         print(f"Error generating follow-up: {e}")
         return None
 
 
-def generate_contextual_message(lead_data, conversation_history):
-    """
-    Generate a contextual message based on previous Chatwoot conversation history.
-    Used when re-engaging with a contact that has prior interactions.
-    """
+def generate_followup_messages(items, concurrency=None, deadline=None):
+    """Follow-ups for many (lead_data, stage) pairs at once (see generate_many). Returns texts in order."""
+    return generate_many([_followup_request(lead, stage) for lead, stage in items], concurrency, deadline)
+
+
+def _contextual_request(lead_data, conversation_history):
     language = lead_data.get('language', 'pt')
     
     user_prompt = f"""
@@ -194,7 +398,7 @@ def generate_contextual_message(lead_data, conversation_history):
     Idioma: {language}
     
     HISTÓRICO DA CONVERSA ANTERIOR (Chatwoot):
-    {conversation_history}
+    {{history}}
     
     INSTRUÇÕES:
     1. Leia o histórico acima e entenda o contexto da conversa anterior
@@ -212,19 +416,24 @@ def generate_contextual_message(lead_data, conversation_history):
     Gere as 4 partes agora:
     """
     
+    return {
+        'function': 'generate_contextual_message',
+        'messages': _with_history(SYSTEM_PROMPT, user_prompt, conversation_history),
+        'max_tokens': 250,
+        'temperature': 0.5,
+        'meta': {'lead_id': lead_data.get('id'), 'prompt_version': 'CONTEXTUAL'}
+    }
+
+
+def generate_contextual_message(lead_data, conversation_history):
+    """
+    Generate a contextual message based on previous Chatwoot conversation history.
+    Used when re-engaging with a contact that has prior interactions.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=250,
-            temperature=0.5
-        )
+        message = _complete(**_contextual_request(lead_data, conversation_history))
         
         # Parse response into 4 parts
-        message = response.choices[0].message.content.strip()
         parts = [p.strip() for p in message.split('|||')]
         
         # Ensure we have exactly 4 parts
@@ -248,7 +457,7 @@ def analyze_conversation_for_name(history_text):
     Analise o histórico de conversa abaixo e tente identificar o NOME DA PESSOA ou NOME DA EMPRESA com quem o Ivair está falando.
     
     HISTÓRICO:
-    {history_text}
+    {{history}}
     
     Regras:
     1. Se o cliente se apresentou (ex: "Aqui é o João"), use "João".
@@ -264,19 +473,18 @@ def analyze_conversation_for_name(history_text):
     """
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Você é um assistente que extrai dados de CRM."},
-                {"role": "user", "content": user_prompt}
-            ],
+        content = _complete(
+            'analyze_conversation_for_name',
+            # Keep the opening lines too: that's where people introduce themselves
+            _with_history("Você é um assistente que extrai dados de CRM.", user_prompt, history_text, head_lines=10),
             max_tokens=100,
             temperature=0.1,
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            meta={'prompt_version': 'NAME_ANALYSIS'}
         )
         
         import json
-        return json.loads(response.choices[0].message.content)
+        return json.loads(content)
     except Exception as e:
         print(f"Error analyzing name: {e}")
         return None
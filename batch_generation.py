@@ -0,0 +1,406 @@
+import os
+import io
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from database import get_db_connection, get_conversation_text, DATA_DIR, register_schema, ensure_schema
+import generation_cache
+import llm_usage
+import agent
+
+# Overnight pre-generation of the messages the next business day will send
+# (follow-ups, Chatwoot re-engagement) through the OpenAI Batch API.
+# Results land in generation_cache under the same key the send path computes,
+# so in-window sending finds them there and makes no LLM call. If a
+# conversation changed in the meantime the prompt (and key) differs and the
+# send path simply generates live as before.
+BATCH_CLIENT = os.getenv("BATCH_CLIENT", "openai") # openai | local
+BATCH_HORIZON_HOURS = int(os.getenv("BATCH_HORIZON_HOURS", "24"))
+BATCH_MAX_NEW_LEADS = int(os.getenv("BATCH_MAX_NEW_LEADS", "100"))
+BATCH_DIR = os.path.join(DATA_DIR, "batches")
+# The Batch API answers within this window; results also stay cached this long
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_RESULT_TTL_SECONDS = 3 * 24 * 3600
+
+_SCHEMA = register_schema(
+    'batch_generation',
+    '''
+    CREATE TABLE IF NOT EXISTS generation_batches (
+        batch_id TEXT PRIMARY KEY,
+        client TEXT NOT NULL,
+        remote_id TEXT,
+        status TEXT NOT NULL,
+        request_count INTEGER NOT NULL,
+        input_path TEXT,
+        created_at REAL NOT NULL,
+        completed_at REAL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS batch_requests (
+        custom_id TEXT PRIMARY KEY,
+        batch_id TEXT NOT NULL REFERENCES generation_batches(batch_id) ON DELETE CASCADE,
+        lead_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        stage INTEGER,
+        function TEXT NOT NULL,
+        temperature REAL,
+        cache_key TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        content TEXT,
+        error TEXT,
+        completed_at REAL
+    )
+    ''',
+    # One row per nightly prepare (also when there was nothing to generate):
+    # the once-per-day guard, and where the scan of 'new' leads continues
+    '''
+    CREATE TABLE IF NOT EXISTS generation_runs (
+        run_date TEXT PRIMARY KEY,
+        batch_id TEXT,
+        last_new_lead_id INTEGER,
+        created_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_batch_requests_batch ON batch_requests(batch_id)',
+    'CREATE INDEX IF NOT EXISTS idx_batch_requests_lead ON batch_requests(lead_id, status)',
+)
+
+
+# --- Clients -----------------------------------------------------------------
+
+class OpenAIBatchClient:
+    """OpenAI Batch API: upload the JSONL, create the batch, poll, download the output file."""
+
+    name = 'openai'
+
+    def __init__(self):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    def submit(self, jsonl, filename):
+        input_file = self.client.files.create(file=(filename, io.BytesIO(jsonl.encode('utf-8'))), purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        return batch.id
+
+    def poll(self, remote_id):
+        """'completed', 'failed' (also expired/cancelled) or 'in_progress'."""
+        batch = self.client.batches.retrieve(remote_id)
+        if batch.status == 'completed':
+            return 'completed'
+        if batch.status in ('failed', 'expired', 'cancelled'):
+            return 'failed'
+        return 'in_progress'
+
+    def results(self, remote_id):
+        """Output lines ({custom_id, response: {status_code, body}, error})."""
+        batch = self.client.batches.retrieve(remote_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = self.client.files.content(file_id).text
+                lines.extend(json.loads(line) for line in text.splitlines() if line.strip())
+        return lines
+
+
+class LocalBatchClient:
+    """
+    Offline stand-in with the same interface: completes every batch at once
+    with `responder(body) -> text` (default: a canned echo), no network.
+    """
+
+    name = 'local'
+
+    def __init__(self, responder=None):
+        self.responder = responder or (lambda body: f"[local] {body['messages'][-1]['content'][:60].strip()}")
+        self._batches = {}
+
+    def submit(self, jsonl, filename):
+        remote_id = f"local_{uuid.uuid4().hex[:12]}"
+        lines = []
+        for line in jsonl.splitlines():
+            req = json.loads(line)
+            lines.append({
+                'custom_id': req['custom_id'],
+                'response': {'status_code': 200, 'body': {
+                    'choices': [{'message': {'role': 'assistant', 'content': self.responder(req['body'])}}]
+                }},
+                'error': None
+            })
+        self._batches[remote_id] = lines
+        return remote_id
+
+    def poll(self, remote_id):
+        return 'completed' if remote_id in self._batches else 'failed'
+
+    def results(self, remote_id):
+        return self._batches.get(remote_id, [])
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = LocalBatchClient() if BATCH_CLIENT == 'local' else OpenAIBatchClient()
+    return _client
+
+
+def set_client(client):
+    """Swaps the batch client (e.g. LocalBatchClient(responder) in tests)."""
+    global _client
+    _client = client
+
+
+# --- Request assembly ----------------------------------------------------------
+
+def _followup_requests(as_of):
+    from followup import get_due_followups, should_followup
+    requests = []
+    for lead in get_due_followups(as_of):
+        stage = (lead.get('follow_up_stage') or 0) + 1
+        if stage > 3:
+            continue
+        # Chatwoot is checked now, the send happens within the horizon: a lead
+        # still 'waiting_response' today is due by then (only declined/answered are skipped)
+        should_send, _, history = should_followup(lead, allow_waiting=True)
+        if not should_send:
+            continue
+        # Same context the send path builds (followup.process_followups)
+        lead['conversation_history'] = history or get_conversation_text(lead['id'])
+        requests.append((lead['id'], 'followup', stage, agent._followup_request(lead, stage)))
+    return requests
+
+
+def _reengagement_requests(limit, after_id=0):
+    """
+    Checks up to `limit` 'new' leads in Chatwoot, continuing after the lead the
+    previous night stopped at (wrapping around), so the whole queue gets covered.
+    Returns (requests, id of the last lead checked).
+    """
+    import chatwoot_api
+    conn = get_db_connection()
+    leads = [dict(row) for row in conn.execute(
+        "SELECT * FROM leads WHERE status = 'new' AND id > ? ORDER BY id LIMIT ?", (after_id, limit)
+    ).fetchall()]
+    if len(leads) < limit:
+        leads += [dict(row) for row in conn.execute(
+            "SELECT * FROM leads WHERE status = 'new' AND id <= ? ORDER BY id LIMIT ?", (after_id, limit - len(leads))
+        ).fetchall()]
+    conn.close()
+
+    requests = []
+    for lead in leads:
+        try:
+            check = chatwoot_api.should_contact_lead(lead['phone'])
+        except Exception as e:
+            print(f"[Batch] Chatwoot check failed for {lead['phone']}: {e}")
+            continue
+        history = check.get('conversation_history')
+        if check.get('should_contact') and history:
+            requests.append((lead['id'], 'reengagement', None, agent._contextual_request(lead, history)))
+    return requests, (leads[-1]['id'] if leads else 0)
+
+
+def to_jsonl_line(custom_id, req):
+    """One OpenAI Batch API input line for a request dict."""
+    body = {
+        'model': agent.LLM_MODEL,
+        'messages': req['messages'],
+        'temperature': req['temperature'],
+        **agent._request_params(req['max_tokens'], req.get('response_format'))
+    }
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}, ensure_ascii=False)
+
+
+def prepare_batch(now=None, client=None):
+    """
+    Assembles every generation the next BATCH_HORIZON_HOURS will need (and
+    that isn't cached yet), writes the JSONL and submits it.
+    Returns the batch_id, or None if there was nothing to generate.
+    """
+    ensure_schema(_SCHEMA)
+    now = now or datetime.now()
+    client = client or get_client()
+
+    conn = get_db_connection()
+    last_run = conn.execute('SELECT last_new_lead_id FROM generation_runs ORDER BY created_at DESC LIMIT 1').fetchone()
+    conn.close()
+
+    entries = _followup_requests(now + timedelta(hours=BATCH_HORIZON_HOURS))
+    reengagements, last_new_lead_id = _reengagement_requests(
+        BATCH_MAX_NEW_LEADS, last_run['last_new_lead_id'] if last_run else 0
+    )
+    entries += reengagements
+    entries = [(lead_id, kind, stage, req, agent.request_cache_key(req)) for lead_id, kind, stage, req in entries]
+    # Skip what's cached already or still waiting in a submitted batch
+    conn = get_db_connection()
+    in_flight = {row['cache_key'] for row in conn.execute('''
+        SELECT r.cache_key FROM batch_requests r JOIN generation_batches b ON b.batch_id = r.batch_id
+        WHERE b.status = 'submitted'
+    ''').fetchall()}
+    conn.close()
+    entries = [e for e in entries if e[4] not in in_flight and not generation_cache.has(e[4])]
+    if not entries:
+        _record_run(now, None, last_new_lead_id)
+        print("[Batch] Nothing to pre-generate.")
+        return None
+
+    batch_id = f"gen_{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    lines, rows = [], []
+    for i, (lead_id, kind, stage, req, key) in enumerate(entries):
+        custom_id = f"{batch_id}-{i}"
+        lines.append(to_jsonl_line(custom_id, req))
+        rows.append((custom_id, batch_id, lead_id, kind, stage, req['function'], req['temperature'], key))
+    jsonl = '\n'.join(lines) + '\n'
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    input_path = os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+    with open(input_path, 'w', encoding='utf-8') as f:
+        f.write(jsonl)
+
+    remote_id = client.submit(jsonl, os.path.basename(input_path))
+
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO generation_batches (batch_id, client, remote_id, status, request_count, input_path, created_at)
+        VALUES (?, ?, ?, 'submitted', ?, ?, ?)
+    ''', (batch_id, client.name, remote_id, len(rows), input_path, time.time()))
+    conn.executemany('''
+        INSERT INTO batch_requests (custom_id, batch_id, lead_id, kind, stage, function, temperature, cache_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+    _record_run(now, batch_id, last_new_lead_id)
+    print(f"[Batch] Submitted {batch_id} ({len(rows)} requests, remote {remote_id}).")
+    return batch_id
+
+
+def _record_run(now, batch_id, last_new_lead_id):
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO generation_runs (run_date, batch_id, last_new_lead_id, created_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(run_date) DO UPDATE SET
+            batch_id = COALESCE(excluded.batch_id, batch_id),
+            last_new_lead_id = excluded.last_new_lead_id, created_at = excluded.created_at
+    ''', (now.date().isoformat(), batch_id, last_new_lead_id, time.time()))
+    conn.commit()
+    conn.close()
+
+
+def _store_results(batch_id, lines):
+    conn = get_db_connection()
+    requests = {row['custom_id']: dict(row) for row in conn.execute(
+        'SELECT * FROM batch_requests WHERE batch_id = ?', (batch_id,)
+    ).fetchall()}
+    conn.close()
+
+    now = time.time()
+    updates = []
+    for line in lines:
+        req = requests.get(line.get('custom_id'))
+        if not req:
+            continue
+        response = line.get('response') or {}
+        try:
+            if response.get('status_code') != 200:
+                raise ValueError(line.get('error') or response.get('body'))
+            content = response['body']['choices'][0]['message']['content'].strip()
+        except Exception as e:
+            updates.append(('failed', None, str(e)[:500], now, req['custom_id']))
+            continue
+        llm_usage.record(req['function'], agent.LLM_MODEL, 'batch', {
+            'lead_id': req['lead_id'],
+            'prompt_version': f"FOLLOWUP_{req['stage']}" if req['kind'] == 'followup' else 'CONTEXTUAL'
+        }, response['body'].get('usage'))
+        generation_cache.put(req['function'], req['cache_key'], agent.LLM_MODEL, req['temperature'], content, ttl=BATCH_RESULT_TTL_SECONDS)
+        updates.append(('ready', content, None, now, req['custom_id']))
+
+    conn = get_db_connection()
+    conn.executemany(
+        'UPDATE batch_requests SET status = ?, content = ?, error = ?, completed_at = ? WHERE custom_id = ?', updates
+    )
+    conn.commit()
+    conn.close()
+    return sum(1 for u in updates if u[0] == 'ready')
+
+
+def poll_batches(client=None):
+    """Collects finished batches. Returns how many results were stored."""
+    ensure_schema(_SCHEMA)
+    client = client or get_client()
+    conn = get_db_connection()
+    batches = [dict(row) for row in conn.execute(
+        "SELECT * FROM generation_batches WHERE status = 'submitted' AND client = ?", (client.name,)
+    ).fetchall()]
+    conn.close()
+
+    stored = 0
+    for batch in batches:
+        try:
+            status = client.poll(batch['remote_id'])
+            if status == 'in_progress':
+                continue
+            ready = _store_results(batch['batch_id'], client.results(batch['remote_id'])) if status == 'completed' else 0
+        except Exception as e:
+            print(f"[Batch] Poll error for {batch['batch_id']}: {e}")
+            continue
+        conn = get_db_connection()
+        conn.execute(
+            'UPDATE generation_batches SET status = ?, completed_at = ? WHERE batch_id = ?',
+            (status, time.time(), batch['batch_id'])
+        )
+        conn.commit()
+        conn.close()
+        stored += ready
+        print(f"[Batch] {batch['batch_id']} {status}: {ready}/{batch['request_count']} messages pre-generated.")
+    return stored
+
+
+def run(within_business_hours):
+    """
+    Scheduler entry point: polls pending batches and, outside business hours,
+    submits tonight's batch (once per day).
+    """
+    poll_batches()
+    if within_business_hours:
+        return
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    already = conn.execute(
+        'SELECT 1 FROM generation_runs WHERE run_date = ?', (datetime.now().date().isoformat(),)
+    ).fetchone()
+    conn.close()
+    if not already:
+        prepare_batch()
+
+
+def ready_reengagement_lead_ids():
+    """'new' leads whose re-engagement message is pre-generated and still cached (claimed first)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT DISTINCT r.lead_id FROM batch_requests r JOIN leads l ON l.id = r.lead_id
+        WHERE r.kind = 'reengagement' AND r.status = 'ready' AND r.completed_at >= ? AND l.status = 'new'
+    ''', (time.time() - BATCH_RESULT_TTL_SECONDS,)).fetchall()
+    conn.close()
+    return [row['lead_id'] for row in rows]
+
+
+def get_lead_results(lead_id):
+    """Pre-generated messages stored for a lead (newest first)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT kind, stage, status, content, error, completed_at FROM batch_requests
+        WHERE lead_id = ? ORDER BY rowid DESC
+    ''', (lead_id,)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
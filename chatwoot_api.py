@@ -1,5 +1,5 @@
 import os
-import requests
+import http_client
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 
@@ -43,7 +43,7 @@ def get_contact_by_phone(phone):
         url = f"{CHATWOOT_URL}/api/v1/accounts/{CHATWOOT_ACCOUNT_ID}/contacts/search"
         params = {"q": clean_phone}
         
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = http_client.get(url, headers=headers, params=params, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -52,7 +52,7 @@ def get_contact_by_phone(phone):
 
         # Try w/ PLUS (e.g. +5545...) if not found
         params = {"q": f"+{clean_phone}"}
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = http_client.get(url, headers=headers, params=params, timeout=10)
         if response.status_code == 200:
             data = response.json()
             if data.get('payload') and len(data['payload']) > 0:
@@ -81,7 +81,7 @@ def get_conversation_history(contact_id):
         # Get contact's conversations
         url = f"{CHATWOOT_URL}/api/v1/accounts/{CHATWOOT_ACCOUNT_ID}/contacts/{contact_id}/conversations"
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = http_client.get(url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -91,7 +91,7 @@ def get_conversation_history(contact_id):
                 
                 # Get messages from that conversation
                 messages_url = f"{CHATWOOT_URL}/api/v1/accounts/{CHATWOOT_ACCOUNT_ID}/conversations/{conversation_id}/messages"
-                messages_response = requests.get(messages_url, headers=headers, timeout=10)
+                messages_response = http_client.get(messages_url, headers=headers, timeout=10)
                 
                 if messages_response.status_code == 200:
                     messages_data = messages_response.json()
@@ -140,7 +140,7 @@ def list_conversations(page=1, sort_by='last_activity_at'):
             "sort_by": sort_by,
         }
 
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = http_client.get(url, headers=headers, params=params, timeout=10)
         
         if response.status_code == 200:
             try:
@@ -0,0 +1,75 @@
+import os
+import asyncio
+import weakref
+import chatwoot_api
+
+# asyncio front-end for chatwoot_api (same functions, awaitable) used by the
+# fan-out jobs (restore at startup, Chatwoot -> Trello sync).
+# Each call runs the sync client on a worker thread, so every request still goes
+# through http_client's keep-alive pool and retry policy; the semaphore caps how
+# many are in flight. Keep it <= HTTP_POOL_SIZE or connections get discarded.
+CHATWOOT_CONCURRENCY = int(os.getenv("CHATWOOT_CONCURRENCY", "8"))
+
+# One semaphore per event loop (asyncio.run() creates a new loop on every call)
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(CHATWOOT_CONCURRENCY)
+        _semaphores[loop] = semaphore
+    return semaphore
+
+
+async def _call(func, *args, **kwargs):
+    async with _semaphore():
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def get_contact_by_phone(phone):
+    return await _call(chatwoot_api.get_contact_by_phone, phone)
+
+
+async def get_conversation_history(contact_id):
+    return await _call(chatwoot_api.get_conversation_history, contact_id)
+
+
+async def list_conversations(page=1, sort_by='last_activity_at'):
+    return await _call(chatwoot_api.list_conversations, page=page, sort_by=sort_by)
+
+
+async def should_contact_lead(phone):
+    return await _call(chatwoot_api.should_contact_lead, phone)
+
+
+async def get_last_message_info(phone):
+    return await _call(chatwoot_api.get_last_message_info, phone)
+
+
+async def analyze_conversation_sentiment(phone):
+    return await _call(chatwoot_api.analyze_conversation_sentiment, phone)
+
+
+format_history_for_llm = chatwoot_api.format_history_for_llm
+
+
+async def get_histories(contact_ids):
+    """
+    Fetches the message history of many contacts concurrently.
+    Returns {contact_id: messages or None}.
+    """
+    unique_ids = list(dict.fromkeys(cid for cid in contact_ids if cid is not None))
+    results = await asyncio.gather(
+        *(get_conversation_history(cid) for cid in unique_ids),
+        return_exceptions=True
+    )
+
+    histories = {}
+    for cid, result in zip(unique_ids, results):
+        if isinstance(result, Exception):
+            print(f"Error fetching Chatwoot conversation {cid}: {result}")
+            result = None
+        histories[cid] = result
+    return histories
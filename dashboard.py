@@ -4,14 +4,15 @@ import sqlite3
 import os
 from datetime import datetime
 import subprocess
-from database import get_db_connection, update_lead_status, init_db
-from search import search_leads
+from database import get_db_connection, update_lead_status, init_db, get_messages, get_recent_messages_for_leads, get_active_chats, day_bounds
+from search import iter_search_pages
+from ingestion import ingest_pages
 from agent import generate_message, PROMPT_TEMPLATES
 import trello_crm
 
 # Initialize DB on startup
 init_db()
-from whatsapp import check_whatsapp_exists, send_message, format_number
+from whatsapp import check_whatsapp_exists, check_whatsapp_exists_many, send_message, format_number
 from scraper import scrape_website
 
 st.set_page_config(page_title="Agente Prospectador", layout="wide")
@@ -39,46 +40,26 @@ if page == "Buscar Leads":
             
             status_text.text("Buscando no Google Maps...")
             
-            # We can't easily stream the console output from search_leads here without refactoring
-            # So we'll just run it and show results
+            # Pages arrive in parallel and go through the ingestion pipeline
+            # (dedupe -> batched WhatsApp check -> bulk insert) as soon as they land
             try:
-                leads = search_leads(query, num_pages)
-                progress_bar.progress(20)
-                status_text.text(f"Encontrados {len(leads)} leads. Verificando WhatsApp...")
+                pages_done = [0]
                 
-                new_leads_count = 0
-                valid_leads_count = 0
+                def pages():
+                    for _, leads in iter_search_pages(query, num_pages):
+                        pages_done[0] += 1
+                        yield leads
                 
-                for i, lead in enumerate(leads):
-                    # Progress update
-                    progress = 20 + int((i / len(leads)) * 80)
-                    progress_bar.progress(progress)
-                    status_text.text(f"Processando {i+1}/{len(leads)}: {lead['name']}")
-                    
-                    # Clean Phone
-                    lead['phone'] = format_number(lead['phone'])
-                    
-                    # Check if exists in DB
-                    conn = get_db_connection()
-                    exists = conn.execute("SELECT 1 FROM leads WHERE phone = ?", (lead['phone'],)).fetchone()
-                    conn.close()
-                    
-                    if not exists:
-                        # Check WhatsApp Validity BEFORE saving as 'new'
-                        jid = check_whatsapp_exists(lead['phone'])
-                        
-                        if jid:
-                            lead['status'] = 'new'
-                            valid_leads_count += 1
-                        else:
-                            lead['status'] = 'invalid_number'
-                            
-                        # Add to DB
-                        from database import add_lead
-                        if add_lead(lead):
-                            new_leads_count += 1
-                            
-                status_text.success(f"Busca concluída! {new_leads_count} processados. {valid_leads_count} são WhatsApp válidos e prontos para contato.")
+                def show_progress(stored, stats):
+                    # Runs in this thread (widgets can't be touched from the pipeline threads)
+                    status_text.text(f"{stats.found} leads encontrados. Verificando WhatsApp... {stats.stored} salvos até agora.")
+                    progress_bar.progress(min(100, int(pages_done[0] / num_pages * 100)))
+                
+                # Check WhatsApp Validity BEFORE saving as 'new' (invalid ones are kept as 'invalid_number')
+                stats = ingest_pages(pages(), store_invalid=True, on_batch=show_progress)
+                
+                progress_bar.progress(100)
+                status_text.success(f"Busca concluída! {stats.stored} processados. {stats.stored_valid} são WhatsApp válidos e prontos para contato.")
                 
             except Exception as e:
                 st.error(f"Erro na busca: {e}")
@@ -150,17 +131,17 @@ elif page == "Visão Geral":
     st.title("📊 Visão Geral do Dia")
     
     conn = get_db_connection()
-    today_str = datetime.now().strftime('%Y-%m-%d')
+    today_start, tomorrow_start = day_bounds()
     
     # --- KPIs ---
     # 1. New Leads Today
-    new_leads_count = conn.execute(f"SELECT COUNT(*) FROM leads WHERE DATE(created_at) = '{today_str}'").fetchone()[0]
+    new_leads_count = conn.execute("SELECT COUNT(*) FROM leads WHERE created_at >= ? AND created_at < ?", (today_start, tomorrow_start)).fetchone()[0]
     
     # 2. Responded Today (Approximate by status + last_contact)
-    responded_count = conn.execute(f"SELECT COUNT(*) FROM leads WHERE status = 'responded' AND DATE(last_contact_date) = '{today_str}'").fetchone()[0]
+    responded_count = conn.execute("SELECT COUNT(*) FROM leads WHERE status = 'responded' AND last_contact_date >= ? AND last_contact_date < ?", (today_start, tomorrow_start)).fetchone()[0]
     
     # 3. Active Contacts Today (Sent/Follow-up)
-    contacted_count = conn.execute(f"SELECT COUNT(*) FROM leads WHERE status IN ('contacted', 'follow_up_1', 'follow_up_2', 'follow_up_3') AND DATE(last_contact_date) = '{today_str}'").fetchone()[0]
+    contacted_count = conn.execute("SELECT COUNT(*) FROM leads WHERE status IN ('contacted', 'follow_up_1', 'follow_up_2', 'follow_up_3') AND last_contact_date >= ? AND last_contact_date < ?", (today_start, tomorrow_start)).fetchone()[0]
     
     kp1, kp2, kp3 = st.columns(3)
     kp1.metric("🆕 Novos Leads (Hoje)", new_leads_count, help="Leads que entraram na base hoje")
@@ -171,7 +152,7 @@ elif page == "Visão Geral":
     
     # --- RECENT RETURNS (Highlights) ---
     recent_responses = conn.execute("""
-        SELECT name, phone, last_contact_date, conversation_history 
+        SELECT id, name, phone, last_contact_date 
         FROM leads 
         WHERE status = 'responded' 
         ORDER BY last_contact_date DESC 
@@ -180,18 +161,16 @@ elif page == "Visão Geral":
     
     if recent_responses:
         st.subheader("🔥 Últimos Retornos (Quentes)")
+        last_client_msgs = get_recent_messages_for_leads([r['id'] for r in recent_responses], per_lead=1, direction='in')
         cols = st.columns(len(recent_responses))
         for idx, row in enumerate(recent_responses):
             lead = dict(row)
             # Find last client msg
             last_msg = "..."
-            if lead['conversation_history']:
-                lines = lead['conversation_history'].split('\n')
-                # Try to find last line not starting with Agent prefix
-                for line in reversed(lines):
-                    if line.strip() and "Ivair" not in line and "Agente" not in line:
-                        last_msg = line[:50] + "..." if len(line) > 50 else line
-                        break
+            client_msgs = last_client_msgs.get(lead['id'])
+            if client_msgs and client_msgs[-1]['body']:
+                line = client_msgs[-1]['body'].strip()
+                last_msg = line[:50] + "..." if len(line) > 50 else line
             
             with cols[idx]:
                 st.info(f"**{lead['name']}**\n\n🕒 {lead['last_contact_date'][11:16]}\n\n💬 _{last_msg}_")
@@ -202,12 +181,13 @@ elif page == "Visão Geral":
     st.subheader("⏳ Linha do Tempo (Últimas 10 Ações)")
     
     timeline_leads = conn.execute("""
-        SELECT id, name, phone, status, last_contact_date, prompt_version, conversation_history 
+        SELECT id, name, phone, status, last_contact_date, prompt_version 
         FROM leads 
         WHERE last_contact_date IS NOT NULL 
         ORDER BY last_contact_date DESC 
         LIMIT 10
     """).fetchall()
+    last_sent_msgs = get_recent_messages_for_leads([r['id'] for r in timeline_leads], per_lead=1, direction='out')
     
     # Get Chatwoot base URL
     chatwoot_base = os.getenv("CHATWOOT_URL", "").replace("/conversations", "")
@@ -278,9 +258,10 @@ elif page == "Visão Geral":
         """, unsafe_allow_html=True)
         
         # Show message preview if contacted
-        if lead['status'] == 'contacted' and lead.get('conversation_history'):
+        sent_msgs = last_sent_msgs.get(lead['id'])
+        if lead['status'] == 'contacted' and sent_msgs:
             with st.expander(f"📄 Ver mensagem enviada (Prompt {lead.get('prompt_version', '?')})"):
-                st.text(lead['conversation_history'][:500])
+                st.text((sent_msgs[-1]['body'] or '')[:500])
 
     conn.close()
 
@@ -328,9 +309,10 @@ elif page == "Gerenciar Leads":
             st.info(f"Selecionado: **{lead['name']}** ({lead['phone']})")
             
             # Show History
-            if lead.get('conversation_history'):
+            lead_messages = get_messages(int(lead['id']), limit=50)
+            if lead_messages:
                 with st.expander("📜 Histórico de Conversa", expanded=True):
-                    st.text(lead['conversation_history'])
+                    st.text("\n".join(m['body'] for m in lead_messages if m['body']))
             
             # Show assigned prompt version if exists
             current_version = lead.get('prompt_version')
@@ -351,11 +333,13 @@ elif page == "Gerenciar Leads":
             if action == "Gerar Mensagem (IA)":
                 # Option to choose version manually or random
                 version_choice = st.selectbox("Versão do Prompt", ["Aleatório", "A", "B", "C"], index=0)
+                # Template local é instantâneo; a IA adapta o texto usando o site do lead
+                personalize = st.checkbox("Personalizar com IA (usa o site)", value=False)
                 
                 if st.button("Gerar"):
                     with st.spinner("Gerando..."):
                         website_content = None
-                        if lead['website']:
+                        if personalize and lead['website']:
                             website_content = scrape_website(lead['website'])
                         
                         # Logic for choosing version
@@ -365,7 +349,7 @@ elif page == "Gerenciar Leads":
                         else:
                             chosen_version = version_choice
                             
-                        msg = generate_message(lead, website_content, version=chosen_version)
+                        msg = generate_message(lead, website_content, version=chosen_version, personalize=personalize)
                         st.text_area("Mensagem Sugerida", value=msg, height=200)
                         
                         # Store selection in session state or just remind user (since we save on send)
@@ -380,7 +364,7 @@ elif page == "Gerenciar Leads":
                         # Detect if we just generated a prompt version
                         version_used = st.session_state.get('last_generated_version', None)
                         
-                        update_lead_status(lead['phone'], 'contacted', msg_to_send)
+                        update_lead_status(lead['phone'], 'contacted', msg_to_send, direction='out', source='manual', channel='whatsapp')
                         
                         if version_used:
                              from database import update_lead_prompt_version
@@ -407,7 +391,7 @@ elif page == "Gerenciar Leads":
 
             elif action == "Marcar como Respondido":
                 if st.button("Confirmar"):
-                    update_lead_status(lead['phone'], 'responded', "Marcado manualmente via Dashboard")
+                    update_lead_status(lead['phone'], 'responded', "Marcado manualmente via Dashboard", direction='note', source='dashboard')
                     st.success("Atualizado!")
                     st.rerun()
 
@@ -438,16 +422,11 @@ elif page == "Chat em Tempo Real":
     
     st.divider()
     
-    # 2. Chat View - Get leads with conversation history
-    chat_query = """
-        SELECT * FROM leads 
-        WHERE conversation_history IS NOT NULL AND conversation_history != ''
-        ORDER BY last_contact_date DESC
-        LIMIT 50
-    """
-    active_chats = conn.execute(chat_query).fetchall()
     conn.close()
     
+    # 2. Chat View - Get leads with messages
+    active_chats = get_active_chats(limit=50)
+    
     if not active_chats:
         st.info("Nenhuma conversa ativa encontrada. Aguardando mensagens...")
     else:
@@ -475,35 +454,30 @@ elif page == "Chat em Tempo Real":
             
             st.divider()
             
-            # Parse and display bubbles
-            history = lead['conversation_history']
-            if history:
-                lines = history.split('\n')
-                for line in lines:
-                    line = line.strip()
-                    if not line: continue
-                    
-                    is_agent = False
-                    if any(x in line for x in ["Agente", "Ivair", "Chatwoot Agent", "Follow-up", "Envio"]):
-                        is_agent = True
-                    
-                    # Style
-                    if is_agent:
-                        st.markdown(f"""
-                        <div style="display: flex; justify-content: flex-end; margin-bottom: 10px;">
-                            <div style="background-color: #dcf8c6; color: black; padding: 10px; border-radius: 10px; max-width: 70%;">
-                                {line}
-                            </div>
+            # Display bubbles (last page of messages only)
+            for msg in get_messages(lead['id'], limit=50):
+                line = (msg['body'] or '').strip()
+                if not line: continue
+                
+                is_agent = msg['direction'] != 'in'
+                
+                # Style
+                if is_agent:
+                    st.markdown(f"""
+                    <div style="display: flex; justify-content: flex-end; margin-bottom: 10px;">
+                        <div style="background-color: #dcf8c6; color: black; padding: 10px; border-radius: 10px; max-width: 70%;">
+                            {line}
                         </div>
-                        """, unsafe_allow_html=True)
-                    else:
-                         st.markdown(f"""
-                        <div style="display: flex; justify-content: flex-start; margin-bottom: 10px;">
-                            <div style="background-color: #ffffff; color: black; border: 1px solid #ddd; padding: 10px; border-radius: 10px; max-width: 70%;">
-                                {line}
-                            </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                else:
+                     st.markdown(f"""
+                    <div style="display: flex; justify-content: flex-start; margin-bottom: 10px;">
+                        <div style="background-color: #ffffff; color: black; border: 1px solid #ddd; padding: 10px; border-radius: 10px; max-width: 70%;">
+                            {line}
                         </div>
-                        """, unsafe_allow_html=True)
+                    </div>
+                    """, unsafe_allow_html=True)
             
             # Quick Reply Box
             st.divider()
@@ -514,7 +488,7 @@ elif page == "Chat em Tempo Real":
                         jid = check_whatsapp_exists(lead['phone'])
                         if jid:
                             send_message(jid, reply_text)
-                            update_lead_status(lead['phone'], 'contacted', f"🤖 Ivair (WhatsApp):\n\n{reply_text}")
+                            update_lead_status(lead['phone'], 'contacted', f"🤖 Ivair (WhatsApp):\n\n{reply_text}", direction='out', source='manual', channel='whatsapp')
                             
                             # Trello Sync
                             if trello_crm.is_configured():
@@ -561,21 +535,20 @@ elif page == "Configurações":
             
             cleaned_count = 0
             
-            for i, row in enumerate(leads_to_check):
-                lead = dict(row)
-                
+            # We might need to re-clean the phone just in case
+            leads_to_check = [dict(row) for row in leads_to_check]
+            status_t.text(f"Verificando {len(leads_to_check)} números em lote...")
+            jids = check_whatsapp_exists_many([format_number(l['phone']) for l in leads_to_check], use_cache=False)
+            
+            for i, lead in enumerate(leads_to_check):
                 # Progress
                 progress.progress(int((i / len(leads_to_check)) * 100))
-                status_t.text(f"Verificando: {lead['name']} ({lead['phone']})")
-                
-                # Check
-                # We might need to re-clean the phone just in case
-                clean_p = format_number(lead['phone'])
                 
-                jid = check_whatsapp_exists(clean_p)
+                phone = format_number(lead['phone'])
                 
-                if not jid:
-                    update_lead_status(lead['phone'], 'invalid_number', "Marcado como inválido durante limpeza")
+                # Ausente do resultado = não deu para verificar (erro da API): não invalida
+                if phone in jids and not jids[phone]:
+                    update_lead_status(lead['phone'], 'invalid_number', "Marcado como inválido durante limpeza", direction='note', source='revalidation')
                     cleaned_count += 1
                 
             progress.progress(100)
@@ -1,6 +1,11 @@
 import sqlite3
 import os
-from datetime import datetime
+import re
+import random
+import socket
+import threading
+from collections import deque
+from datetime import datetime, timedelta
 
 # Determine DB path provided by env or default to local data dir
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
@@ -9,10 +14,202 @@ if not os.path.exists(DATA_DIR):
 
 DB_NAME = os.path.join(DATA_DIR, "leads.db")
 
+# Connection pool tuning (server, scheduler and restore share the same file)
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# How long a scheduler worker owns a claimed lead before the reaper returns it to 'new'
+LEAD_LEASE_SECONDS = int(os.getenv("LEAD_LEASE_SECONDS", str(30 * 60)))
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection handed out by get_db_connection().
+    close() does not close the file: it ends any open transaction and
+    gives the connection back to the pool for the next caller.
+
+    A nested get_db_connection() on the same thread gets the same connection.
+    If the outer caller has a transaction open, the nested checkout runs inside
+    a SAVEPOINT: its commit() only releases the savepoint and its rollback()
+    (or close() with uncommitted work) only undoes its own writes, so helpers
+    can't end the caller's transaction.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkouts = 0
+        self._savepoints = [] # one per nested checkout: savepoint name, or None if no outer transaction
+        self._pid = os.getpid()
+
+    def _enter_nested(self):
+        name = None
+        if self.in_transaction:
+            name = f"nested_{len(self._savepoints) + 1}"
+            super().execute(f"SAVEPOINT {name}")
+        self._savepoints.append(name)
+        self._checkouts += 1
+
+    def _savepoint(self):
+        return self._savepoints[-1] if self._savepoints else None
+
+    def commit(self):
+        name = self._savepoint()
+        if name is None:
+            return super().commit()
+        # Keep the work for the outer transaction, and start a fresh savepoint
+        super().execute(f"RELEASE SAVEPOINT {name}")
+        super().execute(f"SAVEPOINT {name}")
+
+    def rollback(self):
+        name = self._savepoint()
+        if name is None:
+            return super().rollback()
+        super().execute(f"ROLLBACK TO SAVEPOINT {name}")
+
+    def close(self):
+        if self._checkouts > 1:
+            # Nested get_db_connection() on the same thread - outer caller still owns it
+            name = self._savepoints.pop()
+            self._checkouts -= 1
+            try:
+                if name is not None:
+                    # Uncommitted nested work is discarded, like a plain close()
+                    super().execute(f"ROLLBACK TO SAVEPOINT {name}")
+                    super().execute(f"RELEASE SAVEPOINT {name}")
+                elif self.in_transaction:
+                    super().rollback()
+            except sqlite3.OperationalError:
+                pass # the outer transaction was ended some other way
+            return
+        self._checkouts = 0
+        self._savepoints = []
+        _pool.release(self)
+
+    def really_close(self):
+        super().close()
+
+
+class _ConnectionPool:
+    """
+    Keeps a few open connections around so each helper doesn't pay
+    connect + PRAGMA cost. A connection is bound to one thread while
+    checked out, so callers keep sqlite3's one-thread-at-a-time rule.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            DB_NAME,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            factory=PooledConnection,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn._pid == os.getpid():
+            conn._enter_nested()
+            return conn
+
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if candidate._pid == os.getpid():
+                    conn = candidate
+                    break
+        if conn is None:
+            conn = self._connect()
+
+        conn._checkouts = 1
+        self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        if getattr(self._local, 'conn', None) is conn:
+            self._local.conn = None
+
+        try:
+            if conn.in_transaction:
+                # Same as a plain close(): uncommitted work is discarded
+                conn.rollback()
+        except sqlite3.Error:
+            conn.really_close()
+            return
+
+        with self._lock:
+            if conn._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.really_close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn.really_close()
+
+
+_pool = _ConnectionPool(DB_POOL_SIZE)
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Returns a pooled connection (WAL, busy timeout, tuned cache/mmap).
+    Callers still call conn.close() when done - that returns it to the pool.
+    """
+    return _pool.acquire()
+
+
+def close_db_connections():
+    """Really closes every idle pooled connection (shutdown / tests)."""
+    _pool.close_all()
+
+
+# Subsystem tables (rate_buckets, jid_cache, webhook_events, ...) are declared
+# next to their code with register_schema(). init_db() creates every schema
+# registered so far; ensure_schema() creates one on first use, for processes
+# that only import the module (dashboard, one-off scripts).
+_schemas = {}
+_schemas_ready = set()
+_schemas_lock = threading.Lock()
+
+
+def register_schema(name, *statements):
+    """Declares a subsystem's CREATE ... IF NOT EXISTS statements. Returns `name`."""
+    _schemas[name] = statements
+    return name
+
+
+def ensure_schema(name):
+    """Runs a registered schema once per process (cheap set lookup afterwards)."""
+    if name in _schemas_ready:
+        return
+    with _schemas_lock:
+        if name in _schemas_ready:
+            return
+        conn = get_db_connection()
+        for statement in _schemas[name]:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+        _schemas_ready.add(name)
 
 def init_db():
     conn = get_db_connection()
@@ -62,10 +259,138 @@ def init_db():
         c.execute('ALTER TABLE leads ADD COLUMN language TEXT')
     except sqlite3.OperationalError:
         pass # Column likely exists
-        
+
+    try:
+        c.execute('ALTER TABLE leads ADD COLUMN lease_expires_at TIMESTAMP')
+    except sqlite3.OperationalError:
+        pass # Column likely exists
+
+    try:
+        c.execute('ALTER TABLE leads ADD COLUMN claimed_by TEXT')
+    except sqlite3.OperationalError:
+        pass # Column likely exists
+
+    # One row per message (replaces appending to leads.conversation_history)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lead_id INTEGER NOT NULL REFERENCES leads(id) ON DELETE CASCADE,
+            direction TEXT NOT NULL,
+            source TEXT,
+            channel TEXT,
+            created_at TIMESTAMP,
+            body TEXT,
+            external_id TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_lead ON messages(lead_id, id)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_external_id ON messages(external_id) WHERE external_id IS NOT NULL')
+
+    # Versioned one-shot migrations (PRAGMA user_version)
+    schema_version = c.execute('PRAGMA user_version').fetchone()[0]
+    if schema_version < 1:
+        _migrate_history_to_messages(c)
+        c.execute('PRAGMA user_version = 1')
+    if schema_version < 2:
+        for index_sql in LEAD_INDEXES:
+            c.execute(index_sql)
+        c.execute('ANALYZE leads')
+        c.execute('PRAGMA user_version = 2')
+    if schema_version < 3:
+        c.execute(QUEUE_INDEX)
+        c.execute('PRAGMA user_version = 3')
+
     conn.commit()
     conn.close()
 
+    for name in list(_schemas):
+        ensure_schema(name)
+
+
+# Index set for the hot lead queries (schema version 2)
+LEAD_INDEXES = [
+    # Queue/status scans: scheduler refill count, follow-ups stage 1, dashboard KPIs (covering)
+    'CREATE INDEX IF NOT EXISTS idx_leads_status_last_contact ON leads(status, last_contact_date)',
+    # Follow-ups stage 2/3 (status = 'follow_up' AND next_contact_date <= now)
+    'CREATE INDEX IF NOT EXISTS idx_leads_status_next_contact ON leads(status, next_contact_date)',
+    # Recent activity / feed ordering
+    'CREATE INDEX IF NOT EXISTS idx_leads_last_contact ON leads(last_contact_date)',
+    # "New leads today" KPI and get_all_leads ordering
+    'CREATE INDEX IF NOT EXISTS idx_leads_created_at ON leads(created_at)',
+]
+
+# Claim queue: picks "first 'new' lead at or after a random id" straight from the index (schema version 3)
+QUEUE_INDEX = 'CREATE INDEX IF NOT EXISTS idx_leads_queue ON leads(status, id)'
+
+
+def day_bounds(day=None):
+    """
+    [start, end) strings for one calendar day, so date filters stay
+    range scans on the indexed column instead of date(column) = ?.
+    """
+    day = day or datetime.now().date()
+    return day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def explain_query_plan(sql, params=()):
+    """Returns the EXPLAIN QUERY PLAN detail lines for a query."""
+    conn = get_db_connection()
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    conn.close()
+    return [row['detail'] for row in rows]
+
+
+# Lines that start a new entry inside the legacy conversation_history blob
+_HISTORY_ENTRY_START = re.compile(
+    r'^(🤖|📩|🗣️|🔄|📝|Status alterado|Marcado|Invalidado|Cliente:|Ivair:)'
+)
+_INBOUND_PREFIXES = ('📩', 'Cliente')
+_NOTE_PREFIXES = ('Status alterado', 'Marcado', 'Invalidado')
+
+
+def _guess_direction(text):
+    """'in' (client), 'note' (manual status notes) or 'out' (us), from the message prefix."""
+    head = (text or '').lstrip()
+    if head.startswith(_INBOUND_PREFIXES):
+        return 'in'
+    if head.startswith(_NOTE_PREFIXES):
+        return 'note'
+    return 'out'
+
+
+def _split_history_blob(history):
+    """Splits a legacy conversation_history blob back into individual messages."""
+    entries = []
+    current = []
+    for line in history.split('\n'):
+        if _HISTORY_ENTRY_START.match(line.strip()) and any(l.strip() for l in current):
+            entries.append('\n'.join(current).strip())
+            current = []
+        current.append(line)
+    if any(l.strip() for l in current):
+        entries.append('\n'.join(current).strip())
+    return entries
+
+
+def _migrate_history_to_messages(c):
+    rows = c.execute('''
+        SELECT id, conversation_history, COALESCE(last_contact_date, created_at) AS ts
+        FROM leads
+        WHERE conversation_history IS NOT NULL AND conversation_history != ''
+    ''').fetchall()
+
+    migrated = 0
+    for row in rows:
+        for body in _split_history_blob(row['conversation_history']):
+            c.execute('''
+                INSERT INTO messages (lead_id, direction, source, channel, created_at, body)
+                VALUES (?, ?, 'legacy', NULL, ?, ?)
+            ''', (row['id'], _guess_direction(body), row['ts'], body))
+            migrated += 1
+
+    if rows:
+        print(f"[DB] Migrated {migrated} messages from {len(rows)} conversation_history blobs.")
+
 def update_lead_prompt_version(phone, version):
     conn = get_db_connection()
     c = conn.cursor()
@@ -104,33 +429,357 @@ def get_lead_by_phone(phone):
     conn.close()
     return lead
 
-def update_lead_status(phone, status, message=None):
+def get_existing_phones(phones):
+    """Which of `phones` already have a lead (batched IN lookups instead of one query per phone)."""
+    phones = list(dict.fromkeys(p for p in phones if p))
+    existing = set()
+    conn = get_db_connection()
+    for i in range(0, len(phones), 500):
+        chunk = phones[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f'SELECT phone FROM leads WHERE phone IN ({placeholders})', chunk).fetchall()
+        existing.update(row['phone'] for row in rows)
+    conn.close()
+    return existing
+
+# Columns upsert_leads() writes, in VALUES order
+UPSERT_COLUMNS = ('name', 'phone', 'address', 'website', 'rating', 'reviews', 'types', 'search_term', 'language', 'status', 'last_contact_date')
+
+# Merge policies for a phone that already has a lead (per column, in upsert_leads):
+#   'keep'    - existing value wins (column untouched)
+#   'replace' - incoming value wins when given (not None)
+#   'fill'    - incoming value only fills an empty (NULL / '') column
+#   'max'     - greater of both (e.g. last_contact_date)
+_MERGE_SQL = {
+    'replace': "COALESCE(excluded.{col}, leads.{col})",
+    'fill': "COALESCE(NULLIF(leads.{col}, ''), excluded.{col})",
+    'max': "MAX(COALESCE(leads.{col}, excluded.{col}), COALESCE(excluded.{col}, leads.{col}))",
+}
+
+def upsert_leads(leads, merge=None):
+    """
+    Inserts or updates many leads in one transaction (one executemany).
+    `merge` maps column -> policy ('keep', 'replace', 'fill', 'max') for phones
+    that already exist; unlisted columns are kept, so merge=None never touches
+    an existing lead. New leads get status 'new' unless one is given.
+    Returns (inserted, updated) lists of the lead dicts.
+    """
+    merge = merge or {}
+    for col, policy in merge.items():
+        if col not in UPSERT_COLUMNS or col == 'phone' or (policy != 'keep' and policy not in _MERGE_SQL):
+            raise ValueError(f"Invalid merge policy {col}={policy}")
+    updates = [
+        f"{col} = " + _MERGE_SQL[policy].format(col=col)
+        for col, policy in merge.items() if policy != 'keep'
+    ]
+    on_conflict = 'DO UPDATE SET ' + ', '.join(updates) if updates else 'DO NOTHING'
+    # The 'new' default only applies to rows being inserted: for existing phones
+    # excluded.status must stay NULL when not given, or 'replace' would reset it
+    insert_placeholders = ', '.join("COALESCE(?, 'new')" if col == 'status' else '?' for col in UPSERT_COLUMNS)
+    update_placeholders = ', '.join('?' for col in UPSERT_COLUMNS)
+
+    leads = [l for l in leads if l.get('phone')]
+    if not leads:
+        return [], []
+
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        if not conn.in_transaction:
+            # Write lock up front: the existing-phone check and the write see the same rows
+            c.execute('BEGIN IMMEDIATE')
+        existing = set()
+        phones = list(dict.fromkeys(l['phone'] for l in leads))
+        for i in range(0, len(phones), 500):
+            chunk = phones[i:i + 500]
+            rows = c.execute(f"SELECT phone FROM leads WHERE phone IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            existing.update(row['phone'] for row in rows)
+
+        inserted, updated = [], []
+        for lead_data in leads:
+            (updated if lead_data['phone'] in existing else inserted).append(lead_data)
+            existing.add(lead_data['phone'])
+
+        for batch, placeholders in ((inserted, insert_placeholders), (updated, update_placeholders)):
+            if not batch or (batch is updated and not updates):
+                continue
+            c.executemany(f'''
+                INSERT INTO leads ({', '.join(UPSERT_COLUMNS)})
+                VALUES ({placeholders})
+                ON CONFLICT(phone) {on_conflict}
+            ''', [tuple(lead_data.get(col) for col in UPSERT_COLUMNS) for lead_data in batch])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if not updates:
+        updated = [] # DO NOTHING: existing leads were left as they were
+    return inserted, updated
+
+def add_leads(leads):
+    """
+    Bulk add_lead() in one transaction; honors lead['status'] (default 'new').
+    Phones that already exist are skipped. Returns the leads actually inserted.
+    """
+    return upsert_leads(leads)[0]
+
+def update_lead_status(phone, status, message=None, direction=None, source=None, channel=None, external_id=None):
+    """
+    Returns True if `message` was stored (False if absent or external_id already seen).
+    A message whose external_id was already stored is a redelivery: the lead
+    is left untouched, so replaying a webhook is a no-op.
+    """
+    now = datetime.now()
     conn = get_db_connection()
     c = conn.cursor()
+    added = False
     if message:
+        added = _insert_message(c, phone, message, direction, source, channel, now, external_id)
+    if added or not (message and external_id):
         c.execute('''
             UPDATE leads 
-            SET status = ?, last_contact_date = ?, conversation_history = COALESCE(conversation_history, '') || ? || '\n'
-            WHERE phone = ?
-        ''', (status, datetime.now(), message, phone))
-    else:
-        c.execute('''
-            UPDATE leads 
-            SET status = ?, last_contact_date = ?
+            SET status = ?, last_contact_date = ?, lease_expires_at = NULL, claimed_by = NULL
             WHERE phone = ?
-        ''', (status, datetime.now(), phone))
+        ''', (status, now, phone))
+    conn.commit()
+    conn.close()
+    return added
+
+
+def _default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def claim_next_lead(lease_seconds=LEAD_LEASE_SECONDS, worker_id=None, prefer_ids=None):
+    """
+    Atomically moves one random 'new' lead to 'processing' and returns it (dict),
+    or None if the queue is empty.
+
+    The pick is index-driven: a random pivot id, then the first 'new' lead at or
+    after it (wrapping to the start). The claim is a single UPDATE ... RETURNING,
+    so concurrent workers never get the same lead and never need to retry.
+    prefer_ids: leads claimed before the random pick when still 'new'
+    (e.g. the ones with a pre-generated message waiting in the cache).
+    """
+    worker_id = worker_id or _default_worker_id()
+    lease_expires_at = datetime.now() + timedelta(seconds=lease_seconds)
+
+    conn = get_db_connection()
+    prefer_ids = list(prefer_ids or [])[:500]
+    if prefer_ids:
+        placeholders = ','.join('?' * len(prefer_ids))
+        lead = conn.execute(f'''
+            UPDATE leads
+            SET status = 'processing', lease_expires_at = ?, claimed_by = ?
+            WHERE id = (
+                SELECT id FROM leads
+                WHERE status = 'new' AND id IN ({placeholders})
+                ORDER BY id
+                LIMIT 1
+            )
+            AND status = 'new'
+            RETURNING *
+        ''', (lease_expires_at, worker_id, *prefer_ids)).fetchone()
+        conn.commit()
+        if lead:
+            conn.close()
+            return dict(lead)
+
+    max_id = conn.execute("SELECT MAX(id) FROM leads").fetchone()[0]
+    if max_id is None:
+        conn.close()
+        return None
+
+    pivot = random.randint(1, max_id)
+    lead = None
+    for start_id in (pivot, 0):
+        lead = conn.execute('''
+            UPDATE leads
+            SET status = 'processing', lease_expires_at = ?, claimed_by = ?
+            WHERE id = (
+                SELECT id FROM leads
+                WHERE status = 'new' AND id >= ?
+                ORDER BY id
+                LIMIT 1
+            )
+            AND status = 'new'
+            RETURNING *
+        ''', (lease_expires_at, worker_id, start_id)).fetchone()
+        conn.commit()
+        if lead:
+            break
+
+    conn.close()
+    return dict(lead) if lead else None
+
+
+def extend_lead_lease(lead_id, lease_seconds=LEAD_LEASE_SECONDS):
+    """Pushes a claimed lead's lease forward (long-running sends)."""
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE leads SET lease_expires_at = ?
+        WHERE id = ? AND status = 'processing'
+    ''', (datetime.now() + timedelta(seconds=lease_seconds), lead_id))
+    conn.commit()
+    conn.close()
+
+
+def reap_stale_leases():
+    """
+    Returns leads stuck in 'processing' (worker crashed / restarted) to 'new'.
+    Rows without a lease come from before the claim queue and are reaped too.
+    Returns how many leads were released.
+    """
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        UPDATE leads
+        SET status = 'new', lease_expires_at = NULL, claimed_by = NULL
+        WHERE status = 'processing'
+        AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+    ''', (datetime.now(),))
+    conn.commit()
+    released = cursor.rowcount
+    conn.close()
+    return released
+
+
+def _insert_message(c, phone, body, direction=None, source=None, channel=None, created_at=None, external_id=None):
+    c.execute('''
+        INSERT OR IGNORE INTO messages (lead_id, direction, source, channel, created_at, body, external_id)
+        SELECT id, ?, ?, ?, ?, ?, ? FROM leads WHERE phone = ?
+    ''', (
+        direction or _guess_direction(body),
+        source,
+        channel,
+        created_at or datetime.now(),
+        body,
+        external_id,
+        phone
+    ))
+    return c.rowcount > 0
+
+
+def add_message(phone, body, direction=None, source=None, channel=None, created_at=None, external_id=None):
+    """
+    Appends one message to a lead's conversation without touching its status.
+    Returns False if the lead doesn't exist or external_id was already stored.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    added = _insert_message(c, phone, body, direction, source, channel, created_at, external_id)
     conn.commit()
     conn.close()
+    return added
+
+
+def add_messages(phone, messages):
+    """
+    Bulk add_message() in a single transaction.
+    `messages` is a list of dicts with body, direction, source, channel, created_at, external_id.
+    Returns how many were actually inserted.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    added = 0
+    for m in messages:
+        if _insert_message(c, phone, m['body'], m.get('direction'), m.get('source'), m.get('channel'), m.get('created_at'), m.get('external_id')):
+            added += 1
+    conn.commit()
+    conn.close()
+    return added
+
+
+def get_messages(lead_id, limit=50, before_id=None):
+    """
+    One page of a lead's messages in chronological order.
+    Pass the smallest id of the current page as before_id to load older ones.
+    """
+    conn = get_db_connection()
+    if before_id:
+        rows = conn.execute('''
+            SELECT * FROM messages
+            WHERE lead_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (lead_id, before_id, limit)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT * FROM messages
+            WHERE lead_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (lead_id, limit)).fetchall()
+    conn.close()
+    return [dict(row) for row in reversed(rows)]
+
+
+def get_recent_messages_for_leads(lead_ids, per_lead=1, direction=None):
+    """
+    Last `per_lead` messages of each lead in one query.
+    Returns {lead_id: [messages in chronological order]}.
+    """
+    lead_ids = list(lead_ids)
+    if not lead_ids:
+        return {}
+
+    placeholders = ','.join('?' * len(lead_ids))
+    params = list(lead_ids)
+    direction_filter = ""
+    if direction:
+        direction_filter = "AND direction = ?"
+        params.append(direction)
+    params.append(per_lead)
+
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT * FROM (
+            SELECT m.*, ROW_NUMBER() OVER (PARTITION BY lead_id ORDER BY id DESC) AS rn
+            FROM messages m
+            WHERE lead_id IN ({placeholders}) {direction_filter}
+        )
+        WHERE rn <= ?
+        ORDER BY lead_id, id
+    ''', params).fetchall()
+    conn.close()
+
+    result = {}
+    for row in rows:
+        msg = dict(row)
+        msg.pop('rn', None)
+        result.setdefault(msg['lead_id'], []).append(msg)
+    return result
+
+
+def get_conversation_text(lead_id, limit=20):
+    """Last `limit` messages joined as plain text (LLM prompts / follow-ups)."""
+    messages = get_messages(lead_id, limit=limit)
+    return "\n".join(m['body'] for m in messages if m['body'] and m['direction'] != 'note')
+
+
+def get_active_chats(limit=50):
+    """Leads that have at least one message, most recent contact first."""
+    conn = get_db_connection()
+    leads = conn.execute('''
+        SELECT * FROM leads l
+        WHERE EXISTS (SELECT 1 FROM messages m WHERE m.lead_id = l.id)
+        ORDER BY last_contact_date DESC
+        LIMIT ?
+    ''', (limit,)).fetchall()
+    conn.close()
+    return [dict(row) for row in leads]
 
 def get_dashboard_stats():
     conn = get_db_connection()
-    today = datetime.now().strftime('%Y-%m-%d')
+    today_start, tomorrow_start = day_bounds()
     
-    # KPIs
-    new_leads = conn.execute("SELECT COUNT(*) FROM leads WHERE date(created_at) = ?", (today,)).fetchone()[0]
-    sent = conn.execute("SELECT COUNT(*) FROM leads WHERE status IN ('contacted', 'follow_up_1', 'follow_up_2') AND date(last_contact_date) = ?", (today,)).fetchone()[0]
+    # KPIs (range predicates so they're answered from the indexes)
+    new_leads = conn.execute("SELECT COUNT(*) FROM leads WHERE created_at >= ? AND created_at < ?", (today_start, tomorrow_start)).fetchone()[0]
+    sent = conn.execute("SELECT COUNT(*) FROM leads WHERE status IN ('contacted', 'follow_up_1', 'follow_up_2') AND last_contact_date >= ? AND last_contact_date < ?", (today_start, tomorrow_start)).fetchone()[0]
     # Responses logic might need tuning based on actual status usage
-    responses = conn.execute("SELECT COUNT(*) FROM leads WHERE status IN ('responded', 'connected') AND date(last_contact_date) = ?", (today,)).fetchone()[0]
+    responses = conn.execute("SELECT COUNT(*) FROM leads WHERE status IN ('responded', 'connected') AND last_contact_date >= ? AND last_contact_date < ?", (today_start, tomorrow_start)).fetchone()[0]
     
     conn.close()
     return {
@@ -141,12 +790,21 @@ def get_dashboard_stats():
 
 def get_hot_leads(limit=5):
     conn = get_db_connection()
+    # One arm per status so each walks idx_leads_status_last_contact newest-first;
+    # an IN (...) with ORDER BY makes SQLite scan the whole last_contact_date index
     leads = conn.execute("""
-        SELECT * FROM leads 
-        WHERE status IN ('responded', 'connected')
-        ORDER BY last_contact_date DESC 
+        SELECT * FROM (
+            SELECT * FROM leads WHERE status = 'responded'
+            ORDER BY last_contact_date DESC LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT * FROM leads WHERE status = 'connected'
+            ORDER BY last_contact_date DESC LIMIT ?
+        )
+        ORDER BY last_contact_date DESC
         LIMIT ?
-    """, (limit,)).fetchall()
+    """, (limit, limit, limit)).fetchall()
     conn.close()
     return [dict(row) for row in leads]
 
@@ -1,4 +1,4 @@
-import requests
+import http_client
 import re
 import os
 from dotenv import load_dotenv
@@ -17,7 +17,7 @@ def get_all_cards():
         'key': API_KEY,
         'token': TOKEN
     }
-    response = requests.get(url, params=query)
+    response = http_client.get(url, params=query)
     return response.json()
 
 def get_card_actions(card_id):
@@ -27,7 +27,7 @@ def get_card_actions(card_id):
         'key': API_KEY,
         'token': TOKEN
     }
-    response = requests.get(url, params=query)
+    response = http_client.get(url, params=query)
     if response.status_code == 200:
         return response.json()
     return []
@@ -39,7 +39,7 @@ def add_comment(card_id, text):
         'key': API_KEY,
         'token': TOKEN
     }
-    requests.post(url, params=query)
+    http_client.post(url, params=query)
 
 def archive_card(card_id):
     url = f"{BASE_URL}/cards/{card_id}"
@@ -48,7 +48,7 @@ def archive_card(card_id):
         'key': API_KEY,
         'token': TOKEN
     }
-    requests.put(url, params=query)
+    http_client.put(url, params=query)
 
 def extract_phone(card_name):
     # Try to extract phone from "Name - Phone" format
@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+from database import get_db_connection, register_schema, ensure_schema
+
+# Website content fetched for leads (url -> cleaned text via r.jina.ai).
+# Filled ahead of time by scraper.start_prefetcher() so generating a message
+# reads it from here instead of waiting on a 15s scrape. Failures are cached
+# too (shorter, growing TTL) so a dead site isn't retried on every lead.
+ENRICHMENT_TTL_SECONDS = int(os.getenv("ENRICHMENT_TTL_SECONDS", str(30 * 24 * 3600)))
+ENRICHMENT_NEGATIVE_TTL_SECONDS = int(os.getenv("ENRICHMENT_NEGATIVE_TTL_SECONDS", str(24 * 3600)))
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+_SCHEMA = register_schema(
+    'enrichment_store',
+    '''
+    CREATE TABLE IF NOT EXISTS web_content (
+        url TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        http_status INTEGER,
+        content TEXT,
+        content_hash TEXT,
+        failures INTEGER NOT NULL DEFAULT 0,
+        fetched_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_web_content_expires ON web_content(expires_at)',
+)
+
+
+def normalize_url(url):
+    url = (url or '').strip()
+    if not url:
+        return None
+    # Ensure URL has protocol
+    if not url.startswith('http'):
+        url = 'https://' + url
+    return url.rstrip('/')
+
+
+def get(url):
+    """Fresh entry for a URL as a dict (status, content, ...), or None on a miss."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT * FROM web_content WHERE url = ? AND expires_at > ?',
+        (normalize_url(url), time.time())
+    ).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def missing(urls):
+    """The URLs (normalized, deduplicated) without a fresh entry."""
+    ensure_schema(_SCHEMA)
+    urls = list(dict.fromkeys(u for u in map(normalize_url, urls) if u))
+    if not urls:
+        return []
+    fresh = set()
+    conn = get_db_connection()
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows = conn.execute(
+            f"SELECT url FROM web_content WHERE url IN ({','.join('?' * len(chunk))}) AND expires_at > ?",
+            (*chunk, time.time())
+        ).fetchall()
+        fresh.update(row['url'] for row in rows)
+    conn.close()
+    return [u for u in urls if u not in fresh]
+
+
+def put(url, content, http_status=None):
+    """
+    Stores a fetch result; content None records a failure (negative entry,
+    TTL doubling with consecutive failures). Returns True if the content
+    changed since the last successful fetch.
+    """
+    ensure_schema(_SCHEMA)
+    url = normalize_url(url)
+    now = time.time()
+    conn = get_db_connection()
+    previous = conn.execute('SELECT content_hash, failures FROM web_content WHERE url = ?', (url,)).fetchone()
+
+    if content is None:
+        failures = (previous['failures'] if previous else 0) + 1
+        ttl = min(ENRICHMENT_NEGATIVE_TTL_SECONDS * (2 ** (failures - 1)), ENRICHMENT_TTL_SECONDS)
+        # A failed refresh keeps the last good content hash around
+        conn.execute('''
+            INSERT INTO web_content (url, status, http_status, content, content_hash, failures, fetched_at, expires_at)
+            VALUES (?, ?, ?, NULL, NULL, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                status = excluded.status, http_status = excluded.http_status, content = NULL,
+                failures = excluded.failures, fetched_at = excluded.fetched_at, expires_at = excluded.expires_at
+        ''', (url, STATUS_FAILED, http_status, failures, now, now + ttl))
+        changed = False
+    else:
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        conn.execute('''
+            INSERT INTO web_content (url, status, http_status, content, content_hash, failures, fetched_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                status = excluded.status, http_status = excluded.http_status, content = excluded.content,
+                content_hash = excluded.content_hash, failures = 0,
+                fetched_at = excluded.fetched_at, expires_at = excluded.expires_at
+        ''', (url, STATUS_OK, http_status, content, content_hash, now, now + ENRICHMENT_TTL_SECONDS))
+        changed = not previous or previous['content_hash'] != content_hash
+    conn.commit()
+    conn.close()
+    return changed
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('DELETE FROM web_content WHERE expires_at <= ?', (time.time(),))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+def get_stats():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute('''
+        SELECT COUNT(*) AS urls,
+               COALESCE(SUM(status = ? AND expires_at > ?), 0) AS fresh_ok,
+               COALESCE(SUM(status = ? AND expires_at > ?), 0) AS fresh_failed,
+               COALESCE(SUM(LENGTH(content)), 0) AS content_chars
+        FROM web_content
+    ''', (STATUS_OK, time.time(), STATUS_FAILED, time.time())).fetchone()
+    conn.close()
+    return dict(row)
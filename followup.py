@@ -1,6 +1,6 @@
 import sqlite3
 from datetime import datetime, timedelta
-from database import get_db_connection, update_lead_status
+from database import get_db_connection, update_lead_status, add_message, get_conversation_text
 from whatsapp import check_whatsapp_exists, send_message
 from agent import generate_message
 
@@ -18,39 +18,35 @@ FOLLOWUP_PROMPTS = {
 }
 
 
-def get_due_followups():
+def get_due_followups(as_of=None):
     """
     Busca leads elegíveis para follow-up.
     VERSÃO CORRIGIDA: Verifica Chatwoot antes de incluir na lista.
+    as_of: considera vencidos até esse momento (o job em lote olha o dia seguinte).
     """
+    as_of = as_of or datetime.now()
     conn = get_db_connection()
     leads = []
     
-    # Stage 1 Candidates (contacted, nunca fez follow-up)
+    # Stage 1 Candidates (contacted, nunca fez follow-up, último contato há >= 3 dias)
+    # Range on last_contact_date so it's served by idx_leads_status_last_contact
+    stage1_cutoff = as_of - timedelta(days=FOLLOWUP_DELAYS[1])
     rows = conn.execute("""
         SELECT * FROM leads 
         WHERE status = 'contacted' 
+        AND last_contact_date <= ?
         AND (follow_up_stage = 0 OR follow_up_stage IS NULL)
-    """).fetchall()
+    """, (stage1_cutoff,)).fetchall()
     
     for row in rows:
-        try:
-            last_contact = datetime.strptime(row['last_contact_date'], '%Y-%m-%d %H:%M:%S.%f')
-        except:
-            try:
-                last_contact = datetime.strptime(row['last_contact_date'], '%Y-%m-%d %H:%M:%S')
-            except:
-                continue
-                
-        if (datetime.now() - last_contact).days >= FOLLOWUP_DELAYS[1]:
-            leads.append(dict(row))
+        leads.append(dict(row))
             
     # Stage 2 & 3 Candidates
     rows = conn.execute("""
         SELECT * FROM leads 
         WHERE status = 'follow_up' 
         AND next_contact_date <= ?
-    """, (datetime.now(),)).fetchall()
+    """, (as_of,)).fetchall()
     
     for row in rows:
         leads.append(dict(row))
@@ -59,9 +55,11 @@ def get_due_followups():
     return leads
 
 
-def should_followup(lead):
+def should_followup(lead, allow_waiting=False):
     """
     Verifica no Chatwoot se devemos fazer follow-up para este lead.
+    allow_waiting: aceita 'waiting_response' (ainda não completou os dias de
+    espera hoje, mas vence até o envio - usado pelo job em lote da noite).
     
     Returns:
         tuple: (should_send: bool, reason: str, history: str or None)
@@ -71,6 +69,9 @@ def should_followup(lead):
         
         contact_check = chatwoot_api.should_contact_lead(lead['phone'])
         
+        if allow_waiting and contact_check['reason'] == 'waiting_response':
+            return (True, contact_check['reason'], contact_check.get('conversation_history'))
+
         if not contact_check['should_contact']:
             reason = contact_check['reason']
             
@@ -107,6 +108,7 @@ def process_followups(dry_run=True):
     
     processed = 0
     skipped = 0
+    eligible = []
     
     for lead in leads:
         current_stage = lead.get('follow_up_stage') or 0
@@ -143,15 +145,21 @@ def process_followups(dry_run=True):
         
         print(f"    ✅ Pode enviar follow-up. Razão: {reason}")
         
-        # =====================================================================
-        # GERAR MENSAGEM DE FOLLOW-UP
-        # =====================================================================
-        from agent import generate_followup_message
-        
         # Adiciona histórico ao lead para contexto
-        lead['conversation_history'] = history or lead.get('conversation_history', '')
-        
-        message = generate_followup_message(lead, next_stage)
+        lead['conversation_history'] = history or get_conversation_text(lead['id'])
+        eligible.append((lead, next_stage))
+    
+    # =========================================================================
+    # GERAR MENSAGENS DE FOLLOW-UP (todas em paralelo, limitado por LLM_CONCURRENCY)
+    # =========================================================================
+    from agent import generate_followup_messages
+    
+    if eligible:
+        print(f"\n[Follow-up] Generating {len(eligible)} messages...")
+    messages = generate_followup_messages(eligible)
+    
+    for (lead, next_stage), message in zip(eligible, messages):
+        print(f"\n--- Lead: {lead['name']} ({lead['phone']}) - follow-up {next_stage} ---")
         
         if not message:
             print("    ❌ Failed to generate message.")
@@ -189,13 +197,14 @@ def process_followups(dry_run=True):
             SET status = 'follow_up', 
                 follow_up_stage = ?, 
                 last_contact_date = ?, 
-                next_contact_date = ?,
-                conversation_history = COALESCE(conversation_history, '') || ? || '\n'
+                next_contact_date = ?
             WHERE id = ?
-        ''', (next_stage, datetime.now(), next_date, f"\n🔄 Follow-up {next_stage}:\n{message}", lead['id']))
+        ''', (next_stage, datetime.now(), next_date, lead['id']))
         conn.commit()
         conn.close()
         
+        add_message(lead['phone'], f"🔄 Follow-up {next_stage}:\n{message}", direction='out', source='followup', channel='whatsapp')
+        
         print(f"    ✅ Follow-up {next_stage} sent!")
         processed += 1
         
@@ -209,10 +218,6 @@ def process_followups(dry_run=True):
                     print(f"    📋 Trello synced")
         except Exception as t_err:
             print(f"    ⚠️ Trello error: {t_err}")
-        
-        # Delay entre leads para não parecer spam
-        import time
-        time.sleep(5)
     
     print(f"\n[Follow-up] Summary: {processed} sent, {skipped} skipped")
 
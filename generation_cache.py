@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from database import get_db_connection, register_schema, ensure_schema
+
+# LLM completions keyed by (function, model, prompt hash, temperature).
+# Identical requests (the "Gerar" button clicked again, sync re-analyzing an
+# unchanged conversation) are answered from here instead of calling OpenAI.
+# SQLite keeps entries across processes/restarts; a small in-process LRU in
+# front of it serves repeated hits without touching the DB.
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_MEMORY_ENTRIES = 256
+
+_memory = OrderedDict() # key -> (response, expires_at)
+_lock = threading.Lock()
+_counters = {} # function -> {'hits', 'memory_hits', 'misses'}
+
+_SCHEMA = register_schema(
+    'generation_cache',
+    '''
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        cache_key TEXT PRIMARY KEY,
+        function TEXT NOT NULL,
+        model TEXT NOT NULL,
+        temperature REAL,
+        response TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        last_used_at REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used_at)',
+)
+
+
+def make_key(function, model, temperature, messages, **params):
+    """Content address of one request: the full prompt plus every generation parameter."""
+    prompt_hash = hashlib.sha256(
+        json.dumps({'messages': messages, 'params': params}, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    return f"{function}:{model}:{temperature}:{prompt_hash}"
+
+
+def _count(function, field):
+    with _lock:
+        counters = _counters.setdefault(function, {'hits': 0, 'memory_hits': 0, 'misses': 0})
+        counters[field] += 1
+
+
+def _remember(key, response, expires_at):
+    with _lock:
+        _memory[key] = (response, expires_at)
+        _memory.move_to_end(key)
+        while len(_memory) > LLM_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def get(function, key):
+    """Cached response text, or None on a miss."""
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry and entry[1] > now:
+            _memory.move_to_end(key)
+        else:
+            entry = None
+    if entry:
+        _count(function, 'memory_hits')
+        return entry[0]
+
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT response, expires_at FROM llm_cache WHERE cache_key = ? AND expires_at > ?', (key, now)
+    ).fetchone()
+    if row:
+        conn.execute('UPDATE llm_cache SET hits = hits + 1, last_used_at = ? WHERE cache_key = ?', (now, key))
+        conn.commit()
+    conn.close()
+
+    if not row:
+        _count(function, 'misses')
+        return None
+    _count(function, 'hits')
+    _remember(key, row['response'], row['expires_at'])
+    return row['response']
+
+
+def has(key):
+    """Whether a fresh entry exists (no counters, no LRU update)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute('SELECT 1 FROM llm_cache WHERE cache_key = ? AND expires_at > ?', (key, time.time())).fetchone()
+    conn.close()
+    return row is not None
+
+
+def put(function, key, model, temperature, response, ttl=None):
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    expires_at = now + (ttl or LLM_CACHE_TTL_SECONDS)
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO llm_cache (cache_key, function, model, temperature, response, created_at, expires_at, last_used_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(cache_key) DO UPDATE SET
+            response = excluded.response, created_at = excluded.created_at,
+            expires_at = excluded.expires_at, last_used_at = excluded.last_used_at, hits = 0
+    ''', (key, function, model, temperature, response, now, expires_at, now))
+    # Size bound: evict the least recently used entries
+    conn.execute('''
+        DELETE FROM llm_cache WHERE cache_key IN (
+            SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+        )
+    ''', (LLM_CACHE_MAX_ENTRIES,))
+    conn.commit()
+    conn.close()
+    _remember(key, response, expires_at)
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (time.time(),))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+def get_stats():
+    """This process's hit/miss counters per function, plus what's stored."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    stored = [dict(row) for row in conn.execute('''
+        SELECT function, COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS lifetime_hits
+        FROM llm_cache GROUP BY function
+    ''').fetchall()]
+    conn.close()
+    with _lock:
+        counters = {f: dict(c) for f, c in _counters.items()}
+    for c in counters.values():
+        total = c['hits'] + c['memory_hits'] + c['misses']
+        c['hit_rate'] = round((c['hits'] + c['memory_hits']) / total, 3) if total else 0
+    return {'functions': counters, 'stored': stored}
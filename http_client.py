@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP layer for Evolution, Chatwoot, Trello and Jina:
+# one keep-alive pool per host, default timeouts and bounded retries.
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "15"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.5"))
+HTTP_MAX_RETRY_WAIT_SECONDS = float(os.getenv("HTTP_MAX_RETRY_WAIT_SECONDS", "30"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Retrying these can't duplicate side effects (a POST can send a WhatsApp twice)
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class HostMetrics:
+    """Request/latency counters for one host (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.status_counts = {}
+        self._recent_ms = deque(maxlen=500)
+
+    def record(self, elapsed_ms, status=None, retried=False):
+        with self._lock:
+            self.requests += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self._recent_ms.append(elapsed_ms)
+            if status is None:
+                self.errors += 1
+            else:
+                self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            if retried:
+                self.retries += 1
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self._recent_ms)
+            p50 = recent[len(recent) // 2] if recent else 0
+            p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'avg_ms': round(self.total_ms / self.requests, 1) if self.requests else 0,
+                'p50_ms': round(p50, 1),
+                'p95_ms': round(p95, 1),
+                'max_ms': round(self.max_ms, 1),
+                'status_counts': dict(self.status_counts)
+            }
+
+
+_metrics = {}
+
+
+def _get_session(host):
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            # Retries are handled in request() so they can honor Retry-After and be counted
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+            _metrics[host] = HostMetrics()
+        return session
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_seconds(attempt):
+    return HTTP_BACKOFF_SECONDS * (2 ** attempt)
+
+
+def request(method, url, timeout=None, retries=None, idempotent=None, **kwargs):
+    """
+    requests.request() over a pooled per-host session.
+
+    - timeout defaults to HTTP_TIMEOUT_SECONDS
+    - 429/5xx and connection errors are retried up to `retries` times with
+      exponential backoff, honoring Retry-After. Non-idempotent calls (POST)
+      are only retried on 429 unless idempotent=True is passed.
+    """
+    method = method.upper()
+    host = urlparse(url).netloc
+    session = _get_session(host)
+    metrics = _metrics[host]
+    timeout = HTTP_TIMEOUT_SECONDS if timeout is None else timeout
+    retries = HTTP_MAX_RETRIES if retries is None else retries
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            metrics.record((time.monotonic() - start) * 1000, retried=attempt > 0)
+            if not idempotent or attempt >= retries:
+                raise
+            time.sleep(_backoff_seconds(attempt))
+            attempt += 1
+            continue
+
+        metrics.record((time.monotonic() - start) * 1000, response.status_code, retried=attempt > 0)
+
+        retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+        if not retryable or attempt >= retries:
+            return response
+
+        wait = _retry_after_seconds(response)
+        if wait is None:
+            wait = _backoff_seconds(attempt)
+        wait = min(wait, HTTP_MAX_RETRY_WAIT_SECONDS)
+        print(f"[HTTP] {method} {host} -> {response.status_code}, retrying in {wait:.1f}s ({attempt + 1}/{retries})")
+        time.sleep(wait)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def get_metrics():
+    """Per-host latency/error counters since process start."""
+    return {host: m.snapshot() for host, m in list(_metrics.items())}
@@ -0,0 +1,236 @@
+import os
+import queue
+import threading
+from database import get_existing_phones, add_leads
+from whatsapp import format_number, check_whatsapp_exists_many
+
+# Staged lead ingestion shared by every search entry point
+# (server, scheduler auto-refill, main.py CLI, Streamlit search page):
+#
+#   source pages -> normalize -> dedupe + validate WhatsApp -> store
+#
+# Stages run concurrently and hand batches over bounded queues, so a search
+# page is validated while the next one downloads and the DB write of the
+# previous batch happens at the same time.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "50"))
+INGEST_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class IngestionStats:
+    """Counters for one ingestion run (plus the stored leads, in order)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.found = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.unchecked = 0
+        self.stored = 0
+        self.stored_valid = 0
+        self.stored_leads = []
+
+    def add(self, field, n=1):
+        # Stages run in different threads
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def as_dict(self):
+        return {
+            'found': self.found,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'unchecked': self.unchecked,
+            'stored': self.stored,
+            'stored_valid': self.stored_valid
+        }
+
+
+def chunked(leads, size=INGEST_BATCH_SIZE):
+    """Groups a flat iterable of leads into batches (lists)."""
+    batch = []
+    for lead in leads:
+        batch.append(lead)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _put(q, item, failed):
+    # Bounded put that gives up if another stage already failed
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, failed):
+    # Blocking get that ends the stage if another one already failed
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _normalize_stage(pages, out_q, stats, failed, errors):
+    """Cleans phones, drops leads without one and repeats within the run."""
+    seen = set()
+    try:
+        for page in pages:
+            batch = []
+            for lead in page:
+                stats.add('found')
+                if not lead.get('phone'):
+                    continue
+                lead['phone'] = format_number(lead['phone'])
+                if lead['phone'] in seen:
+                    stats.add('duplicates')
+                    continue
+                seen.add(lead['phone'])
+                batch.append(lead)
+            if batch and not _put(out_q, batch, failed):
+                return
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        # Stops a search generator that was abandoned halfway
+        if hasattr(pages, 'close'):
+            pages.close()
+        _put(out_q, _DONE, failed)
+
+
+def _validate_stage(in_q, out_q, stats, store_invalid, failed, errors):
+    """
+    Drops phones already in the DB (one batched lookup), validates the rest in
+    one WhatsApp call and canonicalizes valid phones to their JID number (which
+    can collide with an existing lead again, hence the second lookup).
+    """
+    seen_canonical = set()
+    try:
+        while True:
+            batch = _get(in_q, failed)
+            if batch is _DONE:
+                break
+
+            existing = get_existing_phones([l['phone'] for l in batch])
+            candidates = [l for l in batch if l['phone'] not in existing]
+            stats.add('duplicates', len(batch) - len(candidates))
+            if not candidates:
+                continue
+
+            jids = check_whatsapp_exists_many([l['phone'] for l in candidates])
+
+            ready = []
+            for lead in candidates:
+                if lead['phone'] not in jids:
+                    # WhatsApp check failed for its chunk: not stored (neither valid nor invalid)
+                    stats.add('unchecked')
+                    continue
+                jid = jids[lead['phone']]
+                if jid:
+                    # CRITICAL: Use the JID phone number as canonical to avoid duplicates
+                    # JID format: 554599998888@s.whatsapp.net
+                    lead['phone'] = jid.split('@')[0]
+                    lead['jid'] = jid
+                    if lead['phone'] in seen_canonical:
+                        stats.add('duplicates')
+                        continue
+                    seen_canonical.add(lead['phone'])
+                    ready.append(lead)
+                else:
+                    stats.add('invalid')
+                    if store_invalid:
+                        lead['jid'] = None
+                        ready.append(lead)
+
+            existing = get_existing_phones([l['phone'] for l in ready if l['jid']])
+            if existing:
+                print(f"[Ingestion] Duplicates found (canonical): {', '.join(sorted(existing))}")
+                stats.add('duplicates', sum(1 for l in ready if l['jid'] and l['phone'] in existing))
+                ready = [l for l in ready if not (l['jid'] and l['phone'] in existing)]
+
+            if ready and not _put(out_q, ready, failed):
+                return
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        _put(out_q, _DONE, failed)
+
+
+def ingest_pages(pages, store_invalid=False, classify=None, lead_defaults=None, on_batch=None):
+    """
+    Runs search results through the pipeline and stores the new leads.
+
+    - pages: iterable of lists of leads (e.g. search pages; see chunked())
+    - store_invalid: keep numbers without WhatsApp as 'invalid_number'
+    - classify(lead) -> status for valid leads (default 'new')
+    - lead_defaults: fields set on every stored lead (e.g. {'types': 'google_search'})
+    - on_batch(stored_leads, stats): called after each bulk insert, in the
+      caller's thread (safe for Streamlit widgets)
+
+    Stored leads carry a transient 'jid' key (None for invalid numbers).
+    Returns IngestionStats.
+    """
+    stats = IngestionStats()
+    normalized_q = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    validated_q = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    failed = threading.Event()
+    errors = []
+
+    stages = [
+        threading.Thread(target=_normalize_stage, args=(pages, normalized_q, stats, failed, errors), daemon=True),
+        threading.Thread(target=_validate_stage, args=(normalized_q, validated_q, stats, store_invalid, failed, errors), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # Store stage runs here so callbacks stay in the caller's thread
+    try:
+        while True:
+            batch = _get(validated_q, failed)
+            if batch is _DONE:
+                break
+
+            for lead in batch:
+                if lead_defaults:
+                    lead.update(lead_defaults)
+                if lead['jid']:
+                    lead['status'] = classify(lead) if classify else 'new'
+                else:
+                    lead['status'] = 'invalid_number'
+
+            stored = add_leads(batch)
+            stats.add('duplicates', len(batch) - len(stored))
+            stats.add('stored', len(stored))
+            stats.add('stored_valid', sum(1 for l in stored if l['jid']))
+            stats.stored_leads.extend(stored)
+
+            if on_batch:
+                on_batch(stored, stats)
+    except Exception:
+        failed.set()
+        raise
+    finally:
+        for stage in stages:
+            stage.join(timeout=5)
+
+    if errors:
+        raise errors[0]
+
+    print(f"[Ingestion] {stats.as_dict()}")
+    return stats
+
+
+def ingest_leads(leads, **kwargs):
+    """ingest_pages() for a flat iterable of leads."""
+    return ingest_pages(chunked(leads), **kwargs)
@@ -0,0 +1,85 @@
+import os
+import re
+import time
+from database import get_db_connection, register_schema, ensure_schema
+
+# phone -> WhatsApp JID resolutions from Evolution /chat/whatsappNumbers
+# Positive answers change rarely; negative ones are re-checked sooner
+JID_CACHE_TTL_SECONDS = int(os.getenv("JID_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+JID_CACHE_NEGATIVE_TTL_SECONDS = int(os.getenv("JID_CACHE_NEGATIVE_TTL_SECONDS", str(3 * 24 * 3600)))
+
+_SCHEMA = register_schema(
+    'jid_cache',
+    '''
+    CREATE TABLE IF NOT EXISTS jid_cache (
+        phone TEXT PRIMARY KEY,
+        jid TEXT,
+        checked_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_jid_cache_jid ON jid_cache(jid)',
+)
+
+
+def cache_key(phone):
+    return re.sub(r'\D', '', phone or '') or phone
+
+
+def get_many(phones):
+    """
+    Fresh cache entries for the given phones.
+    Returns {phone: jid or None}; phones missing from the dict are cache misses.
+    """
+    ensure_schema(_SCHEMA)
+    keys = {cache_key(p): p for p in phones if p}
+    if not keys:
+        return {}
+
+    placeholders = ','.join('?' * len(keys))
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT phone, jid FROM jid_cache
+        WHERE phone IN ({placeholders}) AND expires_at > ?
+    ''', (*keys.keys(), time.time())).fetchall()
+    conn.close()
+
+    return {keys[row['phone']]: row['jid'] for row in rows}
+
+
+def put_many(results):
+    """Stores {phone: jid or None} with the positive / negative TTL."""
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    rows = [
+        (cache_key(phone), jid, now, now + (JID_CACHE_TTL_SECONDS if jid else JID_CACHE_NEGATIVE_TTL_SECONDS))
+        for phone, jid in results.items() if phone
+    ]
+    if not rows:
+        return
+    conn = get_db_connection()
+    conn.executemany('''
+        INSERT INTO jid_cache (phone, jid, checked_at, expires_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(phone) DO UPDATE SET jid = excluded.jid, checked_at = excluded.checked_at, expires_at = excluded.expires_at
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+
+def invalidate(phone_or_jid):
+    """Drops every entry for a phone or JID (e.g. after a failed send)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    conn.execute('DELETE FROM jid_cache WHERE phone = ? OR jid = ?', (cache_key(phone_or_jid.split('@')[0]), phone_or_jid))
+    conn.commit()
+    conn.close()
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('DELETE FROM jid_cache WHERE expires_at <= ?', (time.time(),))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
@@ -0,0 +1,147 @@
+import os
+import time
+from database import get_db_connection, register_schema, ensure_schema
+
+# One row per OpenAI call made by agent.py (live, async bulk or batch):
+# prompt/completion tokens, the local prompt estimate, latency and which
+# lead / prompt version it was for. Cache hits make no call and aren't logged
+# (see generation_cache.get_stats()).
+# gpt-4o-mini list prices, USD per 1M tokens; the Batch API bills half
+LLM_PRICE_INPUT_PER_MTOK = float(os.getenv("LLM_PRICE_INPUT_PER_MTOK", "0.15"))
+LLM_PRICE_OUTPUT_PER_MTOK = float(os.getenv("LLM_PRICE_OUTPUT_PER_MTOK", "0.60"))
+BATCH_PRICE_FACTOR = 0.5
+LLM_USAGE_RETENTION_DAYS = int(os.getenv("LLM_USAGE_RETENTION_DAYS", "90"))
+
+# Cost of one row in SQL (batch rows at the discounted price)
+_COST_SQL = f'''
+    (COALESCE(prompt_tokens, 0) * {LLM_PRICE_INPUT_PER_MTOK} + COALESCE(completion_tokens, 0) * {LLM_PRICE_OUTPUT_PER_MTOK})
+    / 1000000.0 * (CASE WHEN source = 'batch' THEN {BATCH_PRICE_FACTOR} ELSE 1 END)
+'''
+
+_SCHEMA = register_schema(
+    'llm_usage',
+    '''
+    CREATE TABLE IF NOT EXISTS llm_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        function TEXT NOT NULL,
+        prompt_version TEXT,
+        lead_id INTEGER,
+        model TEXT NOT NULL,
+        source TEXT NOT NULL,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        estimated_prompt_tokens INTEGER,
+        latency_ms REAL,
+        error TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_llm_calls_created ON llm_calls(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_llm_calls_lead ON llm_calls(lead_id)',
+)
+
+
+def record(function, model, source, meta=None, usage=None, estimated_prompt_tokens=None, latency_ms=None, error=None):
+    """Logs one call. `usage` is the OpenAI usage object/dict (None on errors)."""
+    meta = meta or {}
+    try:
+        if usage is not None and not isinstance(usage, dict):
+            usage = {'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+                     'completion_tokens': getattr(usage, 'completion_tokens', None)}
+        usage = usage or {}
+        ensure_schema(_SCHEMA)
+        conn = get_db_connection()
+        conn.execute('''
+            INSERT INTO llm_calls (created_at, function, prompt_version, lead_id, model, source,
+                                   prompt_tokens, completion_tokens, estimated_prompt_tokens, latency_ms, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            time.time(), function, meta.get('prompt_version'), meta.get('lead_id'), model, source,
+            usage.get('prompt_tokens'), usage.get('completion_tokens'), estimated_prompt_tokens,
+            round(latency_ms, 1) if latency_ms is not None else None, str(error)[:500] if error else None
+        ))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        # Accounting must never break a generation
+        print(f"[LLM Usage] Could not record call: {e}")
+
+
+def _since(days):
+    return time.time() - days * 24 * 3600
+
+
+def cost_by_prompt_version(days=30):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT prompt_version, function, COUNT(*) AS calls,
+               ROUND(AVG(prompt_tokens), 1) AS avg_prompt_tokens,
+               ROUND(AVG(completion_tokens), 1) AS avg_completion_tokens,
+               ROUND(AVG(latency_ms), 1) AS avg_latency_ms,
+               ROUND(SUM({_COST_SQL}), 6) AS cost_usd
+        FROM llm_calls
+        WHERE created_at >= ? AND error IS NULL
+        GROUP BY prompt_version, function
+        ORDER BY cost_usd DESC
+    ''', (_since(days),)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def cost_by_lead(days=30, limit=50):
+    """Most expensive leads (with their total cost and call count)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT c.lead_id, l.name, l.phone, COUNT(*) AS calls,
+               SUM(COALESCE(c.prompt_tokens, 0) + COALESCE(c.completion_tokens, 0)) AS tokens,
+               ROUND(SUM({_COST_SQL}), 6) AS cost_usd
+        FROM llm_calls c LEFT JOIN leads l ON l.id = c.lead_id
+        WHERE c.created_at >= ? AND c.lead_id IS NOT NULL AND c.error IS NULL
+        GROUP BY c.lead_id
+        ORDER BY cost_usd DESC
+        LIMIT ?
+    ''', (_since(days), limit)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def get_report(days=30):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    totals = conn.execute(f'''
+        SELECT COUNT(*) AS calls,
+               COALESCE(SUM(error IS NOT NULL), 0) AS errors,
+               COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+               COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+               ROUND(AVG(latency_ms), 1) AS avg_latency_ms,
+               ROUND(COALESCE(SUM({_COST_SQL}), 0), 6) AS cost_usd,
+               COUNT(DISTINCT lead_id) AS leads
+        FROM llm_calls WHERE created_at >= ?
+    ''', (_since(days),)).fetchone()
+    conn.close()
+    report = dict(totals)
+    report['cost_per_lead_usd'] = round(report['cost_usd'] / report['leads'], 6) if report['leads'] else 0
+    report['by_prompt_version'] = cost_by_prompt_version(days)
+    report['top_leads'] = cost_by_lead(days, limit=10)
+    return report
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('DELETE FROM llm_calls WHERE created_at < ?', (_since(LLM_USAGE_RETENTION_DAYS),))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+if __name__ == "__main__":
+    report = get_report()
+    print("--- 💸 USO DA OPENAI (30 dias) ---")
+    print(f"Chamadas: {report['calls']} ({report['errors']} erros) | Tokens: {report['prompt_tokens']} prompt + {report['completion_tokens']} resposta")
+    print(f"Custo: US$ {report['cost_usd']:.4f} | Por lead: US$ {report['cost_per_lead_usd']:.5f} | Latência média: {report['avg_latency_ms']} ms")
+    for row in report['by_prompt_version']:
+        print(f"  {row['prompt_version'] or '-':<14} {row['function']:<30} {row['calls']:>5} chamadas  ~{row['avg_prompt_tokens']} tokens  US$ {row['cost_usd']:.4f}")
@@ -1,10 +1,9 @@
-import time
-import random
 import sys
-from database import init_db, add_lead, get_lead_by_phone, update_lead_status
-from search import search_leads
+from database import init_db, update_lead_status
+from search import iter_search_pages
+from ingestion import ingest_pages
 from agent import generate_message
-from whatsapp import format_number, check_whatsapp_exists, send_message
+from whatsapp import send_message
 
 from scraper import scrape_website
 
@@ -29,50 +28,33 @@ def main():
         num_pages = 1
         
     dry_run = input("Modo de teste (Dry Run)? (s/n) [s]: ").lower() != 'n'
+    personalize = input("Personalizar mensagens com IA? (s/n) [n]: ").lower() == 's'
     
     print(f"\nIniciando busca por '{query}' ({num_pages} páginas)...")
-    leads = search_leads(query, num_pages)
-    print(f"Encontrados {len(leads)} leads.")
+    # Dedupe, WhatsApp check and DB insert run as one pipeline while pages download
+    stats = ingest_pages(
+        (leads for _, leads in iter_search_pages(query, num_pages)),
+        store_invalid=True
+    )
+    print(f"Encontrados {stats.found} leads. {stats.duplicates} já estavam no banco, {stats.invalid} sem WhatsApp válido.")
     
+    leads = [l for l in stats.stored_leads if l['jid']]
     for i, lead in enumerate(leads):
         print(f"\n--- Processando {i+1}/{len(leads)}: {lead['name']} ---")
-        
-        # 1. Check DB
-        formatted_phone = format_number(lead['phone'])
-        existing_lead = get_lead_by_phone(formatted_phone)
-        
-        if existing_lead:
-            print(f"Lead já existe no banco (Status: {existing_lead['status']}). Pulando.")
-            continue
-            
-        # 2. Save to DB
-        lead['phone'] = formatted_phone
-        if add_lead(lead):
-            print("Salvo no banco de dados.")
-        else:
-            print("Erro ao salvar no banco.")
-            continue
-            
-        # 3. Check WhatsApp
-        print("Verificando WhatsApp...")
-        jid = check_whatsapp_exists(formatted_phone)
-        
-        if not jid:
-            print(f"Número {formatted_phone} não possui WhatsApp válido. Marcando como inválido.")
-            update_lead_status(formatted_phone, 'invalid_number')
-            continue
+        formatted_phone = lead['phone']
+        jid = lead['jid']
             
         print(f"WhatsApp encontrado: {jid}")
         
         # 4. Scrape Website (New)
         website_content = None
-        if lead.get('website'):
+        if personalize and lead.get('website'):
             print(f"Enriquecendo dados do site: {lead['website']}...")
             website_content = scrape_website(lead['website'])
         
         # 5. Generate Message
-        print("Gerando mensagem com IA...")
-        message = generate_message(lead, website_content)
+        print("Gerando mensagem com IA..." if personalize else "Gerando mensagem (template)...")
+        message = generate_message(lead, website_content, personalize=personalize)
         if not message:
             print("Falha ao gerar mensagem.")
             continue
@@ -91,11 +73,6 @@ def main():
                 update_lead_status(formatted_phone, 'contacted', message)
             else:
                 print("Erro ao enviar mensagem.")
-        
-        # 6. Wait to avoid spamming
-        delay = random.randint(10, 30)
-        print(f"Aguardando {delay} segundos...")
-        time.sleep(delay)
 
     print("\nProcesso finalizado!")
 
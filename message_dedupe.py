@@ -0,0 +1,91 @@
+import os
+import time
+from database import get_db_connection, register_schema, ensure_schema
+
+# Provider message IDs (Evolution key.id, Chatwoot message id) whose side effects
+# were already applied. Consulted by the webhooks and the Chatwoot -> Trello sync
+# so redeliveries and cross-path copies of one message become no-ops.
+# Only the path that stores the message in the DB marks it processed; the
+# Chatwoot -> Trello sync records its comments under the TRELLO_COMMENTED scope,
+# which only stops the webhook from commenting the same message again.
+MESSAGE_DEDUPE_RETENTION_DAYS = int(os.getenv("MESSAGE_DEDUPE_RETENTION_DAYS", "30"))
+TRELLO_COMMENTED = 'trello_commented'
+
+_SCHEMA = register_schema(
+    'message_dedupe',
+    '''
+    CREATE TABLE IF NOT EXISTS processed_messages (
+        provider_id TEXT PRIMARY KEY,
+        processed_at REAL NOT NULL
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_processed_messages_at ON processed_messages(processed_at)',
+)
+
+
+def provider_ids(evolution_id=None, chatwoot_id=None, source_id=None):
+    """
+    Every ID one message is known by. Chatwoot messages that came from the
+    WhatsApp (Evolution) inbox carry source_id 'WAID:<key.id>', which ties the
+    two webhook deliveries of the same message together.
+    """
+    ids = []
+    if evolution_id:
+        ids.append(f"evolution:{evolution_id}")
+    if chatwoot_id:
+        ids.append(f"chatwoot:{chatwoot_id}")
+    if isinstance(source_id, str) and source_id.startswith('WAID:'):
+        ids.append(f"evolution:{source_id[5:]}")
+    return list(dict.fromkeys(ids))
+
+
+def _scoped(ids, scope):
+    # Scoped markers live in the same table as '<scope>|<provider_id>'
+    return {f"{scope}|{i}" if scope else i: i for i in ids if i}
+
+
+def processed_among(ids, scope=None):
+    """Returns the subset of `ids` already processed (or marked under `scope`)."""
+    keys = _scoped(ids, scope)
+    if not keys:
+        return set()
+    ensure_schema(_SCHEMA)
+    placeholders = ','.join('?' * len(keys))
+    conn = get_db_connection()
+    rows = conn.execute(
+        f'SELECT provider_id FROM processed_messages WHERE provider_id IN ({placeholders})', tuple(keys)
+    ).fetchall()
+    conn.close()
+    return {keys[row['provider_id']] for row in rows}
+
+
+def is_processed(ids, scope=None):
+    return bool(processed_among(ids, scope))
+
+
+def mark_processed(ids, scope=None):
+    keys = list(_scoped(ids, scope))
+    if not keys:
+        return
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    conn = get_db_connection()
+    conn.executemany('''
+        INSERT INTO processed_messages (provider_id, processed_at) VALUES (?, ?)
+        ON CONFLICT(provider_id) DO UPDATE SET processed_at = excluded.processed_at
+    ''', [(k, now) for k in keys])
+    conn.commit()
+    conn.close()
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute(
+        'DELETE FROM processed_messages WHERE processed_at < ?',
+        (time.time() - MESSAGE_DEDUPE_RETENTION_DAYS * 24 * 3600,)
+    )
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
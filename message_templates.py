@@ -0,0 +1,97 @@
+import re
+from datetime import datetime
+from string import Formatter
+
+# Local renderer for first-contact messages: the A/B/C templates are
+# precompiled into (literal, slot) segments once, and rendering is just
+# filling the slots (greeting by time of day, recipient with name fallbacks).
+# No LLM call - agent.generate_message(personalize=True) is the opt-in LLM pass.
+
+# Opening bubble per version with slots; the other bubbles come verbatim
+# from agent.PROMPT_TEMPLATES.
+GREETING_BUBBLES = {
+    'A': "{saudacao}{destinatario}!",
+    'B': "Olá{destinatario}, ótima semana!",
+    'C': "E aí, tudo bem?",
+    'A_ES': "¡{saudacao}{destinatario}!",
+    'B_ES': "¡Hola{destinatario}, excelente semana!",
+    'C_ES': "¿Qué tal, todo bien?",
+}
+
+GREETINGS = {
+    'pt': ("Bom dia", "Boa tarde", "Boa noite"),
+    'es': ("Buenos días", "Buenas tardes", "Buenas noches"),
+}
+
+RECIPIENT_PREFIX = {
+    'pt': ", equipe ",
+    'es': ", equipo ",
+}
+
+SLOTS = {'saudacao', 'destinatario'}
+
+# Company names from Google Maps carry suffixes like "Ltda" or " - Foz do Iguaçu"
+MAX_RECIPIENT_CHARS = 30
+_NAME_SEPARATORS = re.compile(r'\s+[-|–—:]\s+|\s*[(\[]')
+_LEGAL_SUFFIXES = re.compile(r'\b(ltda|eireli|epp|s\.?a\.?|s\.?r\.?l\.?)\.?$', re.IGNORECASE)
+
+
+def compile_template(text):
+    """Template string -> tuple of (literal, slot or None) segments."""
+    segments = []
+    for literal, field, _, _ in Formatter().parse(text):
+        if field is not None and field not in SLOTS:
+            raise ValueError(f"Unknown slot '{field}' in template: {text}")
+        segments.append((literal, field))
+    return tuple(segments)
+
+
+def compile_templates(prompt_templates):
+    """{version: [compiled bubble, ...]} from agent.PROMPT_TEMPLATES."""
+    compiled = {}
+    for version, bubbles in prompt_templates.items():
+        greeting = GREETING_BUBBLES.get(version, bubbles[0])
+        compiled[version] = [compile_template(greeting)] + [
+            # Literal bubbles: escape braces so they can't be read as slots
+            compile_template(b.replace('{', '{{').replace('}', '}}')) for b in bubbles[1:]
+        ]
+    return compiled
+
+
+def greeting(language='pt', now=None):
+    hour = (now or datetime.now()).hour
+    morning, afternoon, evening = GREETINGS.get(language, GREETINGS['pt'])
+    if 5 <= hour < 12:
+        return morning
+    if 12 <= hour < 18:
+        return afternoon
+    return evening
+
+
+def recipient_name(lead):
+    """
+    Short name to address the lead by, or '' when there's nothing usable:
+    contact name if known, else the company name without location/legal suffixes.
+    """
+    for key in ('contact_name', 'name'):
+        name = (lead.get(key) or '').strip()
+        if not name or re.fullmatch(r'[\d\s()+-]+', name):
+            continue
+        name = _NAME_SEPARATORS.split(name)[0].strip()
+        name = _LEGAL_SUFFIXES.sub('', name).strip(' .,-')
+        if name and len(name) <= MAX_RECIPIENT_CHARS:
+            return name
+    return ''
+
+
+def render(compiled_bubbles, lead, language='pt', now=None):
+    """Fills the slots of one compiled version. Returns the list of bubbles."""
+    name = recipient_name(lead)
+    slots = {
+        'saudacao': greeting(language, now),
+        'destinatario': f"{RECIPIENT_PREFIX.get(language, RECIPIENT_PREFIX['pt'])}{name}" if name else '',
+    }
+    return [
+        ''.join(literal + (slots[field] if field else '') for literal, field in bubble)
+        for bubble in compiled_bubbles
+    ]
@@ -0,0 +1,98 @@
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Local token counting and history trimming for agent.py prompts, so a long
+# Chatwoot/DB history can't make every follow-up prompt bigger (and slower).
+# The history gets at most PROMPT_HISTORY_TOKEN_BUDGET tokens and never more
+# than what's left of PROMPT_MAX_TOKENS after the fixed parts (system prompt,
+# instructions).
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+PROMPT_HISTORY_TOKEN_BUDGET = int(os.getenv("PROMPT_HISTORY_TOKEN_BUDGET", "1200"))
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    # tiktoken is optional (and may need to download its BPE file once)
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base") # gpt-4o family
+        except Exception as e:
+            print(f"[Prompt] tiktoken unavailable, using estimate: {e}")
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Tokens in `text`: exact with tiktoken, otherwise ~1 token per 4 chars of each word + 1 per symbol."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum((len(t) + 3) // 4 if t[0].isalnum() or t[0] == '_' else 1 for t in _TOKEN_RE.findall(text))
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m.get('content')) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def trim_history(text, budget, head_lines=0):
+    """
+    Keeps the most recent lines of a history that fit in `budget` tokens
+    (plus up to `head_lines` opening lines, e.g. where people introduce
+    themselves), replacing the omitted middle with a one-line marker.
+    A single newest line that's too big on its own is cut from the start.
+    """
+    if not text or count_tokens(text) <= budget:
+        return text
+    if budget <= 0:
+        return ''
+
+    lines = text.split('\n')
+    used = count_tokens("[... 9999 linhas anteriores omitidas ...]") + 1
+
+    head = []
+    for line in lines[:head_lines]:
+        cost = count_tokens(line) + 1
+        if used + cost > budget // 2:
+            break
+        head.append(line)
+        used += cost
+
+    tail = []
+    for line in reversed(lines[len(head):]):
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        tail.append(line)
+        used += cost
+
+    if not tail:
+        # ~4 chars per token; shrink until it fits
+        newest = lines[-1]
+        chars = max(1, budget * 4)
+        while chars > 1 and count_tokens(newest[-chars:]) + 1 > budget:
+            chars = chars * 3 // 4
+        return '…' + newest[-chars:]
+
+    omitted = len(lines) - len(head) - len(tail)
+    return '\n'.join(head + [f"[... {omitted} linhas anteriores omitidas ...]"] + tail[::-1])
+
+
+def fit_history(history, fixed_tokens, budget=None, max_total=None, head_lines=0):
+    """History trimmed to the history budget and to what the fixed prompt parts left of the total."""
+    budget = PROMPT_HISTORY_TOKEN_BUDGET if budget is None else budget
+    available = (max_total or PROMPT_MAX_TOKENS) - fixed_tokens
+    return trim_history(history, max(0, min(budget, available)), head_lines)
@@ -0,0 +1,115 @@
+import os
+import time
+from database import get_db_connection, register_schema, ensure_schema
+
+# Outbound WhatsApp ceilings (shared by server, scheduler, followup and dashboard processes)
+# Instance bucket: overall messages per minute for one Evolution instance
+WA_INSTANCE_RATE_PER_MIN = float(os.getenv("WA_INSTANCE_RATE_PER_MIN", "12"))
+WA_INSTANCE_BURST = float(os.getenv("WA_INSTANCE_BURST", "3"))
+# Recipient bucket: spacing between bubbles sent to the same number
+WA_RECIPIENT_INTERVAL_SECONDS = float(os.getenv("WA_RECIPIENT_INTERVAL_SECONDS", "6"))
+WA_RECIPIENT_BURST = float(os.getenv("WA_RECIPIENT_BURST", "1"))
+
+_SCHEMA = register_schema(
+    'rate_limiter',
+    '''
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+)
+
+
+def _try_take(buckets):
+    """
+    One atomic attempt over several buckets: takes a token from all of them or
+    from none. `buckets` is a list of (key, rate_per_second, capacity).
+    Returns 0 on success, otherwise the seconds to wait before retrying.
+    """
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        if not conn.in_transaction:
+            # Write lock up front: concurrent processes serialize on the bucket rows
+            conn.execute("BEGIN IMMEDIATE")
+
+        levels = []
+        for key, rate, capacity in buckets:
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            if row:
+                tokens = min(capacity, row['tokens'] + max(0.0, now - row['updated_at']) * rate)
+            else:
+                tokens = capacity
+            levels.append(tokens)
+
+        wait = 0.0
+        for (key, rate, capacity), tokens in zip(buckets, levels):
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+
+        taken = 1 if wait == 0 else 0
+        for (key, rate, capacity), tokens in zip(buckets, levels):
+            conn.execute('''
+                INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+            ''', (key, tokens - taken, now))
+        conn.commit()
+        return wait
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def acquire(buckets, timeout=None):
+    """
+    Blocks until a token is available in every bucket, then takes it.
+    Returns the total seconds waited, or None if `timeout` ran out first.
+    """
+    ensure_schema(_SCHEMA)
+    waited = 0.0
+    while True:
+        wait = _try_take(buckets)
+        if wait == 0:
+            return waited
+        if timeout is not None and waited + wait > timeout:
+            return None
+        time.sleep(wait)
+        waited += wait
+
+
+def whatsapp_buckets(instance, number):
+    return [
+        (f"wa:instance:{instance}", WA_INSTANCE_RATE_PER_MIN / 60.0, WA_INSTANCE_BURST),
+        (f"wa:recipient:{instance}:{number}", 1.0 / WA_RECIPIENT_INTERVAL_SECONDS, WA_RECIPIENT_BURST),
+    ]
+
+
+def purge_expired(idle_seconds=3600):
+    """
+    Deletes recipient buckets that refilled completely and sat idle: a missing
+    row already means a full bucket, so nothing changes for the next send.
+    """
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        DELETE FROM rate_buckets
+        WHERE key LIKE 'wa:recipient:%' AND updated_at < ?
+        AND tokens + (? - updated_at) * ? >= ?
+    ''', (now - idle_seconds, now, 1.0 / WA_RECIPIENT_INTERVAL_SECONDS, WA_RECIPIENT_BURST))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+def wait_for_whatsapp_send(instance, number, timeout=None):
+    """Waits for the instance and recipient budgets before one WhatsApp send."""
+    waited = acquire(whatsapp_buckets(instance, number), timeout=timeout)
+    if waited:
+        print(f"[RateLimit] Waited {waited:.1f}s before sending to {number}")
+    return waited
@@ -1,11 +1,118 @@
-import os
-import sys
-import time
+import asyncio
 from datetime import datetime
-import chatwoot_api
-from database import get_db_connection, add_lead, update_lead_status, get_lead_by_phone, init_db
+import chatwoot_async
+from database import init_db, add_messages, upsert_leads
 
-def restore_leads():
+
+def chatwoot_messages_to_rows(messages, contact_name):
+    """Maps Chatwoot message payloads to rows for database.add_messages()."""
+    rows = []
+    for msg in messages or []:
+        content = msg.get('content')
+        msg_type = msg.get('message_type')
+        if not content or msg_type == 2: # 2 = activity (status changes, assignments)
+            continue
+
+        if msg_type == 0:
+            body = f"📩 Cliente ({contact_name}):\n\n{content}"
+        else:
+            body = f"🗣️ Chatwoot Agent:\n\n{content}"
+
+        created_at = msg.get('created_at')
+        rows.append({
+            'body': body,
+            'direction': 'in' if msg_type == 0 else 'out',
+            'source': 'chatwoot',
+            'channel': 'chatwoot',
+            'created_at': datetime.fromtimestamp(created_at) if isinstance(created_at, int) else None,
+            'external_id': f"chatwoot:{msg['id']}" if msg.get('id') else None
+        })
+    return rows
+
+def _conversation_contact(conv):
+    sender = conv.get('meta', {}).get('sender', {})
+    return sender, sender.get('phone_number')
+
+
+# Existing leads only take the Chatwoot status/last activity; their other fields stay
+RESTORE_MERGE = {'status': 'replace', 'last_contact_date': 'replace'}
+
+
+def _conversation_lead(conv, messages):
+    """Lead row (with status and last_contact_date) for one Chatwoot conversation."""
+    sender, phone = _conversation_contact(conv)
+    name = sender.get('name', 'Cliente Ex-Chatwoot')
+
+    # Determine Status - STRICT MODE
+    # Last message determines status
+    status = 'contacted' # Default
+    if messages and len(messages) > 0:
+        # Assuming messages are sorted chronological (last is newest)
+        last_msg = messages[-1]
+        if last_msg.get('message_type') == 0: # 0 = Incoming (Client)
+            status = 'responded'
+        else:
+            status = 'contacted'
+
+    # Last Activity Date
+    last_activity = conv.get('last_activity_at')
+    if last_activity:
+        last_date = datetime.fromtimestamp(last_activity)
+    else:
+        last_date = datetime.now()
+
+    return {
+        'name': name,
+        'phone': phone.replace('+', '').replace(' ', '').replace('-', ''),
+        'address': str(sender.get('location', '')),
+        'website': '', 
+        'rating': 0,
+        'reviews': 0,
+        'types': 'chatwoot_import',
+        'search_term': 'Importado do Histórico',
+        'language': 'pt',
+        'status': status,
+        'last_contact_date': last_date
+    }
+
+
+def _restore_page(conversations, histories):
+    """
+    Applies one page of Chatwoot conversations (with their already fetched
+    histories) to the local DB: every lead in one upsert, then the messages.
+    Returns how many leads were imported (new).
+    """
+    # We process ALL leads (New or Existing) to ensure status is synced
+    leads = []
+    for conv in conversations:
+        try:
+            sender, _ = _conversation_contact(conv)
+            lead = _conversation_lead(conv, histories.get(sender.get('id')))
+            lead['_messages'] = histories.get(sender.get('id'))
+            leads.append(lead)
+        except Exception as e:
+            print(f"❌ [Restore] Error processing item: {e}")
+
+    inserted, updated = upsert_leads(leads, merge=RESTORE_MERGE)
+    for lead in updated:
+        print(f"🔄 [Sync] Updated {lead['name']} ({lead['phone']}) -> {lead['status']}")
+    for lead in inserted:
+        print(f"✅ [Restore] Imported {lead['name']} ({lead['phone']}) as {lead['status']}")
+
+    for lead in leads:
+        try:
+            add_messages(lead['phone'], chatwoot_messages_to_rows(lead['_messages'], lead['name']))
+        except Exception as e:
+            print(f"❌ [Restore] Error storing messages of {lead['phone']}: {e}")
+    return len(inserted)
+
+
+async def restore_leads_async():
+    """
+    Full import from Chatwoot. Histories of a page are fetched concurrently
+    (bounded by CHATWOOT_CONCURRENCY) while the next page is already being listed;
+    each page is written with one lead upsert.
+    """
     print("🔄 [Restore] Starting Full Import from Chatwoot...")
     
     # Ensure DB exists
@@ -14,104 +121,35 @@ def restore_leads():
     page = 1
     total_restored = 0
     total_skipped = 0
+
+    print(f"🔄 [Restore] Fetching page {page}...")
+    next_page = asyncio.ensure_future(chatwoot_async.list_conversations(page=page, sort_by='last_activity_at'))
     
     while True:
-        print(f"🔄 [Restore] Fetching page {page}...")
-        conversations = chatwoot_api.list_conversations(page=page, sort_by='last_activity_at')
+        conversations = await next_page
         
         if not conversations:
             print("✅ [Restore] No more conversations found.")
             break
+
+        print(f"🔄 [Restore] Fetching page {page + 1}...")
+        next_page = asyncio.ensure_future(chatwoot_async.list_conversations(page=page + 1, sort_by='last_activity_at'))
+
+        with_phone = [conv for conv in conversations if _conversation_contact(conv)[1]]
+        histories = await chatwoot_async.get_histories(
+            [_conversation_contact(conv)[0].get('id') for conv in with_phone]
+        )
+        total_skipped += len(conversations) - len(with_phone)
             
-        for conv in conversations:
-            try:
-                # Extract Lead Info
-                meta = conv.get('meta', {})
-                sender = meta.get('sender', {})
-                phone = sender.get('phone_number')
-                name = sender.get('name', 'Cliente Ex-Chatwoot')
-                
-                if not phone:
-                    continue
-                    
-                # Check if exists locally
-                cleaned_phone = phone.replace('+', '').replace(' ', '').replace('-', '')
-                
-                # We process ALL leads (New or Existing) to ensure status is synced
-                existing = get_lead_by_phone(cleaned_phone)
-                
-                # Fetch History text (Needed for status check)
-                messages = chatwoot_api.get_conversation_history(sender.get('id'))
-                history_text = chatwoot_api.format_history_for_llm(messages)
-                    
-                # Determine Status - STRICT MODE
-                # Last message determines status
-                status = 'contacted' # Default
-                if messages and len(messages) > 0:
-                    # Assuming messages are sorted chronological (last is newest)
-                    last_msg = messages[-1]
-                    if last_msg.get('message_type') == 0: # 0 = Incoming (Client)
-                        status = 'responded'
-                    else:
-                        status = 'contacted'
-                        
-                # Last Activity Date
-                last_activity = conv.get('last_activity_at')
-                if last_activity:
-                    last_date = datetime.fromtimestamp(last_activity)
-                else:
-                    last_date = datetime.now()
-
-                if existing:
-                    # UPDATE existing lead
-                    conn = get_db_connection()
-                    c = conn.cursor()
-                    c.execute('''
-                        UPDATE leads 
-                        SET status = ?, last_contact_date = ?, conversation_history = ?
-                        WHERE phone = ?
-                    ''', (status, last_date, history_text, cleaned_phone))
-                    conn.commit()
-                    conn.close()
-                    print(f"🔄 [Sync] Updated {name} ({cleaned_phone}) -> {status}")
-                    
-                else:
-                    # INSERT new lead
-                    lead = {
-                        'name': name,
-                        'phone': cleaned_phone,
-                        'address': str(sender.get('location', '')),
-                        'website': '', 
-                        'rating': 0,
-                        'reviews': 0,
-                        'types': 'chatwoot_import',
-                        'search_term': 'Importado do Histórico',
-                        'language': 'pt'
-                    }
-                    
-                    if add_lead(lead):
-                         # Update status immediately after add
-                         conn = get_db_connection()
-                         c = conn.cursor()
-                         c.execute('''
-                            UPDATE leads 
-                            SET status = ?, last_contact_date = ?, conversation_history = ?
-                            WHERE phone = ?
-                        ''', (status, last_date, history_text, cleaned_phone))
-                         conn.commit()
-                         conn.close()
-                         print(f"✅ [Restore] Imported {name} ({cleaned_phone}) as {status}")
-                         total_restored += 1
-                    else:
-                         print(f"❌ [Restore] Failed to add {cleaned_phone}")
-                    
-            except Exception as e:
-                print(f"❌ [Restore] Error processing item: {e}")
+        total_restored += _restore_page(with_phone, histories)
                 
         page += 1
-        time.sleep(1) # Rate limit safety
         
     print(f"\n🎉 [Restore Complete] Imported: {total_restored} | Skipped: {total_skipped}")
 
+
+def restore_leads():
+    asyncio.run(restore_leads_async())
+
 if __name__ == "__main__":
     restore_leads()
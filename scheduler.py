@@ -1,15 +1,35 @@
 import schedule
+import os
 import time
 import random
 import datetime
-from database import get_db_connection, add_lead, update_lead_status, get_lead_by_phone, update_lead_prompt_version
-from search import search_leads
-from scraper import scrape_website
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import get_db_connection, update_lead_status, get_lead_by_phone, update_lead_prompt_version, claim_next_lead, extend_lead_lease, reap_stale_leases
+from search import fetch_local_results, results_to_leads
+from ingestion import ingest_pages
+from scraper import scrape_website, start_prefetcher
 from agent import generate_message
 from followup import process_followups
-from whatsapp import check_whatsapp_exists, send_message, format_number
+from whatsapp import check_whatsapp_exists, send_message
+import whatsapp
+import jid_cache
+import message_dedupe
+import rate_limiter
+import serp_cache
+import enrichment_store
+import generation_cache
+import llm_usage
+import batch_generation
+import search_planner
 
 # Configuration
+# Worker-pool mode: N leads processed in parallel, each with its own pacing.
+# SCHEDULER_WORKERS=1 keeps the classic "one lead every 30 minutes" loop.
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "1"))
+# Global budget of new leads started per hour, per WhatsApp instance
+LEADS_PER_HOUR = float(os.getenv("LEADS_PER_HOUR", "2"))
+
 SEARCH_CITIES = [
     "Foz do Iguaçu, Brasil",
     "Ciudad del Este, Paraguai", 
@@ -57,7 +77,19 @@ def is_within_business_hours():
     
     return is_window1 or is_window2
 
+_refill_lock = threading.Lock()
+
 def auto_refill_leads():
+    # Several workers can find the queue empty at once - only one searches
+    if not _refill_lock.acquire(blocking=False):
+        print("[Auto-Refill] Already running. Skipping.")
+        return
+    try:
+        _auto_refill_leads()
+    finally:
+        _refill_lock.release()
+
+def _auto_refill_leads():
     conn = get_db_connection()
     count = conn.execute("SELECT COUNT(*) FROM leads WHERE status = 'new'").fetchone()[0]
     conn.close()
@@ -66,48 +98,136 @@ def auto_refill_leads():
     
     if count < 5:
         print("[Auto-Refill] Low inventory. Searching for more leads...")
-        sector = random.choice(SEARCH_SECTORS)
-        city = random.choice(SEARCH_CITIES)
+        # Highest expected yield of new leads, based on past searches
+        planned = search_planner.next_search(SEARCH_SECTORS, SEARCH_CITIES)
+        if not planned:
+            print("[Auto-Refill] Every sector/city is backing off. Skipping.")
+            return
+        sector, city, page = planned['sector'], planned['city'], planned['page']
         query = f"{sector} em {city}"
         
-        print(f"[Auto-Refill] Searching: '{query}'")
+        print(f"[Auto-Refill] Searching: '{query}' (page {page + 1}, expected ~{planned['expected']} new)")
         try:
-            leads = search_leads(query, num_pages=1)
+            local_results = fetch_local_results(query, page * search_planner.PAGE_SIZE)
+            if local_results is None:
+                print("[Auto-Refill] Search failed. Will retry next run.")
+                return
+            leads = results_to_leads(local_results, query)
             
-            added_count = 0
-            for lead in leads:
-                # Clean phone
-                lead['phone'] = format_number(lead['phone'])
-                
-                conn = get_db_connection()
-                exists = conn.execute("SELECT 1 FROM leads WHERE phone = ?", (lead['phone'],)).fetchone()
-                conn.close()
-                
-                if not exists:
-                    # Validate WhatsApp immediately
-                    jid = check_whatsapp_exists(lead['phone'])
-                    if jid:
-                        # Check Chatwoot before adding as 'new'
-                        import chatwoot_api
-                        cw_contact = chatwoot_api.get_contact_by_phone(lead['phone'])
-                        
-                        if cw_contact:
-                            print(f"[Auto-Refill] Found in Chatwoot: {lead['phone']} ({cw_contact.get('name')}). Importing as 'contacted'.")
-                            lead['status'] = 'contacted'
-                        else:
-                            lead['status'] = 'new'
-                        
-                        if add_lead(lead):
-                            added_count += 1
-                    else:
-                        print(f"      Skipping invalid number: {lead['phone']}")
-                        
+            def classify(lead):
+                # Check Chatwoot before adding as 'new'
+                import chatwoot_api
+                cw_contact = chatwoot_api.get_contact_by_phone(lead['phone'])
+                if cw_contact:
+                    print(f"[Auto-Refill] Found in Chatwoot: {lead['phone']} ({cw_contact.get('name')}). Importing as 'contacted'.")
+                    return 'contacted'
+                return 'new'
+            
+            # Dedupe + WhatsApp validation (batched) + one bulk insert
+            stats = ingest_pages([leads], classify=classify)
+            added_count = stats.stored
+            if stats.invalid:
+                print(f"      Skipped {stats.invalid} invalid numbers.")
+                    
             print(f"[Auto-Refill] Added {added_count} leads.")
+            search_planner.record_result(sector, city, page, len(local_results), added_count)
             
         except Exception as e:
             print(f"[Auto-Refill] Error searching: {e}")
 
 
+class SendBudget:
+    """
+    Spaces lead starts for one WhatsApp instance: at most `per_hour` starts per
+    hour (thread-safe). Carries over at most one missed slot so the dispatcher
+    tick doesn't eat into the rate.
+    """
+
+    def __init__(self, per_hour):
+        self.interval = 3600.0 / per_hour if per_hour > 0 else float('inf')
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_at:
+                return False
+            self._next_at = max(self._next_at, now - self.interval) + self.interval
+            return True
+
+
+_send_budgets = {}
+_outbound_pool = None
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def get_send_budget(instance):
+    if instance not in _send_budgets:
+        _send_budgets[instance] = SendBudget(LEADS_PER_HOUR)
+    return _send_budgets[instance]
+
+
+def _run_lead_worker():
+    try:
+        process_one_lead()
+    except Exception as e:
+        print(f"[Worker] ❌ Unhandled error: {e}")
+
+
+def dispatch_outbound():
+    """
+    Worker-pool mode: starts as many process_one_lead() runs as the free
+    workers and the instance send budget allow. Returns immediately so the
+    scheduler loop (heartbeat, other jobs) keeps running.
+    """
+    global _outbound_pool
+    if not is_within_business_hours():
+        return
+
+    if _outbound_pool is None:
+        _outbound_pool = ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS, thread_name_prefix="lead-worker")
+
+    budget = get_send_budget(whatsapp.INSTANCE)
+    with _in_flight_lock:
+        done = {f for f in _in_flight if f.done()}
+        _in_flight.difference_update(done)
+        free = SCHEDULER_WORKERS - len(_in_flight)
+
+        started = 0
+        while free > 0 and budget.try_acquire():
+            _in_flight.add(_outbound_pool.submit(_run_lead_worker))
+            free -= 1
+            started += 1
+
+    if started:
+        print(f"[Dispatcher] Started {started} lead worker(s) ({len(_in_flight)}/{SCHEDULER_WORKERS} busy, instance {whatsapp.INSTANCE}).")
+
+
+def reap_stuck_leads():
+    released = reap_stale_leases()
+    if released:
+        print(f"[Queue] Released {released} leads stuck in 'processing' (expired lease).")
+
+
+def run_batch_generation():
+    # Outside business hours: pre-generate tomorrow's follow-ups / re-engagements (OpenAI Batch API)
+    try:
+        batch_generation.run(is_within_business_hours())
+    except Exception as e:
+        print(f"[Batch] Error: {e}")
+
+
+def run_followups():
+    # Sent only inside the windows; off-hours run_batch_generation pre-generates
+    # them, so the in-window run reads the batch results from generation_cache
+    if not is_within_business_hours():
+        print("[Follow-up] Outside business hours. Skipping.")
+        return
+    process_followups(dry_run=False)
+
+
 def update_heartbeat():
     try:
         # Write current timestamp to heartbeat file
@@ -144,39 +264,15 @@ def process_one_lead():
     # =========================================================================
     # PASSO 1: SELECIONAR LEAD COM LOCK ATÔMICO
     # =========================================================================
-    conn = get_db_connection()
+    # Claim atômico (UPDATE ... RETURNING) de um lead 'new' aleatório, com lease.
+    # Os que já têm a retomada pré-gerada no lote da noite vão primeiro (sem chamada à OpenAI)
+    lead = claim_next_lead(prefer_ids=batch_generation.ready_reengagement_lead_ids())
     
-    # Seleciona um lead 'new' aleatório
-    lead_row = conn.execute("""
-        SELECT * FROM leads 
-        WHERE status = 'new' 
-        ORDER BY RANDOM() 
-        LIMIT 1
-    """).fetchone()
-    
-    if not lead_row:
-        conn.close()
+    if not lead:
         print("[Job] No new leads available.")
         auto_refill_leads()
         return
     
-    lead = dict(lead_row)
-    lead_id = lead['id']
-    
-    # Lock atômico - marca como 'processing' imediatamente
-    cursor = conn.execute("""
-        UPDATE leads 
-        SET status = 'processing'
-        WHERE id = ? AND status = 'new'
-    """, (lead_id,))
-    conn.commit()
-    
-    if cursor.rowcount == 0:
-        conn.close()
-        print(f"[Job] Lead {lead_id} já foi pego por outro processo. Tentando próximo...")
-        return process_one_lead()
-    
-    conn.close()
     print(f"[Job] 🔒 Lead locked: {lead['name']} ({lead['phone']})")
     
     # =========================================================================
@@ -202,7 +298,11 @@ def process_one_lead():
         print(f"         Data: {recent['last_contact_date']}")
         
         conn = get_db_connection()
-        conn.execute("UPDATE leads SET status = 'duplicate' WHERE id = ?", (lead['id'],))
+        # Sai da fila: libera o lease também (sem mexer em last_contact_date, não houve contato)
+        conn.execute(
+            "UPDATE leads SET status = 'duplicate', lease_expires_at = NULL, claimed_by = NULL WHERE id = ?",
+            (lead['id'],)
+        )
         conn.commit()
         conn.close()
         return
@@ -289,12 +389,14 @@ def process_one_lead():
     # PASSO 4: PREPARAR MENSAGEM
     # =========================================================================
     try:
-        # Scrape website se disponível
+        # Conteúdo do site se disponível
+        # (só do cache: o prefetcher já buscou o site enquanto o lead esperava na fila)
         website_content = None
         if lead.get('website'):
-            print(f"      🌐 Scraping {lead['website']}...")
             try:
-                website_content = scrape_website(lead['website'])
+                website_content = scrape_website(lead['website'], cached_only=True)
+                if website_content is None:
+                    print(f"      🌐 Site ainda não disponível no cache: {lead['website']}")
             except Exception as scrape_err:
                 print(f"      ⚠️ Scrape falhou: {scrape_err}")
         
@@ -310,20 +412,13 @@ def process_one_lead():
             chosen_version = "CONTEXTUAL"
             
         else:
-            # Sem histórico - usa templates A/B/C
+            # Sem histórico - usa templates A/B/C (renderizados localmente, sem LLM)
             chosen_version = random.choice(['A', 'B', 'C'])
             language = lead.get('language', 'pt')
             
-            if language == 'es':
-                final_version = f"{chosen_version}_ES"
-            else:
-                final_version = chosen_version
-            
-            from agent import PROMPT_TEMPLATES
-            message_parts = PROMPT_TEMPLATES.get(
-                final_version, 
-                PROMPT_TEMPLATES.get(chosen_version, PROMPT_TEMPLATES['A'])
-            )
+            from agent import resolve_version, render_message_parts
+            final_version = resolve_version(chosen_version, language)
+            message_parts = render_message_parts(lead, chosen_version)
             
             print(f"      📝 Usando template {final_version}")
         
@@ -356,14 +451,12 @@ def process_one_lead():
                 
             preview = part[:50] + "..." if len(part) > 50 else part
             print(f"         Parte {i+1}/{len(message_parts)}: {preview}")
+            # Renova o lease a cada parte: esperas do rate limiter podem passar de
+            # LEAD_LEASE_SECONDS e o reaper devolveria o lead para outro worker
+            extend_lead_lease(lead['id'])
+            # Espaçamento entre partes vem do rate limiter (bucket por destinatário)
             send_message(jid, part)
             full_message_log.append(part)
-            
-            # Delay entre partes (exceto última)
-            if i < len(message_parts) - 1:
-                delay = random.randint(5, 10)
-                print(f"         ⏱️ Aguardando {delay}s...")
-                time.sleep(delay)
         
         # =====================================================================
         # PASSO 6: ATUALIZAR STATUS
@@ -373,7 +466,10 @@ def process_one_lead():
         update_lead_status(
             lead['phone'], 
             'contacted', 
-            f"🤖 Ivair (v{chosen_version}):\n\n{full_message}"
+            f"🤖 Ivair (v{chosen_version}):\n\n{full_message}",
+            direction='out',
+            source='agent',
+            channel='whatsapp'
         )
         update_lead_prompt_version(lead['phone'], chosen_version)
         
@@ -406,7 +502,10 @@ if __name__ == "__main__":
     sys.stdout.reconfigure(line_buffering=True)
     
     print("=== Auto-Scheduler Started ===")
-    print("Schedule: Mon-Fri | 09:00-11:40 & 14:00-17:20 | Every 30 mins")
+    if SCHEDULER_WORKERS > 1:
+        print(f"Schedule: Mon-Fri | 09:00-11:40 & 14:00-17:20 | {SCHEDULER_WORKERS} workers, {LEADS_PER_HOUR:g} leads/hour")
+    else:
+        print("Schedule: Mon-Fri | 09:00-11:40 & 14:00-17:20 | Every 30 mins")
     print("Version: 2.0 (Anti-Duplicata)")
     
     try:
@@ -423,19 +522,39 @@ if __name__ == "__main__":
                 trello_crm.create_list("Conexão")
                 trello_crm.create_list("A Prospectar")
                 trello_crm.create_list("Arquivados")  # Para leads que recusaram
+                # Warm the local card index (shared through the DB with server/dashboard)
+                trello_crm.refresh_card_index()
+                schedule.every(1).minutes.do(trello_crm.refresh_card_index)
         except Exception as e:
             print(f"Warning: Could not init Trello lists: {e}")
 
         # Run once at startup
+        reap_stuck_leads()
         auto_refill_leads()
-        
-        print("[Job] Executing immediate start-up run...")
-        process_one_lead()
+
+        # Websites of the 'new' queue are scraped in the background, ahead of the send
+        start_prefetcher()
         
         # Schedule
-        schedule.every(30).minutes.do(process_one_lead)
+        if SCHEDULER_WORKERS > 1:
+            print("[Job] Starting worker pool dispatcher...")
+            dispatch_outbound()
+            schedule.every(1).minutes.do(dispatch_outbound)
+        else:
+            print("[Job] Executing immediate start-up run...")
+            process_one_lead()
+            schedule.every(30).minutes.do(process_one_lead)
         schedule.every(1).hours.do(auto_refill_leads)
-        schedule.every(4).hours.do(process_followups, dry_run=False)
+        schedule.every(10).minutes.do(reap_stuck_leads)
+        schedule.every(1).days.do(jid_cache.purge_expired)
+        schedule.every(1).days.do(message_dedupe.purge_expired)
+        schedule.every(1).days.do(rate_limiter.purge_expired)
+        schedule.every(1).days.do(serp_cache.purge_expired)
+        schedule.every(1).days.do(enrichment_store.purge_expired)
+        schedule.every(1).days.do(generation_cache.purge_expired)
+        schedule.every(1).days.do(llm_usage.purge_expired)
+        schedule.every(4).hours.do(run_followups)
+        schedule.every(30).minutes.do(run_batch_generation)
 
         # Chatwoot <-> Trello Sync
         from sync_chatwoot_trello import run_sync
@@ -1,28 +1,143 @@
-import requests
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+import enrichment_store
+from database import get_db_connection
 
-def scrape_website(url):
-    if not url:
-        return None
-        
-    # Ensure URL has protocol
-    if not url.startswith('http'):
-        url = 'https://' + url
-        
+# Background prefetch of the websites of leads waiting in the 'new' queue
+ENRICHMENT_PREFETCH_INTERVAL_SECONDS = int(os.getenv("ENRICHMENT_PREFETCH_INTERVAL_SECONDS", "120"))
+ENRICHMENT_PREFETCH_BATCH = int(os.getenv("ENRICHMENT_PREFETCH_BATCH", "20"))
+ENRICHMENT_PREFETCH_WORKERS = int(os.getenv("ENRICHMENT_PREFETCH_WORKERS", "4"))
+# Rows of the 'new' queue read per prefetch run; the cursor carries the walk over to the next run
+PREFETCH_SCAN_ROWS = 2000
+# Lead id the last prefetch stopped at; the next run resumes after it
+_prefetch_cursor = 0
+
+# Basic cleanup: limit length to avoid token limits
+# GPT-4o-mini has a large context window, but let's keep it reasonable (e.g., 5000 chars)
+MAX_CONTENT_CHARS = 5000
+
+
+def _clean(text):
+    text = re.sub(r'[ \t]+\n', '\n', text or '')
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    return text[:MAX_CONTENT_CHARS]
+
+
+def fetch_website(url):
+    """Fetches a site through r.jina.ai (no cache). Returns (content or None, http_status)."""
     jina_url = f"https://r.jina.ai/{url}"
-    
+
     try:
         print(f"Scraping website: {url}...")
-        response = requests.get(jina_url, timeout=15)
-        
+        response = http_client.get(jina_url, timeout=15, retries=1)
+
         if response.status_code == 200:
-            content = response.text
-            # Basic cleanup: limit length to avoid token limits
-            # GPT-4o-mini has a large context window, but let's keep it reasonable (e.g., 5000 chars)
-            return content[:5000]
+            return _clean(response.text), response.status_code
         else:
             print(f"Failed to scrape {url}: Status {response.status_code}")
-            return None
-            
+            return None, response.status_code
+
     except Exception as e:
         print(f"Error scraping {url}: {e}")
+        return None, None
+
+
+def scrape_website(url, cached_only=False):
+    """
+    Website content for a lead, served from the enrichment store when fresh
+    (a cached failure returns None without retrying). On a miss it's fetched
+    and stored - unless cached_only, which never blocks on the network.
+    """
+    url = enrichment_store.normalize_url(url)
+    if not url:
         return None
+
+    entry = enrichment_store.get(url)
+    if entry:
+        return entry['content'] if entry['status'] == enrichment_store.STATUS_OK else None
+    if cached_only:
+        return None
+
+    content, http_status = fetch_website(url)
+    enrichment_store.put(url, content, http_status)
+    return content
+
+
+def prefetch_new_leads(limit=None, workers=None):
+    """
+    Fetches the sites of up to `limit` 'new' leads that have no fresh entry yet.
+    Leads are claimed in random order, so the queue is walked in keyset pages
+    by id, resuming where the previous run stopped and wrapping around at the
+    end. Each run reads at most PREFETCH_SCAN_ROWS rows (never more than one lap).
+    Returns {'fetched': n, 'failed': n}.
+    """
+    global _prefetch_cursor
+    limit = limit or ENRICHMENT_PREFETCH_BATCH
+    urls = []
+    start_id = last_id = _prefetch_cursor
+    wrapped = False
+    scanned = 0
+    conn = get_db_connection()
+    while len(urls) < limit and scanned < PREFETCH_SCAN_ROWS:
+        rows = conn.execute('''
+            SELECT id, website FROM leads
+            WHERE status = 'new' AND id > ? AND website IS NOT NULL AND website != ''
+            ORDER BY id ASC
+            LIMIT 500
+        ''', (last_id,)).fetchall()
+        if wrapped:
+            rows = [row for row in rows if row['id'] <= start_id]
+        if not rows:
+            if wrapped or not start_id:
+                break
+            wrapped, last_id = True, 0
+            continue
+        scanned += len(rows)
+        missing = set(enrichment_store.missing(row['website'] for row in rows))
+        for row in rows:
+            last_id = row['id']
+            url = enrichment_store.normalize_url(row['website'])
+            if url in missing and url not in urls:
+                urls.append(url)
+                if len(urls) >= limit:
+                    break
+        if wrapped and last_id >= start_id:
+            break
+    conn.close()
+    _prefetch_cursor = last_id
+
+    if not urls:
+        return {'fetched': 0, 'failed': 0}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers or ENRICHMENT_PREFETCH_WORKERS)) as pool:
+        results = list(pool.map(fetch_website, urls))
+    for url, (content, http_status) in zip(urls, results):
+        enrichment_store.put(url, content, http_status)
+
+    failed = sum(1 for content, _ in results if content is None)
+    print(f"[Enrichment] Prefetched {len(urls) - failed} sites ({failed} failed).")
+    return {'fetched': len(urls) - failed, 'failed': failed}
+
+
+def start_prefetcher(interval=None):
+    """Daemon thread that keeps the 'new' queue's websites in the store."""
+    interval = interval or ENRICHMENT_PREFETCH_INTERVAL_SECONDS
+
+    def loop():
+        while True:
+            try:
+                result = prefetch_new_leads()
+            except Exception as e:
+                print(f"[Enrichment] Prefetch error: {e}")
+                result = None
+            # A full batch means there's a backlog: go again right away
+            if not result or result['fetched'] + result['failed'] < ENRICHMENT_PREFETCH_BATCH:
+                time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='enrichment-prefetch', daemon=True)
+    thread.start()
+    return thread
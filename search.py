@@ -1,59 +1,150 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from serpapi import GoogleSearch
 from dotenv import load_dotenv
+import serp_cache
 
 load_dotenv()
 
 SERPAPI_KEY = os.getenv("SERPAPI_KEY")
+# Pages of one query fetched in parallel by iter_search_pages()
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "3"))
+PAGE_SIZE = 20
 
-def search_leads(query, num_pages=1):
-    all_leads = []
-    
-    for page in range(num_pages):
-        start = page * 20
-        print(f"Searching page {page + 1} (start={start})...")
-        
-        params = {
-            "engine": "google_maps",
-            "q": query,
-            "api_key": SERPAPI_KEY,
-            "start": start,
-            "type": "search"
+# SerpAPI answers a query past its last page with this error instead of an empty list
+NO_RESULTS_ERROR = "hasn't returned any results"
+
+
+def fetch_local_results(query, start, use_cache=True):
+    """
+    Raw local_results of one google_maps page, served from serp_cache when fresh.
+    Returns None on an API error (not cached, so it's retried next time).
+    """
+    if use_cache:
+        cached = serp_cache.get(query, start)
+        if cached is not None:
+            print(f"[SerpAPI] Cache hit: '{query}' (start={start})")
+            return cached
+
+    params = {
+        "engine": "google_maps",
+        "q": query,
+        "api_key": SERPAPI_KEY,
+        "start": start,
+        "type": "search"
+    }
+
+    search = GoogleSearch(params)
+    results = search.get_dict()
+    error = results.get("error")
+    if error and NO_RESULTS_ERROR not in error:
+        print(f"[SerpAPI] Error for '{query}' (start={start}): {error}")
+        return None
+
+    local_results = results.get("local_results", [])
+    serp_cache.put(query, start, local_results)
+    return local_results
+
+
+def results_to_leads(local_results, query):
+    leads = []
+    for result in local_results:
+        lead = {
+            "name": result.get("title"),
+            "phone": result.get("phone"),
+            "address": result.get("address"),
+            "website": result.get("website"),
+            "rating": result.get("rating"),
+            "reviews": result.get("reviews"),
+            "types": ", ".join(result.get("types", [])) if result.get("types") else "",
+            "search_term": query # specific sector/term used for this search
         }
+        # Only add if phone number exists
+        if lead["phone"]:
+            # Basic Language Detection
+            # +55 = PT (Brazil)
+            # +595 = ES (Paraguay)
+            # +54 = ES (Argentina)
+            p = lead["phone"]
+            if "+55" in p or p.startswith("55"):
+                lead['language'] = 'pt'
+            elif "+595" in p or p.startswith("595") or "+54" in p or p.startswith("54"):
+                lead['language'] = 'es'
+            else:
+                lead['language'] = 'pt' # Default to PT if unknown/local without area
+
+            leads.append(lead)
+    return leads
+
+
+def iter_search_pages(query, num_pages=1, max_workers=None, use_cache=True):
+    """
+    Yields (page, leads) as each page arrives, fetching up to `max_workers`
+    pages at once. Pages come in completion order, not page order.
+    Page 0 goes alone; after that page N + max_workers is only requested once
+    pages 0..N came back full, so a query that ends early doesn't pay for a
+    window of pages past its end. A short or empty page marks the end of the
+    results: later pages are not requested (or are dropped if already in flight).
+    """
+    max_workers = max(1, max_workers or SEARCH_CONCURRENCY)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    next_page = 0
+    end_page = num_pages # exclusive; shrinks when a short/empty page shows up
+    full_pages = set()
+    frontier = 0 # pages 0..frontier-1 all came back full
 
-        search = GoogleSearch(params)
-        results = search.get_dict()
-        local_results = results.get("local_results", [])
-
-        if not local_results:
-            print("No more results found.")
-            break
-
-        for result in local_results:
-            lead = {
-                "name": result.get("title"),
-                "phone": result.get("phone"),
-                "address": result.get("address"),
-                "website": result.get("website"),
-                "rating": result.get("rating"),
-                "reviews": result.get("reviews"),
-                "types": ", ".join(result.get("types", [])) if result.get("types") else "",
-                "search_term": query # specific sector/term used for this search
-            }
-            # Only add if phone number exists
-            if lead["phone"]:
-                # Basic Language Detection
-                # +55 = PT (Brazil)
-                # +595 = ES (Paraguay)
-                # +54 = ES (Argentina)
-                p = lead["phone"]
-                if "+55" in p or p.startswith("55"):
-                    lead['language'] = 'pt'
-                elif "+595" in p or p.startswith("595") or "+54" in p or p.startswith("54"):
-                    lead['language'] = 'es'
+    def stop_after(last):
+        nonlocal end_page
+        end_page = last
+        for other, other_page in list(pending.items()):
+            if other_page >= end_page:
+                other.cancel()
+
+    try:
+        while pending or next_page < end_page:
+            window_end = frontier + max_workers if frontier else 1
+            while next_page < min(end_page, window_end) and len(pending) < max_workers:
+                start = next_page * PAGE_SIZE
+                print(f"Searching page {next_page + 1} (start={start})...")
+                pending[pool.submit(fetch_local_results, query, start, use_cache)] = next_page
+                next_page += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = pending.pop(future)
+                if page >= end_page:
+                    continue
+                try:
+                    local_results = future.result()
+                except Exception as e:
+                    print(f"[SerpAPI] Page {page + 1} failed: {e}")
+                    local_results = None
+
+                if not local_results:
+                    print(f"No more results found (page {page + 1}).")
+                    stop_after(page)
+                    continue
+
+                if len(local_results) < PAGE_SIZE:
+                    # Last page: whatever comes after it would be empty
+                    stop_after(page + 1)
                 else:
-                    lead['language'] = 'pt' # Default to PT if unknown/local without area
-                    
-                all_leads.append(lead)
-        
-    return all_leads
+                    full_pages.add(page)
+                    while frontier in full_pages:
+                        frontier += 1
+
+                yield page, results_to_leads(local_results, query)
+    finally:
+        # Consumer stopped early (or we're done): drop what hasn't started
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_search_leads(query, num_pages=1, max_workers=None, use_cache=True):
+    """Same as iter_search_pages(), one lead at a time."""
+    for _, leads in iter_search_pages(query, num_pages, max_workers, use_cache):
+        yield from leads
+
+
+def search_leads(query, num_pages=1, use_cache=True):
+    return list(iter_search_leads(query, num_pages, use_cache=use_cache))
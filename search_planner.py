@@ -0,0 +1,135 @@
+import os
+import random
+from datetime import datetime, timedelta
+from database import get_db_connection, register_schema, ensure_schema
+
+# Chooses the next auto-refill search (sector, city, page) by expected new-lead
+# yield, using what every previous search of that combination returned.
+PAGE_SIZE = 20
+# Expected yield of a combination that was never searched (keeps exploring)
+PLANNER_PRIOR_NEW_LEADS = float(os.getenv("PLANNER_PRIOR_NEW_LEADS", "8"))
+# A deeper page is expected to yield this fraction of the page before it
+PLANNER_DEPTH_DECAY = 0.8
+# Searched pages are revisited (new businesses show up) after this interval,
+# doubled for every consecutive search that added nothing
+PLANNER_REVISIT_DAYS = int(os.getenv("PLANNER_REVISIT_DAYS", "14"))
+PLANNER_MAX_BACKOFF_DAYS = 120
+PLANNER_REVISIT_WEIGHT = 0.25
+
+_SCHEMA = register_schema(
+    'search_planner',
+    '''
+    CREATE TABLE IF NOT EXISTS search_coverage (
+        sector TEXT NOT NULL,
+        city TEXT NOT NULL,
+        page INTEGER NOT NULL,
+        runs INTEGER NOT NULL DEFAULT 0,
+        last_results INTEGER NOT NULL DEFAULT 0,
+        last_new_leads INTEGER NOT NULL DEFAULT 0,
+        total_new_leads INTEGER NOT NULL DEFAULT 0,
+        zero_streak INTEGER NOT NULL DEFAULT 0,
+        last_run_at TIMESTAMP,
+        next_eligible_at TIMESTAMP,
+        PRIMARY KEY (sector, city, page)
+    )
+    ''',
+)
+
+
+def _load_coverage():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    rows = conn.execute('SELECT * FROM search_coverage').fetchall()
+    conn.close()
+
+    coverage = {}
+    for row in rows:
+        coverage.setdefault((row['sector'], row['city']), {})[row['page']] = dict(row)
+    return coverage
+
+
+def _eligible(row, now):
+    next_at = row['next_eligible_at']
+    if next_at is None:
+        return True
+    if isinstance(next_at, str):
+        next_at = datetime.fromisoformat(next_at)
+    return now >= next_at
+
+
+def _candidates(pages, now):
+    """(expected_new_leads, page) options for one sector x city."""
+    if not pages:
+        return [(PLANNER_PRIOR_NEW_LEADS, 0)]
+
+    options = []
+    # Go one page deeper while the last page was full (there are more results)
+    deepest = max(pages)
+    last = pages[deepest]
+    if last['last_results'] >= PAGE_SIZE:
+        options.append((max(last['last_new_leads'], 1) * PLANNER_DEPTH_DECAY, deepest + 1))
+
+    # Revisit pages whose backoff has expired
+    for page, row in pages.items():
+        if _eligible(row, now):
+            options.append((row['last_new_leads'] * PLANNER_REVISIT_WEIGHT + 0.5, page))
+    return options
+
+
+def plan_searches(sectors, cities, limit=5):
+    """Best next searches as dicts (sector, city, page, expected), highest yield first."""
+    coverage = _load_coverage()
+    now = datetime.now()
+
+    options = []
+    for sector in sectors:
+        for city in cities:
+            for expected, page in _candidates(coverage.get((sector, city)), now):
+                # random() only breaks ties (e.g. between never-searched combos)
+                options.append((expected, random.random(), sector, city, page))
+
+    options.sort(reverse=True)
+    return [
+        {'sector': sector, 'city': city, 'page': page, 'expected': round(expected, 2)}
+        for expected, _, sector, city, page in options[:limit]
+    ]
+
+
+def next_search(sectors, cities):
+    plan = plan_searches(sectors, cities, limit=1)
+    return plan[0] if plan else None
+
+
+def record_result(sector, city, page, results, new_leads):
+    """Stores how many results a search page returned and how many became new leads."""
+    ensure_schema(_SCHEMA)
+    now = datetime.now()
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT zero_streak FROM search_coverage WHERE sector = ? AND city = ? AND page = ?',
+        (sector, city, page)
+    ).fetchone()
+    zero_streak = 0 if new_leads else (row['zero_streak'] if row else 0) + 1
+    backoff_days = min(PLANNER_REVISIT_DAYS * (2 ** zero_streak), PLANNER_MAX_BACKOFF_DAYS)
+
+    conn.execute('''
+        INSERT INTO search_coverage (sector, city, page, runs, last_results, last_new_leads, total_new_leads, zero_streak, last_run_at, next_eligible_at)
+        VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(sector, city, page) DO UPDATE SET
+            runs = runs + 1,
+            last_results = excluded.last_results,
+            last_new_leads = excluded.last_new_leads,
+            total_new_leads = total_new_leads + excluded.last_new_leads,
+            zero_streak = excluded.zero_streak,
+            last_run_at = excluded.last_run_at,
+            next_eligible_at = excluded.next_eligible_at
+    ''', (sector, city, page, results, new_leads, new_leads, zero_streak, now, now + timedelta(days=backoff_days)))
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    from scheduler import SEARCH_SECTORS, SEARCH_CITIES
+    print("--- 🧭 PRÓXIMAS BUSCAS PLANEJADAS ---")
+    for item in plan_searches(SEARCH_SECTORS, SEARCH_CITIES, limit=10):
+        print(f"  {item['expected']:>5}  {item['sector']} em {item['city']} (página {item['page'] + 1})")
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import zlib
+from datetime import date
+from database import get_db_connection, register_schema, ensure_schema
+
+# Raw SerpAPI google_maps pages (local_results) keyed by (query, start).
+# Refills keep hitting the same sector x city queries; a fresh-enough page is
+# reused instead of paying for the same search again.
+SERP_CACHE_TTL_SECONDS = int(os.getenv("SERP_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_SCHEMA = register_schema(
+    'serp_cache',
+    '''
+    CREATE TABLE IF NOT EXISTS serp_cache (
+        query_key TEXT NOT NULL,
+        start INTEGER NOT NULL,
+        payload BLOB NOT NULL,
+        result_count INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (query_key, start)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_serp_cache_expires ON serp_cache(expires_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS serp_cache_stats (
+        day TEXT PRIMARY KEY,
+        hits INTEGER NOT NULL DEFAULT 0,
+        misses INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+)
+
+
+def query_key(query):
+    return ' '.join((query or '').lower().split())
+
+
+def _count(conn, column):
+    conn.execute(f'''
+        INSERT INTO serp_cache_stats (day, {column}) VALUES (?, 1)
+        ON CONFLICT(day) DO UPDATE SET {column} = {column} + 1
+    ''', (date.today().isoformat(),))
+
+
+def get(query, start):
+    """Cached local_results list for a page, or None on a miss / expired entry."""
+    ensure_schema(_SCHEMA)
+    key = query_key(query)
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT payload FROM serp_cache WHERE query_key = ? AND start = ? AND expires_at > ?',
+        (key, start, time.time())
+    ).fetchone()
+    if row:
+        conn.execute('UPDATE serp_cache SET hits = hits + 1 WHERE query_key = ? AND start = ?', (key, start))
+        _count(conn, 'hits')
+    else:
+        _count(conn, 'misses')
+    conn.commit()
+    conn.close()
+    return json.loads(zlib.decompress(row['payload'])) if row else None
+
+
+def put(query, start, local_results, ttl=None):
+    """Stores a page (an empty list is cached too: it marks the end of the results)."""
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    payload = zlib.compress(json.dumps(local_results, ensure_ascii=False).encode('utf-8'))
+    conn = get_db_connection()
+    conn.execute('''
+        INSERT INTO serp_cache (query_key, start, payload, result_count, fetched_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(query_key, start) DO UPDATE SET
+            payload = excluded.payload, result_count = excluded.result_count,
+            fetched_at = excluded.fetched_at, expires_at = excluded.expires_at, hits = 0
+    ''', (query_key(query), start, payload, len(local_results), now, now + (ttl or SERP_CACHE_TTL_SECONDS)))
+    conn.commit()
+    conn.close()
+
+
+def purge_expired():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('DELETE FROM serp_cache WHERE expires_at <= ?', (time.time(),))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+def get_report(days=30):
+    """Hit/miss counters (last `days` days) plus what's currently stored."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    daily = [dict(row) for row in conn.execute(
+        'SELECT day, hits, misses FROM serp_cache_stats ORDER BY day DESC LIMIT ?', (days,)
+    ).fetchall()]
+    stored = conn.execute('''
+        SELECT COUNT(*) AS pages,
+               COALESCE(SUM(expires_at > ?), 0) AS fresh_pages,
+               COALESCE(SUM(LENGTH(payload)), 0) AS bytes
+        FROM serp_cache
+    ''', (time.time(),)).fetchone()
+    conn.close()
+
+    hits = sum(d['hits'] for d in daily)
+    misses = sum(d['misses'] for d in daily)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0,
+        'pages': stored['pages'],
+        'fresh_pages': stored['fresh_pages'],
+        'bytes': stored['bytes'],
+        'daily': daily
+    }
+
+
+if __name__ == "__main__":
+    report = get_report()
+    print("--- 📦 CACHE SERPAPI ---")
+    print(f"Hits: {report['hits']} | Misses (buscas pagas): {report['misses']} | Hit rate: {report['hit_rate']:.0%}")
+    print(f"Páginas guardadas: {report['pages']} ({report['fresh_pages']} válidas, {report['bytes'] / 1024:.0f} KB comprimidos)")
+    for d in report['daily']:
+        print(f"  {d['day']}: {d['hits']} hits / {d['misses']} misses")
@@ -1,11 +1,17 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
-from database import update_lead_status, get_lead_by_phone, add_lead, get_dashboard_stats, get_hot_leads, get_recent_activity, get_all_leads, get_analytics_data
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for
+from database import update_lead_status, get_lead_by_phone, add_lead, get_dashboard_stats, get_hot_leads, get_recent_activity, get_all_leads, get_analytics_data, get_messages, get_recent_messages_for_leads, get_active_chats
 import os
+import time
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
-from search import search_leads
-from whatsapp import check_whatsapp_exists, format_number, send_message
+from search import iter_search_pages
+from ingestion import ingest_pages
+from whatsapp import check_whatsapp_exists, check_whatsapp_exists_many, send_message
 from agent import generate_message
+from scraper import scrape_website
+import webhook_queue
+import message_dedupe
 
 SEARCH_LOGS = []
 
@@ -13,47 +19,19 @@ def run_search_background(query, num_pages):
     global SEARCH_LOGS
     SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"Iniciando busca por: {query} ({num_pages} pgs)..."})
     
+    def pages():
+        # Pages are fetched in parallel; each one enters the pipeline as soon as it arrives
+        for page, leads in iter_search_pages(query, int(num_pages)):
+            SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"Página {page + 1}: {len(leads)} resultados brutos. Validando WhatsApp..."})
+            yield leads
+
+    def log_new(stored, stats):
+        for lead in stored:
+            SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"LEAD NOVO: {lead['name']} ({lead['phone']})"})
+
     try:
-        leads = search_leads(query, int(num_pages))
-        SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"Encontrados {len(leads)} resultados brutos. Validando WhatsApp..."})
-        
-        new_count = 0
-        for i, lead in enumerate(leads):
-            # Clean and Check
-            raw_phone = lead['phone']
-            if not raw_phone: continue
-            
-            clean_phone = format_number(raw_phone)
-            lead['phone'] = clean_phone
-            
-            # Check DB existance
-            existing = get_lead_by_phone(clean_phone)
-            if existing:
-                continue
-                
-            # Check WhatsApp
-            jid = check_whatsapp_exists(clean_phone)
-            if jid:
-                # CRITICAL: Use the JID phone number as canonical to avoid duplicates
-                # JID format: 554599998888@s.whatsapp.net
-                canonical_phone = jid.split('@')[0]
-                
-                # Check DB existence AGAIN with canonical phone
-                if get_lead_by_phone(canonical_phone):
-                    print(f"Duplicate found (canonical): {canonical_phone}")
-                    continue
-
-                lead['phone'] = canonical_phone
-                lead['status'] = 'new'
-                lead['types'] = 'google_search' # Tag source
-                if add_lead(lead):
-                    new_count += 1
-                    SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"LEAD NOVO: {lead['name']} ({canonical_phone})"})
-            else:
-                 # Optional: add as invalid? For now just skip logging to keep noise down
-                 pass
-                 
-        SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"Busca finalizada! {new_count} novos leads adicionados."})
+        stats = ingest_pages(pages(), lead_defaults={'types': 'google_search'}, on_batch=log_new) # Tag source
+        SEARCH_LOGS.insert(0, {'time': datetime.now().strftime('%H:%M:%S'), 'msg': f"Busca finalizada! {stats.stored} novos leads adicionados."})
         
     except Exception as e:
         print(f"Search Error: {e}")
@@ -102,6 +80,32 @@ def manual_restore():
     
     return jsonify({"status": "started", "message": "Restoration started in background. Check logs."})
 
+@app.route('/api/http_metrics')
+def http_metrics():
+    import http_client
+    return jsonify(http_client.get_metrics())
+
+@app.route('/api/serp_cache')
+def serp_cache_report():
+    import serp_cache
+    return jsonify(serp_cache.get_report())
+
+@app.route('/api/enrichment')
+def enrichment_report():
+    import enrichment_store
+    return jsonify(enrichment_store.get_stats())
+
+@app.route('/api/llm_cache')
+def llm_cache_report():
+    import generation_cache
+    return jsonify(generation_cache.get_stats())
+
+@app.route('/api/llm_usage')
+def llm_usage_report():
+    import llm_usage
+    days = request.args.get('days', 30, type=int)
+    return jsonify(llm_usage.get_report(days))
+
 # --- UI ROUTES ---
 
 @app.route('/')
@@ -111,11 +115,12 @@ def dashboard():
     system_status = check_scheduler_status()
     
     # Process Hot Leads for Template
+    last_messages = get_recent_messages_for_leads([l['id'] for l in hot_leads], per_lead=1)
     processed_leads = []
     for lead in hot_leads:
         # Extract last message
-        history = lead['conversation_history'] or ""
-        last_msg = history.split('\n')[-1] if history else "Sem histórico"
+        msgs = last_messages.get(lead['id'])
+        last_msg = msgs[-1]['body'] if msgs else "Sem histórico"
         if len(last_msg) > 100: last_msg = last_msg[:100] + "..."
         
         # Format time (naive)
@@ -181,103 +186,159 @@ def dashboard():
                            timeline_events=timeline,
                            system_status=system_status)
 
+# --- FEED ---
+# Trello links for feed rows: batch-resolved from the local card index, cached briefly.
+# A page never waits more than FEED_LINK_TIMEOUT_SECONDS for them; rows fall back to a
+# Trello search link and the lookup keeps warming the cache in the background.
+FEED_LINK_CACHE_SECONDS = int(os.getenv("FEED_LINK_CACHE_SECONDS", "60"))
+FEED_LINK_TIMEOUT_SECONDS = float(os.getenv("FEED_LINK_TIMEOUT_SECONDS", "0.5"))
+FEED_MAX_LIMIT = 50
+
+_trello_link_cache = {} # phone -> (expires_at, card url or None)
+_trello_link_lock = threading.Lock()
+_trello_link_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def _lookup_trello_links(phones):
+    import trello_crm
+    cards = trello_crm.find_cards_by_phones(phones)
+    links = {}
+    for phone in phones:
+        card = cards.get(phone)
+        links[phone] = (card.get('shortUrl') or card.get('url')) if card else None
+
+    expires_at = time.time() + FEED_LINK_CACHE_SECONDS
+    with _trello_link_lock:
+        if len(_trello_link_cache) > 5000:
+            now = time.time()
+            for key in [k for k, (exp, _) in _trello_link_cache.items() if exp <= now]:
+                del _trello_link_cache[key]
+        for phone, link in links.items():
+            _trello_link_cache[phone] = (expires_at, link)
+    return links
+
+
+def _start_trello_link_lookup(phones):
+    """Returns (cached links, future resolving the misses or None)."""
+    now = time.time()
+    links, misses = {}, []
+    with _trello_link_lock:
+        for phone in dict.fromkeys(phones):
+            cached = _trello_link_cache.get(phone)
+            if cached and cached[0] > now:
+                links[phone] = cached[1]
+            else:
+                misses.append(phone)
+    future = _trello_link_executor.submit(_lookup_trello_links, misses) if misses else None
+    return links, future
+
+
+def _render_feed_item(lead, trello_link, trello_style, lead_messages):
+    # Prepare data
+    status = lead['status']
+    icon = "⚪"
+    desc = "Interação detectada"
+    
+    if status == 'new': icon, desc = ("✨", "Novo Lead detectado")
+    elif status == 'contacted': icon, desc = ("🤖", "Robô enviou mensagem")
+    elif status == 'responded': icon, desc = ("📩", "Cliente respondeu")
+    elif 'follow_up' in status: icon, desc = ("⏰", f"Follow-up ({status})")
+    elif status == 'closed_deal': icon, desc = ("💰", "Venda Fechada!")
+    elif status == 'invalid_number': icon, desc = ("🚫", "Número Inválido")
+    
+    phone_display = lead['phone'] or "N/A"
+    time_display = str(lead['last_contact_date'])[11:16] if lead['last_contact_date'] else "--:--"
+
+    chatwoot_link = os.getenv("CHATWOOT_URL", "#")
+    
+    prompt_badge = ""
+    if lead.get('prompt_version'):
+        prompt_badge = f'<span class="px-2 py-0.5 rounded text-[10px] font-bold bg-[#283539] text-gray-400 border border-gray-700">📝 Prompt {lead["prompt_version"]}</span>'
+
+    # Message Preview
+    msg_preview = ""
+    if lead_messages:
+         # Basic escaping for HTML safety would be good here, but for now assuming internal safe data
+        history = "\n".join(m['body'] for m in lead_messages if m['body'])
+        esc_history = history.replace("<", "&lt;").replace(">", "&gt;")
+        msg_preview = f"""
+        <details class="group mt-2">
+            <summary class="list-none cursor-pointer text-xs text-blue-400 hover:text-blue-300 flex items-center gap-1 select-none">
+                <span class="material-symbols-outlined text-[14px] transition-transform group-open:rotate-180">expand_more</span>
+                Ver mensagem enviada
+            </summary>
+            <div class="mt-2 text-xs text-gray-400 bg-[#111618] p-3 rounded border border-[#283539] whitespace-pre-wrap">{esc_history}</div>
+        </details>
+        """
+
+    return f"""
+    <div class="relative pl-8 pb-8 border-l border-[#283539] last:border-0 last:pb-0">
+        <div class="absolute -left-[13px] top-0 w-6 h-6 rounded-full bg-[#161b1d] border border-[#283539] flex items-center justify-center text-sm shadow-sm">
+            {icon}
+        </div>
+        <div class="flex flex-col gap-1">
+            <div class="flex items-center gap-2">
+                <span class="text-xs font-mono text-text-secondary">{time_display}</span>
+                <span class="text-sm font-bold text-white">{lead['name']}</span>
+            </div>
+            <div class="text-sm text-gray-300">
+                {desc} <span class="text-gray-500 text-xs">📞 {phone_display}</span>
+            </div>
+            
+            <div class="flex flex-wrap items-center gap-3 mt-1">
+                 <a href="{trello_link}" target="_blank" class="flex items-center gap-1 text-[11px] text-[#0079bf] bg-[#0079bf]/10 px-2 py-0.5 rounded {trello_style}">
+                    📋 Trello
+                </a>
+                <a href="{chatwoot_link}" target="_blank" class="flex items-center gap-1 text-[11px] text-[#9966CC] hover:underline bg-[#9966CC]/10 px-2 py-0.5 rounded hover:bg-[#9966CC]/20 transition-colors">
+                    🟣 Chatwoot
+                </a>
+                {prompt_badge}
+            </div>
+            {msg_preview}
+        </div>
+    </div>
+    """
+
 @app.route('/api/feed')
 def get_feed_html():
     offset = int(request.args.get('offset', 0))
-    limit = int(request.args.get('limit', 10))
+    limit = min(int(request.args.get('limit', 10)), FEED_MAX_LIMIT)
     
     activities = get_recent_activity(limit=limit, offset=offset)
-    
-    # Pre-fetch Trello cards to speed up or just do it in loop (slow but simpler for now)
-    import trello_crm
-    
-    html_output = ""
-    for lead in activities:
-        # Prepare data
-        status = lead['status']
-        icon = "⚪"
-        desc = "Interação detectada"
-        
-        if status == 'new': icon, desc = ("✨", "Novo Lead detectado")
-        elif status == 'contacted': icon, desc = ("🤖", "Robô enviou mensagem")
-        elif status == 'responded': icon, desc = ("📩", "Cliente respondeu")
-        elif 'follow_up' in status: icon, desc = ("⏰", f"Follow-up ({status})")
-        elif status == 'closed_deal': icon, desc = ("💰", "Venda Fechada!")
-        elif status == 'invalid_number': icon, desc = ("🚫", "Número Inválido")
-        
-        phone_display = lead['phone'] or "N/A"
-        time_display = str(lead['last_contact_date'])[11:16] if lead['last_contact_date'] else "--:--"
-        
-        # Links - Direct Trello Card Link
-        trello_link = "#"
-        trello_style = "opacity-50 cursor-not-allowed" # Disabled style by default
-        
-        try:
-            if lead['phone'] and trello_crm.is_configured():
-                card = trello_crm.find_card_by_phone(lead['phone'])
-                if card:
-                    trello_link = card.get('shortUrl', card.get('url'))
-                    trello_style = "hover:underline hover:bg-[#0079bf]/20 transition-colors"
-                else:
-                    # Fallback to search if not found, but user wanted direct link. 
-                    # If not found, maybe show "Create"? Or just search.
-                    # Let's keep search as fallback but clearly marked? 
-                    # User said "puxar link", so if it exists use it.
-                    trello_link = f"https://trello.com/search?q={lead['phone']}"
-                    trello_style = "hover:underline hover:bg-[#0079bf]/20 transition-colors"
-        except:
-             pass
+    recent_messages = get_recent_messages_for_leads([a['id'] for a in activities], per_lead=5)
 
-        chatwoot_link = os.getenv("CHATWOOT_URL", "#")
-        
-        prompt_badge = ""
-        if lead.get('prompt_version'):
-            prompt_badge = f'<span class="px-2 py-0.5 rounded text-[10px] font-bold bg-[#283539] text-gray-400 border border-gray-700">📝 Prompt {lead["prompt_version"]}</span>'
-
-        # Message Preview
-        msg_preview = ""
-        if lead['conversation_history']:
-             # Basic escaping for HTML safety would be good here, but for now assuming internal safe data
-            esc_history = lead['conversation_history'].replace("<", "&lt;").replace(">", "&gt;")
-            msg_preview = f"""
-            <details class="group mt-2">
-                <summary class="list-none cursor-pointer text-xs text-blue-400 hover:text-blue-300 flex items-center gap-1 select-none">
-                    <span class="material-symbols-outlined text-[14px] transition-transform group-open:rotate-180">expand_more</span>
-                    Ver mensagem enviada
-                </summary>
-                <div class="mt-2 text-xs text-gray-400 bg-[#111618] p-3 rounded border border-[#283539] whitespace-pre-wrap">{esc_history}</div>
-            </details>
-            """
-
-        html_output += f"""
-        <div class="relative pl-8 pb-8 border-l border-[#283539] last:border-0 last:pb-0">
-            <div class="absolute -left-[13px] top-0 w-6 h-6 rounded-full bg-[#161b1d] border border-[#283539] flex items-center justify-center text-sm shadow-sm">
-                {icon}
-            </div>
-            <div class="flex flex-col gap-1">
-                <div class="flex items-center gap-2">
-                    <span class="text-xs font-mono text-text-secondary">{time_display}</span>
-                    <span class="text-sm font-bold text-white">{lead['name']}</span>
-                </div>
-                <div class="text-sm text-gray-300">
-                    {desc} <span class="text-gray-500 text-xs">📞 {phone_display}</span>
-                </div>
-                
-                <div class="flex flex-wrap items-center gap-3 mt-1">
-                     <a href="{trello_link}" target="_blank" class="flex items-center gap-1 text-[11px] text-[#0079bf] bg-[#0079bf]/10 px-2 py-0.5 rounded {trello_style}">
-                        📋 Trello
-                    </a>
-                    <a href="{chatwoot_link}" target="_blank" class="flex items-center gap-1 text-[11px] text-[#9966CC] hover:underline bg-[#9966CC]/10 px-2 py-0.5 rounded hover:bg-[#9966CC]/20 transition-colors">
-                        🟣 Chatwoot
-                    </a>
-                    {prompt_badge}
-                </div>
-                {msg_preview}
-            </div>
-        </div>
-        """
-        
-    return html_output
+    import trello_crm
+    trello_enabled = trello_crm.is_configured()
+    links, pending = {}, None
+    if trello_enabled:
+        # One batched lookup for the whole page, running while the first rows stream out
+        links, pending = _start_trello_link_lookup([a['phone'] for a in activities if a['phone']])
+    deadline = time.monotonic() + FEED_LINK_TIMEOUT_SECONDS
+
+    def generate():
+        nonlocal pending
+        for lead in activities:
+            phone = lead['phone']
+            if pending is not None and phone and phone not in links:
+                try:
+                    links.update(pending.result(timeout=max(0.0, deadline - time.monotonic())))
+                except FutureTimeoutError:
+                    print("[Feed] Trello links not ready in time, using search links")
+                except Exception as e:
+                    print(f"[Feed] Trello link lookup failed: {e}")
+                pending = None
+
+            # Links - Direct Trello Card Link
+            trello_link = "#"
+            trello_style = "opacity-50 cursor-not-allowed" # Disabled style by default
+            if phone and trello_enabled:
+                # Not found (or not resolved in time): fall back to a Trello search
+                trello_link = links.get(phone) or f"https://trello.com/search?q={phone}"
+                trello_style = "hover:underline hover:bg-[#0079bf]/20 transition-colors"
+
+            yield _render_feed_item(lead, trello_link, trello_style, recent_messages.get(lead['id']))
+
+    return Response(generate(), mimetype='text/html')
 
 @app.route('/leads', methods=['GET'])
 def leads_page():
@@ -342,13 +403,16 @@ def manage_page():
 def generate_msg_action():
     phone = request.form.get('phone')
     version = request.form.get('version', 'A')
+    # Local template by default; the LLM pass (with the cached site content) is opt-in
+    personalize = request.form.get('personalize') == '1'
     
     lead = get_lead_by_phone(phone)
     if not lead: return jsonify({'error': 'Lead not found'}), 404
+    lead = dict(lead)
     
     # Generate
-    # We might need to scrape if not cached, but for speed let's just generate
-    msg = generate_message(lead, version=version)
+    website_content = scrape_website(lead['website']) if personalize and lead.get('website') else None
+    msg = generate_message(lead, website_content, version=version, personalize=personalize)
     
     # Check if this was an AJAX request or Form submit
     # For MVP, let's assume simple Form submit? 
@@ -371,13 +435,11 @@ def send_msg_action():
         
         for part in parts:
             if not part.strip(): continue
+            # Pacing between parts comes from the shared rate limiter (whatsapp.send_message)
             send_message(jid, part.strip())
             full_log += f"{part.strip()}\n"
-            # Import time to sleep if needed, but for now loop is enough (API usually queues)
-            import time
-            time.sleep(1.5) # Small human delay
             
-        update_lead_status(phone, 'contacted', f"🤖 Ivair (Manual via Dashboard):\n\n{full_log.strip()}")
+        update_lead_status(phone, 'contacted', f"🤖 Ivair (Manual via Dashboard):\n\n{full_log.strip()}", direction='out', source='manual', channel='whatsapp')
         print(f"Manual message sent to {phone}")
     else:
         print(f"Invalid Number: {phone}")
@@ -389,7 +451,7 @@ def set_status_action():
     phone = request.form.get('phone')
     status = request.form.get('status')
     
-    update_lead_status(phone, status, "Status alterado manualmente pelo Dashboard")
+    update_lead_status(phone, status, "Status alterado manualmente pelo Dashboard", direction='note', source='dashboard')
     return redirect(url_for('manage_page', selected_phone=phone))
 
 @app.route('/settings')
@@ -402,14 +464,14 @@ def revalidate_action():
     print("Starting Re-validation of 'new' leads...")
     
     def run_revalidation():
-        leads = get_all_leads()
+        leads = [l for l in get_all_leads() if l['status'] == 'new']
+        jids = check_whatsapp_exists_many([l['phone'] for l in leads], use_cache=False)
         count = 0
         for lead in leads:
-            if lead['status'] == 'new':
-                jid = check_whatsapp_exists(lead['phone'])
-                if not jid:
-                     update_lead_status(lead['phone'], 'invalid_number', "Invalidado na Re-validação")
-                     count += 1
+            # Phones missing from jids couldn't be checked (API error) - leave them as they are
+            if lead['phone'] in jids and not jids[lead['phone']]:
+                 update_lead_status(lead['phone'], 'invalid_number', "Invalidado na Re-validação", direction='note', source='revalidation')
+                 count += 1
         print(f"Re-validation complete. Invalidated {count} leads.")
 
     threading.Thread(target=run_revalidation).start()
@@ -423,54 +485,55 @@ def analytics_page():
     data = get_analytics_data()
     return render_template('analytics.html', analytics_data=data)
 
+CHAT_LIST_LIMIT = 100
+CHAT_PAGE_SIZE = 50
+
 @app.route('/chat')
 def chat_page():
     phone_filter = request.args.get('phone')
-    all_leads = get_all_leads() # Potentially heavy, optimise later
+    before_id = request.args.get('before', type=int)
     
-    # Filter for active chats (those with history)
-    active_chats = []
-    selected_chat = None
+    # Active chats (those with messages), newest first - sorted by the query
+    active_leads = get_active_chats(limit=CHAT_LIST_LIMIT)
+    active_chats = [{
+        'name': l['name'],
+        'phone': l['phone'],
+        'last_contact': str(l['last_contact_date'])[5:16],
+        'messages': []
+    } for l in active_leads]
     
-    for l in all_leads:
-        history = l['conversation_history']
-        if history:
-            chat_obj = {
-                'name': l['name'],
-                'phone': l['phone'],
-                'last_contact': str(l['last_contact_date'])[5:16],
-                'messages': []
-            }
-            
-            # Parse messages (simple split by newline for MVP, improved parsing needed)
-            # Format in DB is usually: "Sender: Message"
-            raw_msgs = history.split('\n')
-            for m in raw_msgs:
-                if not m.strip(): continue
-                is_agent = "Ivair" in m or "Chatwoot Agent" in m
-                sender = "Agente" if is_agent else l['name']
-                content = m.split(':', 1)[1] if ':' in m else m
-                
-                chat_obj['messages'].append({
-                    'is_agent': is_agent,
-                    'sender': sender,
-                    'content': content
-                })
-            
-            chat_obj['raw_ts'] = l['last_contact_date'] or datetime.min
-            
-            active_chats.append(chat_obj)
-            
-            if phone_filter and l['phone'] == phone_filter:
-                selected_chat = chat_obj
-
-    # SORT BY RECENT ACTIVITY (Newest First)
-    # This fixes the user request to show newest chats on top
-    active_chats.sort(key=lambda x: str(x.get('raw_ts', '')), reverse=True)
+    selected_lead = None
+    if phone_filter:
+        selected_lead = get_lead_by_phone(phone_filter)
+    if not selected_lead and active_leads:
+        # Default to first if none selected
+        selected_lead = active_leads[0]
 
-    # Default to first if none selected
-    if not selected_chat and active_chats:
-        selected_chat = active_chats[0]
+    selected_chat = None
+    if selected_lead:
+        selected_lead = dict(selected_lead)
+        selected_chat = {
+            'name': selected_lead['name'],
+            'phone': selected_lead['phone'],
+            'last_contact': str(selected_lead['last_contact_date'])[5:16],
+            'messages': [],
+            'older_before': None
+        }
+        
+        # Only one page of the selected conversation is loaded
+        page = get_messages(selected_lead['id'], limit=CHAT_PAGE_SIZE, before_id=before_id)
+        if len(page) == CHAT_PAGE_SIZE:
+            # Full page: there may be older messages ("Carregar mensagens anteriores")
+            selected_chat['older_before'] = page[0]['id']
+        for m in page:
+            if not m['body']: continue
+            is_agent = m['direction'] != 'in'
+            selected_chat['messages'].append({
+                'id': m['id'],
+                'is_agent': is_agent,
+                'sender': "Agente" if is_agent else selected_lead['name'],
+                'content': m['body']
+            })
 
     return render_template('chat.html', active_chats=active_chats, selected_chat=selected_chat)
 
@@ -484,13 +547,205 @@ def chat_send():
     # send_message(phone, message)
     
     # Update DB
-    update_lead_status(phone, 'contacted', f"🤖 Ivair (Manual): {message}")
+    update_lead_status(phone, 'contacted', f"🤖 Ivair (Manual): {message}", direction='out', source='manual', channel='dashboard')
     
     return redirect(f'/chat?phone={phone}')
 
 
 # --- WEBHOOKS (EXISTING) ---
 
+# --- WEBHOOKS ---
+# Endpoints only validate and enqueue (webhook_queue); the DB/Trello effects run on
+# background consumers, in arrival order per phone, so Evolution/Chatwoot always
+# get a fast 200 even when Trello is slow.
+
+def _sync_message_to_trello(phone, lead_name, sender_prefix, message_content, outgoing, search_term, comment=True):
+    import trello_crm
+    if not trello_crm.is_configured():
+        return
+
+    # 1. Try to find card by PHONE (Robust duplicate check)
+    card = trello_crm.find_card_by_phone(phone)
+    card_name = f"{lead_name} - {phone}"
+
+    if not card:
+        # Fallback search by Name just in case
+        card = trello_crm.find_card_by_name(card_name)
+
+    # 2. If not found, create it
+    # User said: "mesmo se nao estao na planilha... criar um"
+    if not card:
+        # Create dummy lead data for creation
+        dummy_lead = {
+            'name': lead_name,
+            'phone': phone,
+            'website': '',
+            'rating': '',
+            'reviews': '',
+            'search_term': search_term,
+            'address': ''
+        }
+        # If outgoing -> We started -> 'Contato Frio'
+        # If incoming -> They started/responded -> 'Conexão'
+        target_list = "Contato Frio" if outgoing else "Conexão"
+
+        print(f"Creating new Trello card for {card_name} in {target_list}...")
+        card_id = trello_crm.create_card(dummy_lead, list_name=target_list)
+        if card_id:
+            card = {'id': card_id}
+
+    # 3. Log Message
+    if card:
+        if comment:
+            trello_crm.add_comment(card['id'], f"{sender_prefix}\n\n{message_content}")
+
+        # Move card if needed (e.g. if we get a response, move to Conexão)
+        if not outgoing:
+            trello_crm.move_card(card['id'], "Conexão")
+
+
+def _apply_evolution_message(event, steps):
+    # Same message already applied (provider retry, or it came in through Chatwoot first)
+    if not steps.done('db') and message_dedupe.is_processed(event.get('provider_ids', [])):
+        print(f"[Evolution] Duplicate delivery {event.get('external_id')} ignored")
+        return
+
+    phone = event['phone']
+    from_me = event['from_me']
+    message_content = event['content']
+    push_name = event.get('push_name') or 'Desconhecido'
+
+    if from_me:
+        sender_prefix = "🤖 Ivair (WhatsApp):"
+    else:
+        sender_prefix = "📩 Cliente:"
+
+    lead = get_lead_by_phone(phone)
+    if not steps.done('db'):
+        # 1. Check / Create Lead in DB
+        if not lead:
+            print(f"Creating new lead from WhatsApp: {push_name} ({phone})")
+            new_lead_data = {
+                'name': push_name,
+                'phone': phone,
+                'address': '',
+                'website': '',
+                'rating': 0,
+                'reviews': 0,
+                'types': 'whatsapp_contact',
+                'search_term': 'WhatsApp Orgânico',
+                'language': 'pt' # Default
+            }
+            add_lead(new_lead_data)
+            lead = get_lead_by_phone(phone) # Refresh logic
+
+        # 2. Determine Status Update
+        if from_me:
+            # Keep status unless it was new
+            new_status = lead['status'] if lead else 'contacted'
+            if new_status == 'new': new_status = 'contacted'
+        else:
+            new_status = 'responded'
+
+        # 3. Update DB History
+        # This ensures Dashboard Chat works for EVERYONE
+        if lead:
+            added = update_lead_status(
+                phone, new_status, f"{sender_prefix}\n\n{message_content}",
+                direction='out' if from_me else 'in',
+                source='evolution',
+                channel='whatsapp',
+                external_id=event.get('external_id')
+            )
+            if not added and event.get('external_id'):
+                print(f"[Evolution] Duplicate delivery {event['external_id']} ignored")
+                message_dedupe.mark_processed(event.get('provider_ids', []))
+                return
+        steps.mark('db')
+
+    # Trello Sync Logic
+    if not steps.done('trello'):
+        lead_name = lead['name'] if lead else push_name
+        # The Chatwoot -> Trello sync may have commented this message already
+        commented = message_dedupe.is_processed(event.get('provider_ids', []), scope=message_dedupe.TRELLO_COMMENTED)
+        _sync_message_to_trello(phone, lead_name, sender_prefix, message_content, from_me, 'WhatsApp Web/Orgânico', comment=not commented)
+        steps.mark('trello')
+
+    message_dedupe.mark_processed(event.get('provider_ids', []))
+
+
+def _apply_chatwoot_message(event, steps):
+    # Same message already applied (provider retry, or it came in through Evolution first)
+    if not steps.done('db') and message_dedupe.is_processed(event.get('provider_ids', [])):
+        print(f"[Chatwoot] Duplicate delivery {event.get('external_id')} ignored")
+        return
+
+    phone = event['phone']
+    message_content = event['content']
+    message_type = event['message_type'] # 0=incoming, 1=outgoing
+    sender_name = event.get('sender_name') or 'Chatwoot User'
+
+    # Determine sender
+    if message_type == 1: # Outgoing (Agent)
+        sender_prefix = "🗣️ Chatwoot Agent:"
+        new_status = 'contacted'
+    else: # Incoming (Client)
+        sender_prefix = f"📩 Cliente ({sender_name}):"
+        new_status = 'responded'
+
+    lead = get_lead_by_phone(phone)
+    if not steps.done('db'):
+        # 1. Check / Create Lead in DB
+        if not lead:
+            print(f"[Chatwoot] Creating new lead: {sender_name} ({phone})")
+            new_lead_data = {
+                'name': sender_name,
+                'phone': phone,
+                'address': '',
+                'website': '',
+                'rating': 0,
+                'reviews': 0,
+                'types': 'chatwoot_contact',
+                'search_term': 'Chatwoot/Orgânico',
+                'language': 'pt'
+            }
+            add_lead(new_lead_data)
+            lead = get_lead_by_phone(phone)
+
+        # 2. Update DB History
+        if lead:
+            added = update_lead_status(
+                phone, new_status, f"{sender_prefix}\n\n{message_content}",
+                direction='out' if message_type == 1 else 'in',
+                source='chatwoot',
+                channel='chatwoot',
+                external_id=event.get('external_id')
+            )
+            if not added and event.get('external_id'):
+                print(f"[Chatwoot] Duplicate delivery {event['external_id']} ignored")
+                message_dedupe.mark_processed(event.get('provider_ids', []))
+                return
+        steps.mark('db')
+
+    # 3. Trello Sync
+    if not steps.done('trello'):
+        lead_name = lead['name'] if lead else sender_name
+        commented = message_dedupe.is_processed(event.get('provider_ids', []), scope=message_dedupe.TRELLO_COMMENTED)
+        _sync_message_to_trello(phone, lead_name, sender_prefix, message_content, message_type == 1, 'Chatwoot/Orgânico', comment=not commented)
+        steps.mark('trello')
+
+    message_dedupe.mark_processed(event.get('provider_ids', []))
+
+
+webhook_queue.register('evolution', _apply_evolution_message)
+webhook_queue.register('chatwoot', _apply_chatwoot_message)
+
+
+@app.route('/api/webhook_queue')
+def webhook_queue_stats():
+    return jsonify(webhook_queue.get_stats())
+
+
 @app.route('/webhook/evolution', methods=['POST'])
 def evolution_webhook():
     data = request.json
@@ -520,100 +775,19 @@ def evolution_webhook():
             if not message_content:
                 return jsonify({"status": "ignored", "reason": "no text"}), 200
 
-            # 1. Check / Create Lead in DB
-            lead = get_lead_by_phone(phone)
-            if not lead:
-                push_name = message_data.get('pushName', 'Desconhecido')
-                print(f"Creating new lead from WhatsApp: {push_name} ({phone})")
-                new_lead_data = {
-                    'name': push_name,
-                    'phone': phone,
-                    'address': '',
-                    'website': '',
-                    'rating': 0,
-                    'reviews': 0,
-                    'types': 'whatsapp_contact',
-                    'search_term': 'WhatsApp Orgânico',
-                    'language': 'pt' # Default
-                }
-                add_lead(new_lead_data)
-                lead = get_lead_by_phone(phone) # Refresh logic
-
-            # 2. Determine Sender & Status Update
-            if from_me:
-                sender_prefix = "🤖 Ivair (WhatsApp):"
-                # Keep status unless it was new
-                new_status = lead['status'] if lead else 'contacted'
-                if new_status == 'new': new_status = 'contacted'
-            else:
-                sender_prefix = "📩 Cliente:"
-                new_status = 'responded'
-
-            # 3. Update DB History
-            # This ensures Dashboard Chat works for EVERYONE
-            if lead:
-                update_lead_status(phone, new_status, f"{sender_prefix}\n\n{message_content}")
-
-
-
-            # Trello Sync Logic
-            try:
-                import trello_crm
-                if trello_crm.is_configured():
-                    # Check if lead exists in DB to get Name
-                    lead = get_lead_by_phone(phone)
-                    
-                    
-                    # 1. Try to find card by PHONE (Robust duplicate check)
-                    card = trello_crm.find_card_by_phone(phone)
-                    
-                    if not card:
-                         # Fallback search by Name (if available) just in case
-                         if lead:
-                             card_name = f"{lead['name']} - {phone}"
-                             card = trello_crm.find_card_by_name(card_name)
-                         else:
-                             push_name = message_data.get('pushName', 'Desconhecido')
-                             card_name = f"{push_name} - {phone}"
-                             # Try generic search for this name+phone combo
-                             if not card:
-                                  card = trello_crm.find_card_by_name(card_name)
-                    
-                    # 2. If not found, create it (Only if it's a client msg or we want to capture everything)
-                    # User said: "mesmo se nao estao na planilha... criar um"
-                    if not card:
-                        # Create dummy lead data for creation
-                        dummy_lead = {
-                            'name': lead['name'] if lead else message_data.get('pushName', 'Desconhecido'),
-                            'phone': phone,
-                            'website': '',
-                            'rating': '',
-                            'reviews': '',
-                            'search_term': 'WhatsApp Web/Orgânico',
-                            'address': ''
-                        }
-                        # Create in 'Conexão' if they responded, or 'Contato Frio' if we started? 
-                        # If from_me -> We started -> 'Contato Frio'
-                        # If not from_me -> They started/responded -> 'Conexão'
-                        target_list = "Contato Frio" if from_me else "Conexão"
-                        
-                        print(f"Creating new Trello card for {card_name} in {target_list}...")
-                        card_id = trello_crm.create_card(dummy_lead, list_name=target_list)
-                        if card_id:
-                            card = {'id': card_id}
-                    
-                    # 3. Log Message
-                    if card:
-                        trello_crm.add_comment(card['id'], f"{sender_prefix}\n\n{message_content}")
-                        
-                        # Move card if needed (e.g. if we get a response, move to Conexão)
-                        if not from_me:
-                            trello_crm.move_card(card['id'], "Conexão")
-
-            except Exception as t_err:
-                print(f"Trello Sync Error (Webhook): {t_err}")
-
-            return jsonify({"status": "success", "message": "Processed"}), 200
+            provider_ids = message_dedupe.provider_ids(evolution_id=key.get('id'))
+            if message_dedupe.is_processed(provider_ids):
+                return jsonify({"status": "ignored", "reason": "duplicate"}), 200
+
+            webhook_queue.enqueue('evolution', phone, {
+                'phone': phone,
+                'from_me': bool(from_me),
+                'content': message_content,
+                'push_name': message_data.get('pushName'),
+                'external_id': f"evolution:{key['id']}" if key.get('id') else None,
+                'provider_ids': provider_ids
+            })
+            return jsonify({"status": "success", "message": "Queued"}), 200
 
     return jsonify({"status": "ignored"}), 200
 
@@ -622,7 +796,7 @@ def evolution_webhook():
 def chatwoot_webhook():
     """
     Receives events from Chatwoot (message_created, conversation_created, etc.)
-    and syncs them to our Database and Trello.
+    and queues them to be synced to our Database and Trello.
     """
     data = request.json
     event = data.get('event')
@@ -637,7 +811,6 @@ def chatwoot_webhook():
         # Get phone number from conversation meta
         phone = None
         meta = conversation.get('meta', {})
-        contact_inbox = conversation.get('contact_inbox', {})
         
         # Try to get phone from sender or meta
         if sender.get('phone_number'):
@@ -651,71 +824,25 @@ def chatwoot_webhook():
         
         # Message Content
         message_content = message_data.get('content', '')
-        message_type = message_data.get('message_type') # 0=incoming, 1=outgoing
-        sender_name = sender.get('name', 'Chatwoot User')
         
         if not message_content:
             return jsonify({"status": "ignored", "reason": "no content"}), 200
-        
-        # Determine sender
-        if message_type == 1: # Outgoing (Agent)
-            sender_prefix = "🗣️ Chatwoot Agent:"
-            new_status = 'contacted'
-        else: # Incoming (Client)
-            sender_prefix = f"📩 Cliente ({sender_name}):"
-            new_status = 'responded'
-        
-        # 1. Check / Create Lead in DB
-        lead = get_lead_by_phone(phone)
-        if not lead:
-            print(f"[Chatwoot] Creating new lead: {sender_name} ({phone})")
-            new_lead_data = {
-                'name': sender_name,
-                'phone': phone,
-                'address': '',
-                'website': '',
-                'rating': 0,
-                'reviews': 0,
-                'types': 'chatwoot_contact',
-                'search_term': 'Chatwoot/Orgânico',
-                'language': 'pt'
-            }
-            add_lead(new_lead_data)
-            lead = get_lead_by_phone(phone)
-        
-        # 2. Update DB History
-        if lead:
-            update_lead_status(phone, new_status, f"{sender_prefix}\n\n{message_content}")
-        
-        # 3. Trello Sync
-        try:
-            import trello_crm
-            if trello_crm.is_configured():
-                card = trello_crm.find_card_by_phone(phone)
-                
-                if not card:
-                    # Create card
-                    dummy_lead = {
-                        'name': lead['name'] if lead else sender_name,
-                        'phone': phone,
-                        'website': '',
-                        'rating': '',
-                        'reviews': '',
-                        'search_term': 'Chatwoot/Orgânico',
-                        'address': ''
-                    }
-                    target_list = "Contato Frio" if message_type == 1 else "Conexão"
-                    card_id = trello_crm.create_card(dummy_lead, list_name=target_list)
-                    if card_id:
-                        card = {'id': card_id}
-                
-                if card:
-                    trello_crm.add_comment(card['id'], f"{sender_prefix}\n\n{message_content}")
-                    if message_type != 1: # Client replied
-                        trello_crm.move_card(card['id'], "Conexão")
-        except Exception as t_err:
-            print(f"[Chatwoot] Trello Sync Error: {t_err}")
-        
+
+        provider_ids = message_dedupe.provider_ids(
+            chatwoot_id=message_data.get('id'),
+            source_id=message_data.get('source_id')
+        )
+        if message_dedupe.is_processed(provider_ids):
+            return jsonify({"status": "ignored", "reason": "duplicate"}), 200
+
+        webhook_queue.enqueue('chatwoot', phone, {
+            'phone': phone,
+            'message_type': message_data.get('message_type'),
+            'content': message_content,
+            'sender_name': sender.get('name'),
+            'external_id': f"chatwoot:{message_data['id']}" if message_data.get('id') else None,
+            'provider_ids': provider_ids
+        })
         return jsonify({"status": "success", "event": event}), 200
     
     elif event == 'conversation_created':
@@ -726,5 +853,6 @@ def chatwoot_webhook():
     return jsonify({"status": "ignored", "event": event}), 200
 
 if __name__ == '__main__':
+    webhook_queue.start_consumers()
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port)
@@ -1,8 +1,10 @@
 import os
 import json
-import time
+import asyncio
 from datetime import datetime, timedelta
 import chatwoot_api
+import chatwoot_async
+import message_dedupe
 import trello_crm
 from database import get_db_connection, get_lead_by_phone
 
@@ -26,7 +28,11 @@ def save_state(timestamp):
     except Exception as e:
         print(f"Error saving sync state: {e}")
 
-def run_sync():
+async def run_sync_async():
+    """
+    Chatwoot -> Trello sync. Histories of the updated conversations in a page are
+    fetched concurrently; Trello writes still happen one conversation at a time.
+    """
     print("🔄 [Sync] Starting Chatwoot -> Trello sync...")
     
     state = load_state()
@@ -44,7 +50,7 @@ def run_sync():
     current_run_ts = datetime.now().timestamp()
     
     while True:
-        conversations = chatwoot_api.list_conversations(page=page)
+        conversations = await chatwoot_async.list_conversations(page=page)
         if not conversations:
             break
             
@@ -52,6 +58,7 @@ def run_sync():
         # So if we hit one older than last_sync, we can stop (optimization)
         
         should_continue = True
+        updated = []
         
         for conv in conversations:
             last_activity = conv.get('last_activity_at') # Unix timestamp usually
@@ -61,10 +68,17 @@ def run_sync():
             if last_activity <= last_sync_ts:
                 should_continue = False
                 break
+            updated.append(conv)
+
+        senders = [conv.get('meta', {}).get('sender', {}) for conv in updated]
+        histories = await chatwoot_async.get_histories(
+            [sender.get('id') for sender in senders if sender.get('phone_number')]
+        )
                 
+        for conv, sender in zip(updated, senders):
             # Process this conversation
             try:
-                process_conversation(conv, last_sync_ts)
+                process_conversation(conv, last_sync_ts, messages=histories.get(sender.get('id')))
                 processed_count += 1
             except Exception as e:
                 print(f"❌ [Sync] Error processing conversation {conv.get('id')}: {e}")
@@ -79,7 +93,13 @@ def run_sync():
     print(f"✅ [Sync] Finished. Processed {processed_count} updated conversations.")
     save_state(current_run_ts)
 
-def process_conversation(conv, last_sync_ts):
+def run_sync():
+    asyncio.run(run_sync_async())
+
+def _message_provider_ids(msg):
+    return message_dedupe.provider_ids(chatwoot_id=msg.get('id'), source_id=msg.get('source_id'))
+
+def process_conversation(conv, last_sync_ts, messages=None):
     # 1. Get Contact Info
     meta = conv.get('meta', {})
     sender = meta.get('sender', {})
@@ -92,12 +112,20 @@ def process_conversation(conv, last_sync_ts):
 
     print(f"   -> Processing update for {name} ({phone})")
     
-    # 2. Get Messages for context
-    messages = chatwoot_api.get_conversation_history(sender.get('id'))
+    # 2. Get Messages for context (already fetched when called from run_sync_async)
+    if messages is None:
+        messages = chatwoot_api.get_conversation_history(sender.get('id'))
     if not messages: return
 
+    # Messages already applied by the webhooks (or commented by a previous sync) are skipped
+    all_ids = [i for msg in messages for i in _message_provider_ids(msg)]
+    already_processed = message_dedupe.processed_among(all_ids) | message_dedupe.processed_among(
+        all_ids, scope=message_dedupe.TRELLO_COMMENTED
+    )
+
     # Filter messages newer than last sync
     new_messages = []
+    new_ids = []
     
     for msg in messages:
         try:
@@ -115,6 +143,10 @@ def process_conversation(conv, last_sync_ts):
             msg_type = msg.get('message_type')
             sender_name = "Cliente" if msg_type == 0 else "Ivair"
             
+            ids = _message_provider_ids(msg)
+            if already_processed.intersection(ids):
+                continue
+
             # Strict > check to avoid dupes if sync runs fast
             if msg_ts > last_sync_ts:
                 # Format Time (e.g. 14:30)
@@ -123,6 +155,7 @@ def process_conversation(conv, last_sync_ts):
                 content = msg.get('content', '')
                 if content:
                     new_messages.append(f"⏰ [{time_str}] **{sender_name}**: {content}")
+                    new_ids.extend(ids)
                     
         except Exception as e:
             print(f"      Error parsing message: {e}")
@@ -144,14 +177,11 @@ def process_conversation(conv, last_sync_ts):
     final_comment = f"{header}\n{update_block}\n_(Via Sync Automático)_"
     
     if card:
-        # 1. Deduplication: Check if last comment is identical
-        last_comment = trello_crm.get_last_comment(card['id'])
-        if last_comment and update_block in last_comment:
-            print(f"      Skipping duplicate comment for {card['name']}")
-        else:
-            # Update existing
-            trello_crm.add_comment(card['id'], final_comment)
-            print(f"      Updated Trello Card: {card['name']} with {len(new_messages)} new messages")
+        # 1. Update existing (duplicates were already dropped via message_dedupe)
+        trello_crm.add_comment(card['id'], final_comment)
+        # Only the comment is done: the webhook still has to store these messages
+        message_dedupe.mark_processed(new_ids, scope=message_dedupe.TRELLO_COMMENTED)
+        print(f"      Updated Trello Card: {card['name']} with {len(new_messages)} new messages")
             
         # 2. Intelligent Renaming (Cost Saving: Only if name looks like a phone number)
         # Check if card name starts with + or digit (indicates phone number)
@@ -194,6 +224,7 @@ def process_conversation(conv, last_sync_ts):
         card_id = trello_crm.create_card(lead_data, list_name=target_list)
         if card_id:
             trello_crm.add_comment(card_id, "🔔 **Novo Lead vindo do Chatwoot**\n" + final_comment)
+            message_dedupe.mark_processed(new_ids, scope=message_dedupe.TRELLO_COMMENTED)
             print(f"      Created New Trello Card in '{target_list}'")
 
 if __name__ == "__main__":
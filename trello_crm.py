@@ -1,6 +1,10 @@
 import os
-import requests
+import time
+import threading
+import http_client
 import json
+from datetime import datetime, timezone
+import trello_index
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,6 +15,16 @@ BOARD_ID = os.getenv("TRELLO_BOARD_ID") # Short ID or Long ID
 
 BASE_URL = "https://api.trello.com/1"
 
+# Local card index (trello_index): replay board actions at most every N seconds,
+# and re-download the whole board once a day to heal any drift
+TRELLO_INDEX_REFRESH_SECONDS = int(os.getenv("TRELLO_INDEX_REFRESH_SECONDS", "60"))
+TRELLO_INDEX_REBUILD_SECONDS = int(os.getenv("TRELLO_INDEX_REBUILD_SECONDS", str(24 * 3600)))
+# Above this many touched cards a full rebuild is cheaper than one GET per card
+TRELLO_INDEX_MAX_INCREMENTAL = 50
+
+CARD_FIELDS = 'id,name,desc,idList,url,shortUrl,closed'
+CARD_ACTIONS = 'createCard,updateCard,deleteCard,copyCard,moveCardToBoard,moveCardFromBoard,convertToCardFromCheckItem'
+
 def is_configured():
     return bool(API_KEY and TOKEN and BOARD_ID)
 
@@ -23,7 +37,7 @@ def get_lists():
         'token': TOKEN
     }
     try:
-        response = requests.get(url, params=query)
+        response = http_client.get(url, params=query)
         if response.status_code == 200:
             lists = response.json()
             return {l['name']: l['id'] for l in lists}
@@ -52,7 +66,7 @@ def create_list(name):
         'token': TOKEN
     }
     try:
-        response = requests.post(url, params=query)
+        response = http_client.post(url, params=query)
         if response.status_code == 200:
             data = response.json()
             # Update cache
@@ -96,7 +110,7 @@ def find_card(query_str):
     }
     
     try:
-        response = requests.get(url, params=query)
+        response = http_client.get(url, params=query)
         results = response.json()
         cards = results.get('cards', [])
         if cards:
@@ -106,12 +120,161 @@ def find_card(query_str):
         print(f"Error searching Trello card: {e}")
         return None
 
+# =============================================================================
+# ÍNDICE LOCAL DE CARDS
+# =============================================================================
+
+_index_lock = threading.Lock()
+
+
+def _fetch_board_cards():
+    url = f"{BASE_URL}/boards/{BOARD_ID}/cards/open"
+    cards = []
+    before = None
+    while True:
+        query = {'fields': CARD_FIELDS, 'limit': 1000, 'key': API_KEY, 'token': TOKEN}
+        if before:
+            query['before'] = before
+        response = http_client.get(url, params=query)
+        response.raise_for_status()
+        page = response.json()
+        cards.extend(page)
+        if len(page) < 1000:
+            return cards
+        # Pages go newest -> oldest by id
+        before = min(card['id'] for card in page)
+
+
+def _fetch_card_actions(since=None):
+    url = f"{BASE_URL}/boards/{BOARD_ID}/actions"
+    query = {'filter': CARD_ACTIONS, 'fields': 'type,data', 'limit': 1000, 'key': API_KEY, 'token': TOKEN}
+    if since:
+        query['since'] = since
+    response = http_client.get(url, params=query)
+    response.raise_for_status()
+    return response.json()
+
+
+def rebuild_card_index():
+    """Downloads every open card of the board into the local index."""
+    # Bookmark the newest action first so edits made during the download get replayed
+    latest = _fetch_card_actions()
+    cards = _fetch_board_cards()
+    trello_index.replace_all(cards)
+    now = time.time()
+    trello_index.set_state(
+        last_action_id=latest[0]['id'] if latest else None,
+        rebuilt_at=now,
+        refreshed_at=now
+    )
+    print(f"[Trello] Card index rebuilt: {len(cards)} cards")
+
+
+def _apply_card_actions(since):
+    actions = _fetch_card_actions(since)
+    if not actions:
+        trello_index.set_state(refreshed_at=time.time())
+        return
+
+    touched = []
+    removed = set()
+    for action in actions:
+        card_id = (action.get('data', {}).get('card') or {}).get('id')
+        if not card_id:
+            continue
+        if action.get('type') in ('deleteCard', 'moveCardFromBoard'):
+            removed.add(card_id)
+        elif card_id not in touched:
+            touched.append(card_id)
+
+    if len(actions) >= 1000 or len(touched) > TRELLO_INDEX_MAX_INCREMENTAL:
+        rebuild_card_index()
+        return
+
+    cards = []
+    for card_id in touched:
+        if card_id in removed:
+            continue
+        response = http_client.get(f"{BASE_URL}/cards/{card_id}", params={'fields': CARD_FIELDS, 'key': API_KEY, 'token': TOKEN})
+        if response.status_code == 200:
+            cards.append(response.json())
+        elif response.status_code == 404:
+            removed.add(card_id)
+
+    trello_index.remove_cards(removed)
+    trello_index.put_cards(cards)
+    # Actions come newest first
+    trello_index.set_state(last_action_id=actions[0]['id'], refreshed_at=time.time())
+
+
+def refresh_card_index(force=False):
+    """
+    Brings the local index up to date if it's stale (or always, with force=True).
+    Returns False when the index couldn't be built. Only the scheduler calls this;
+    lookups read whatever is indexed and use /search until the first build.
+    """
+    if not is_configured():
+        return False
+    with _index_lock:
+        try:
+            now = time.time()
+            rebuilt_at = float(trello_index.get_state('rebuilt_at', 0) or 0)
+            refreshed_at = float(trello_index.get_state('refreshed_at', 0) or 0)
+
+            if now - rebuilt_at >= TRELLO_INDEX_REBUILD_SECONDS:
+                rebuild_card_index()
+            elif force or now - refreshed_at >= TRELLO_INDEX_REFRESH_SECONDS:
+                # Empty board at rebuild time: no action id to start from, use the rebuild date
+                since = trello_index.get_state('last_action_id') or datetime.fromtimestamp(rebuilt_at, timezone.utc).isoformat()
+                _apply_card_actions(since)
+            return True
+        except Exception as e:
+            print(f"Error refreshing Trello card index: {e}")
+            # A previous build is still usable, just slightly stale
+            return bool(trello_index.get_state('rebuilt_at'))
+
+
+def _index_card(card):
+    try:
+        trello_index.put_cards([card])
+    except Exception as e:
+        print(f"Error updating Trello card index: {e}")
+
+
+def _index_ready():
+    # Built and kept fresh by the scheduler job; lookups only read it
+    try:
+        return bool(trello_index.get_state('rebuilt_at'))
+    except Exception as e:
+        print(f"Error reading Trello card index: {e}")
+        return False
+
+
+def find_cards_by_phones(phones):
+    """Resolves many phones at once. Returns {phone: card} for the ones with a card."""
+    if not is_configured(): return {}
+    if _index_ready():
+        return trello_index.find_many_by_phone(phones)
+    found = {}
+    for phone in phones:
+        card = find_card(phone)
+        if card:
+            found[phone] = card
+    return found
+
+
 def find_card_by_phone(phone):
-    # Search by phone number (likely in description or title)
+    if not is_configured(): return None
+    if _index_ready():
+        return trello_index.find_by_phone(phone)
+    # Index unavailable: search by phone number (likely in description or title)
     return find_card(phone)
 
 def find_card_by_name(card_name):
-    # Search by specific name attribute
+    if not is_configured(): return None
+    if _index_ready():
+        return trello_index.find_by_name(card_name)
+    # Index unavailable: search by specific name attribute
     return find_card(f"name:\"{card_name}\"")
 
 def create_card(lead_data, list_name="Prospecção"):
@@ -121,14 +284,17 @@ def create_card(lead_data, list_name="Prospecção"):
 
     card_name = f"{lead_data['name']} - {lead_data['phone']}"
     
+    # Cards we create are indexed right away; edits made elsewhere arrive with the scheduler refresh
+    indexed = _index_ready()
+
     # Check duplicate by PHONE first (more robust)
-    existing_card = find_card_by_phone(lead_data['phone'])
+    existing_card = trello_index.find_by_phone(lead_data['phone']) if indexed else find_card(lead_data['phone'])
     if existing_card:
         print(f"Card already exists (found by phone). ID: {existing_card['id']}")
         return existing_card['id']
 
     # Fallback: Check by name (if phone was formatted differently in search vs card)
-    existing_card_name = find_card_by_name(card_name)
+    existing_card_name = trello_index.find_by_name(card_name) if indexed else find_card(f"name:\"{card_name}\"")
     if existing_card_name:
          print(f"Card already exists (found by name). ID: {existing_card_name['id']}")
          return existing_card_name['id']
@@ -165,9 +331,10 @@ def create_card(lead_data, list_name="Prospecção"):
     }
     
     try:
-        response = requests.post(url, params=query)
+        response = http_client.post(url, params=query)
         if response.status_code == 200:
             card = response.json()
+            _index_card(card)
             return card['id']
         else:
             print(f"Error creating card: {response.text}")
@@ -186,7 +353,7 @@ def add_comment(card_id, text):
         'token': TOKEN
     }
     try:
-        requests.post(url, params=query)
+        http_client.post(url, params=query)
     except Exception as e:
         print(f"Error commenting on card: {e}")
 
@@ -203,7 +370,9 @@ def move_card(card_id, list_name):
         'token': TOKEN
     }
     try:
-        requests.put(url, params=query)
+        response = http_client.put(url, params=query)
+        if response.status_code == 200:
+            _index_card(response.json())
     except Exception as e:
         print(f"Error moving card: {e}")
 
@@ -219,7 +388,9 @@ def update_card(card_id, name=None, desc=None):
     if desc: query['desc'] = desc
     
     try:
-        requests.put(url, params=query)
+        response = http_client.put(url, params=query)
+        if response.status_code == 200:
+            _index_card(response.json())
     except Exception as e:
         print(f"Error updating card: {e}")
 
@@ -234,7 +405,7 @@ def get_last_comment(card_id):
         'token': TOKEN
     }
     try:
-        response = requests.get(url, params=query)
+        response = http_client.get(url, params=query)
         if response.status_code == 200:
             actions = response.json()
             if actions:
@@ -0,0 +1,200 @@
+import re
+import time
+from database import get_db_connection, register_schema, ensure_schema
+
+# Local copy of the board's open cards (phone -> card, name -> card) so card
+# resolution doesn't cost a Trello /search call. Filled and kept fresh by
+# trello_crm (bulk board fetch + board actions + our own writes).
+
+# Phone-looking runs in card names/descriptions ("Padaria X - 5545999998888", "**Telefone:** +55 45 ...")
+_PHONE_PATTERN = re.compile(r'\+?\d[\d\s().-]{7,}\d')
+
+_SCHEMA = register_schema(
+    'trello_index',
+    '''
+    CREATE TABLE IF NOT EXISTS trello_cards (
+        card_id TEXT PRIMARY KEY,
+        name TEXT,
+        name_key TEXT,
+        list_id TEXT,
+        url TEXT,
+        short_url TEXT,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_trello_cards_name ON trello_cards(name_key)',
+    '''
+    CREATE TABLE IF NOT EXISTS trello_card_phones (
+        phone TEXT NOT NULL,
+        card_id TEXT NOT NULL REFERENCES trello_cards(card_id) ON DELETE CASCADE,
+        PRIMARY KEY (phone, card_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_trello_card_phones_card ON trello_card_phones(card_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS trello_index_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''',
+)
+
+
+def _name_key(name):
+    return ' '.join((name or '').lower().split())
+
+
+def _digits(phone):
+    return re.sub(r'\D', '', phone or '')
+
+
+def extract_phones(*texts):
+    phones = set()
+    for text in texts:
+        for match in _PHONE_PATTERN.findall(text or ''):
+            digits = _digits(match)
+            if 10 <= len(digits) <= 13:
+                phones.add(digits)
+    return phones
+
+
+def phone_keys(phone):
+    """Digits of a phone plus its with/without country code (55) forms."""
+    digits = _digits(phone)
+    if not digits:
+        return []
+    keys = [digits]
+    if digits.startswith('55') and len(digits) >= 12:
+        keys.append(digits[2:])
+    elif len(digits) in (10, 11):
+        keys.append('55' + digits)
+    return keys
+
+
+def _row_to_card(row):
+    # Same shape as a Trello /search card result
+    return {
+        'id': row['card_id'],
+        'name': row['name'],
+        'idList': row['list_id'],
+        'url': row['url'],
+        'shortUrl': row['short_url']
+    }
+
+
+def _put_cards(conn, cards, now):
+    for card in cards:
+        card_id = card.get('id')
+        if not card_id:
+            continue
+        if card.get('closed'):
+            conn.execute('DELETE FROM trello_cards WHERE card_id = ?', (card_id,))
+            continue
+        conn.execute('''
+            INSERT INTO trello_cards (card_id, name, name_key, list_id, url, short_url, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(card_id) DO UPDATE SET
+                name = excluded.name, name_key = excluded.name_key, list_id = excluded.list_id,
+                url = excluded.url, short_url = excluded.short_url, updated_at = excluded.updated_at
+        ''', (card_id, card.get('name'), _name_key(card.get('name')), card.get('idList'),
+              card.get('url'), card.get('shortUrl'), now))
+        # desc is only present on full card payloads; keep the old phones otherwise
+        if 'desc' in card:
+            conn.execute('DELETE FROM trello_card_phones WHERE card_id = ?', (card_id,))
+        conn.executemany(
+            'INSERT OR IGNORE INTO trello_card_phones (phone, card_id) VALUES (?, ?)',
+            [(phone, card_id) for phone in extract_phones(card.get('name'), card.get('desc'))]
+        )
+
+
+def put_cards(cards):
+    """Upserts card payloads (needs id; name/desc/idList/url/shortUrl/closed when known)."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    _put_cards(conn, cards, time.time())
+    conn.commit()
+    conn.close()
+
+
+def remove_cards(card_ids):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    conn.executemany('DELETE FROM trello_cards WHERE card_id = ?', [(cid,) for cid in card_ids])
+    conn.commit()
+    conn.close()
+
+
+def replace_all(cards):
+    """Swaps the whole index for a fresh board snapshot in one transaction."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM trello_card_phones')
+        conn.execute('DELETE FROM trello_cards')
+        _put_cards(conn, cards, time.time())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def find_many_by_phone(phones):
+    """Returns {phone: card} for the phones that have a card (oldest card wins)."""
+    ensure_schema(_SCHEMA)
+    keys = {}
+    for phone in phones:
+        for key in phone_keys(phone):
+            keys.setdefault(key, phone)
+    if not keys:
+        return {}
+
+    placeholders = ','.join('?' * len(keys))
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT p.phone AS matched, c.* FROM trello_card_phones p
+        JOIN trello_cards c ON c.card_id = p.card_id
+        WHERE p.phone IN ({placeholders})
+        ORDER BY c.card_id
+    ''', tuple(keys)).fetchall()
+    conn.close()
+
+    found = {}
+    for row in rows:
+        # Trello ids start with the creation timestamp, so the first row is the original card
+        found.setdefault(keys[row['matched']], _row_to_card(row))
+    return found
+
+
+def find_by_phone(phone):
+    return find_many_by_phone([phone]).get(phone)
+
+
+def find_by_name(name):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT * FROM trello_cards WHERE name_key = ? ORDER BY card_id LIMIT 1', (_name_key(name),)
+    ).fetchone()
+    conn.close()
+    return _row_to_card(row) if row else None
+
+
+def get_state(key, default=None):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    row = conn.execute('SELECT value FROM trello_index_state WHERE key = ?', (key,)).fetchone()
+    conn.close()
+    return row['value'] if row else default
+
+
+def set_state(**values):
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    conn.executemany('''
+        INSERT INTO trello_index_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    ''', [(k, None if v is None else str(v)) for k, v in values.items()])
+    conn.commit()
+    conn.close()
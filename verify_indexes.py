@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import database
+
+# Runs against a throwaway DB so it never touches data/leads.db
+tmp_dir = tempfile.mkdtemp()
+database.DB_NAME = os.path.join(tmp_dir, "leads.db")
+database.init_db()
+
+# Seed enough rows for ANALYZE to prefer the indexes
+conn = database.get_db_connection()
+now = datetime.now()
+statuses = ['new', 'contacted', 'responded', 'follow_up', 'invalid_number', 'declined']
+conn.executemany(
+    "INSERT INTO leads (name, phone, status, last_contact_date, next_contact_date, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+    [
+        (f"Lead {i}", f"55459{i:08d}", statuses[i % len(statuses)],
+         now - timedelta(hours=i % 500), now + timedelta(hours=i % 300), now - timedelta(hours=i % 700))
+        for i in range(5000)
+    ]
+)
+conn.execute("ANALYZE")
+conn.commit()
+conn.close()
+
+today_start, tomorrow_start = database.day_bounds()
+
+# (description, sql, params) - must mirror the hot queries in database.py / followup.py / scheduler.py
+HOT_QUERIES = [
+    ("KPI novos leads hoje",
+     "SELECT COUNT(*) FROM leads WHERE created_at >= ? AND created_at < ?",
+     (today_start, tomorrow_start)),
+    ("KPI enviados hoje",
+     "SELECT COUNT(*) FROM leads WHERE status IN ('contacted', 'follow_up_1', 'follow_up_2') AND last_contact_date >= ? AND last_contact_date < ?",
+     (today_start, tomorrow_start)),
+    ("KPI respostas hoje",
+     "SELECT COUNT(*) FROM leads WHERE status IN ('responded', 'connected') AND last_contact_date >= ? AND last_contact_date < ?",
+     (today_start, tomorrow_start)),
+    ("Claim da fila (lead 'new' a partir de um id aleatório)",
+     "SELECT id FROM leads WHERE status = 'new' AND id >= ? ORDER BY id LIMIT 1",
+     (2500,)),
+    ("Reaper de leases expirados",
+     "SELECT id FROM leads WHERE status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+     (now,)),
+    ("Auto-refill (contagem de new)",
+     "SELECT COUNT(*) FROM leads WHERE status = 'new'",
+     ()),
+    ("Follow-up estágio 1",
+     "SELECT * FROM leads WHERE status = 'contacted' AND last_contact_date <= ? AND (follow_up_stage = 0 OR follow_up_stage IS NULL)",
+     (now - timedelta(days=3),)),
+    ("Follow-up estágios 2/3",
+     "SELECT * FROM leads WHERE status = 'follow_up' AND next_contact_date <= ?",
+     (now,)),
+    ("Hot leads",
+     "SELECT * FROM (SELECT * FROM leads WHERE status = 'responded' ORDER BY last_contact_date DESC LIMIT ?) "
+     "UNION ALL SELECT * FROM (SELECT * FROM leads WHERE status = 'connected' ORDER BY last_contact_date DESC LIMIT ?) "
+     "ORDER BY last_contact_date DESC LIMIT ?",
+     (5, 5, 5)),
+    ("Atividade recente (feed)",
+     "SELECT * FROM leads WHERE last_contact_date IS NOT NULL ORDER BY last_contact_date DESC LIMIT 10 OFFSET 0",
+     ()),
+    ("Mensagens de um lead",
+     "SELECT * FROM messages WHERE lead_id = ? ORDER BY id DESC LIMIT 50",
+     (1,)),
+]
+
+print("--- 🧪 VERIFICAÇÃO DOS PLANOS DE CONSULTA ---\n")
+
+failures = 0
+for description, sql, params in HOT_QUERIES:
+    plan = database.explain_query_plan(sql, params)
+    # Any "SCAN leads" / "SCAN messages" walks the whole table or index, even "USING (COVERING) INDEX";
+    # only SEARCH is bounded. Scans over subqueries/CTEs are fine.
+    full_scan = [p for p in plan if p.startswith(("SCAN leads", "SCAN messages"))]
+    if full_scan:
+        failures += 1
+        print(f"❌ {description}")
+    else:
+        print(f"✅ {description}")
+    for p in plan:
+        print(f"      {p}")
+
+database.close_db_connections()
+
+print()
+if failures:
+    print(f"❌ {failures} consulta(s) fazendo scan de tabela ou índice.")
+    sys.exit(1)
+print("✅ Todas as consultas usam índices.")
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import database
+
+# Runs against a throwaway DB so it never touches data/leads.db
+tmp_dir = tempfile.mkdtemp()
+database.DB_NAME = os.path.join(tmp_dir, "leads.db")
+database.init_db()
+
+BASE = {'name': 'Lead', 'address': '', 'website': '', 'rating': 0, 'reviews': 0, 'types': '', 'search_term': 'verify'}
+
+
+def lead(phone, **fields):
+    return dict(BASE, phone=phone, **fields)
+
+
+def current(phone):
+    conn = database.get_db_connection()
+    row = conn.execute("SELECT name, status FROM leads WHERE phone = ?", (phone,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+print("--- 🧪 VERIFICAÇÃO DO UPSERT DE LEADS ---\n")
+
+database.upsert_leads([lead('5545900000001'), lead('5545900000002', status='contacted')])
+database.update_lead_status('5545900000001', 'responded')
+
+database.upsert_leads(
+    [
+        lead('5545900000001', name='Renomeado'),                  # sem status
+        lead('5545900000002', status='closed_no_response'),       # status informado
+        lead('5545900000003'),                                    # novo, sem status
+    ],
+    merge={'status': 'replace', 'name': 'replace'}
+)
+
+CHECKS = [
+    ("'replace' sem status mantém o status atual", current('5545900000001'), {'name': 'Renomeado', 'status': 'responded'}),
+    ("'replace' com status informado substitui", current('5545900000002'), {'name': 'Lead', 'status': 'closed_no_response'}),
+    ("Lead novo sem status entra como 'new'", current('5545900000003'), {'name': 'Lead', 'status': 'new'}),
+]
+
+# merge=None nunca altera um lead existente
+database.upsert_leads([lead('5545900000001', name='Outro', status='new')])
+CHECKS.append(("merge=None não altera lead existente", current('5545900000001'), {'name': 'Renomeado', 'status': 'responded'}))
+
+database.close_db_connections()
+
+failures = 0
+for description, got, expected in CHECKS:
+    if got == expected:
+        print(f"✅ {description}")
+    else:
+        failures += 1
+        print(f"❌ {description}: esperado {expected}, obtido {got}")
+
+print()
+if failures:
+    print(f"❌ {failures} verificação(ões) falharam.")
+    sys.exit(1)
+print("✅ Upsert preserva os dados existentes conforme a política de merge.")
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import socket
+import threading
+from database import get_db_connection, register_schema, ensure_schema
+
+# Durable outbox between the webhook endpoints and their side effects (DB + Trello).
+# Handlers only enqueue; consumer threads apply events in order per phone.
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_LEASE_SECONDS = int(os.getenv("WEBHOOK_LEASE_SECONDS", "300"))
+WEBHOOK_RETENTION_HOURS = int(os.getenv("WEBHOOK_RETENTION_HOURS", "72"))
+WEBHOOK_RETRY_BACKOFF_SECONDS = 5
+
+_handlers = {}
+_wakeup = threading.Event()
+_consumers = []
+_consumers_lock = threading.Lock()
+
+_SCHEMA = register_schema(
+    'webhook_queue',
+    '''
+    CREATE TABLE IF NOT EXISTS webhook_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        partition_key TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        steps TEXT NOT NULL DEFAULT '',
+        available_at REAL NOT NULL,
+        claimed_by TEXT,
+        lease_expires_at REAL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        processed_at REAL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events(status, id)',
+    'CREATE INDEX IF NOT EXISTS idx_webhook_events_partition ON webhook_events(partition_key, id)',
+)
+
+
+class EventSteps:
+    """
+    Progress of one event across attempts, so a retry skips the effects that
+    already went through (e.g. DB written, Trello call failed).
+    """
+
+    def __init__(self, event_id, steps):
+        self.event_id = event_id
+        self._done = set(s for s in (steps or '').split(',') if s)
+
+    def done(self, name):
+        return name in self._done
+
+    def mark(self, name):
+        if name in self._done:
+            return
+        conn = get_db_connection()
+        conn.execute("UPDATE webhook_events SET steps = steps || ? WHERE id = ?", (f"{name},", self.event_id))
+        conn.commit()
+        conn.close()
+        self._done.add(name)
+
+
+def register(source, handler):
+    """handler(payload: dict, steps: EventSteps) applies one event; raising means retry."""
+    _handlers[source] = handler
+
+
+def enqueue(source, partition_key, payload):
+    """Stores one event and wakes the consumers. Returns the event id."""
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        INSERT INTO webhook_events (source, partition_key, payload, available_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (source, partition_key, json.dumps(payload, ensure_ascii=False), now, now))
+    conn.commit()
+    event_id = cursor.lastrowid
+    conn.close()
+    _wakeup.set()
+    return event_id
+
+
+def claim_next(worker_id):
+    """
+    Claims the oldest runnable event whose phone has nothing older still pending
+    or in flight, so events for one phone are applied strictly in arrival order.
+    """
+    ensure_schema(_SCHEMA)
+    now = time.time()
+    conn = get_db_connection()
+    row = conn.execute('''
+        UPDATE webhook_events
+        SET status = 'processing', claimed_by = ?, lease_expires_at = ?, attempts = attempts + 1
+        WHERE id = (
+            SELECT e.id FROM webhook_events e
+            WHERE e.status = 'pending' AND e.available_at <= ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM webhook_events o
+                  WHERE o.partition_key = e.partition_key AND o.id < e.id
+                    AND o.status IN ('pending', 'processing')
+              )
+            ORDER BY e.id
+            LIMIT 1
+        )
+        AND status = 'pending'
+        RETURNING *
+    ''', (worker_id, now + WEBHOOK_LEASE_SECONDS, now)).fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+
+def _finish(event_id, status, error=None, available_at=None):
+    conn = get_db_connection()
+    conn.execute('''
+        UPDATE webhook_events
+        SET status = ?, last_error = ?, available_at = COALESCE(?, available_at),
+            claimed_by = NULL, lease_expires_at = NULL,
+            processed_at = CASE WHEN ? = 'pending' THEN NULL ELSE ? END
+        WHERE id = ?
+    ''', (status, error, available_at, status, time.time(), event_id))
+    conn.commit()
+    conn.close()
+
+
+def process_next(worker_id):
+    """Applies one event. Returns False when there was nothing to do."""
+    event = claim_next(worker_id)
+    if not event:
+        return False
+
+    handler = _handlers.get(event['source'])
+    try:
+        if handler is None:
+            raise RuntimeError(f"no handler registered for '{event['source']}'")
+        handler(json.loads(event['payload']), EventSteps(event['id'], event['steps']))
+        _finish(event['id'], 'done')
+    except Exception as e:
+        if event['attempts'] >= WEBHOOK_MAX_ATTEMPTS:
+            print(f"❌ [Webhook Queue] Event {event['id']} ({event['source']}) failed for good: {e}")
+            _finish(event['id'], 'failed', str(e))
+        else:
+            delay = WEBHOOK_RETRY_BACKOFF_SECONDS * (2 ** (event['attempts'] - 1))
+            print(f"⚠️ [Webhook Queue] Event {event['id']} ({event['source']}) failed, retrying in {delay}s: {e}")
+            _finish(event['id'], 'pending', str(e), time.time() + delay)
+    return True
+
+
+def reap_expired_leases():
+    """Puts events whose consumer died mid-processing back in the queue."""
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        UPDATE webhook_events SET status = 'pending', claimed_by = NULL, lease_expires_at = NULL
+        WHERE status = 'processing' AND lease_expires_at < ?
+    ''', (time.time(),))
+    conn.commit()
+    reaped = cursor.rowcount
+    conn.close()
+    return reaped
+
+
+def purge_processed():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    cursor = conn.execute('''
+        DELETE FROM webhook_events WHERE status IN ('done', 'failed') AND processed_at < ?
+    ''', (time.time() - WEBHOOK_RETENTION_HOURS * 3600,))
+    conn.commit()
+    removed = cursor.rowcount
+    conn.close()
+    return removed
+
+
+def get_stats():
+    ensure_schema(_SCHEMA)
+    conn = get_db_connection()
+    counts = {row['status']: row['n'] for row in conn.execute(
+        'SELECT status, COUNT(*) AS n FROM webhook_events GROUP BY status'
+    ).fetchall()}
+    oldest = conn.execute(
+        "SELECT MIN(created_at) FROM webhook_events WHERE status IN ('pending', 'processing')"
+    ).fetchone()[0]
+    conn.close()
+    return {
+        'counts': counts,
+        'oldest_pending_seconds': round(time.time() - oldest, 1) if oldest else 0
+    }
+
+
+def _consumer_loop(worker_id):
+    last_housekeeping = 0
+    while True:
+        try:
+            if time.time() - last_housekeeping > 60:
+                reap_expired_leases()
+                purge_processed()
+                last_housekeeping = time.time()
+
+            if process_next(worker_id):
+                continue
+        except Exception as e:
+            print(f"❌ [Webhook Queue] Consumer error: {e}")
+        # Idle: sleep until a new event arrives (or a retry comes due)
+        _wakeup.wait(timeout=1)
+        _wakeup.clear()
+
+
+def start_consumers(workers=None):
+    """Starts the background consumer threads once per process."""
+    with _consumers_lock:
+        if _consumers:
+            return _consumers
+        ensure_schema(_SCHEMA)
+        for i in range(workers or WEBHOOK_WORKERS):
+            worker_id = f"{socket.gethostname()}:{os.getpid()}:webhook-{i}"
+            thread = threading.Thread(target=_consumer_loop, args=(worker_id,), daemon=True, name=f"webhook-consumer-{i}")
+            thread.start()
+            _consumers.append(thread)
+        print(f"[Webhook Queue] {len(_consumers)} consumer(s) started")
+        return _consumers
@@ -1,7 +1,9 @@
 import os
-import requests
+import http_client
 import re
 from dotenv import load_dotenv
+import rate_limiter
+import jid_cache
 
 load_dotenv()
 
@@ -22,17 +24,10 @@ def format_number(phone):
         
     return clean_phone
 
-def check_whatsapp_exists(phone):
-    # Try to check if number exists on WhatsApp
-    # This endpoint might vary based on Evolution API version
-    # Based on n8n workflow, it uses /chat/whatsappNumbers/{instance}
-    
-    url = f"{API_URL}/chat/whatsappNumbers/{INSTANCE}"
-    headers = {
-        "apikey": API_KEY,
-        "Content-Type": "application/json"
-    }
-    
+# Max numbers (including 8/9-digit variants) per /chat/whatsappNumbers request
+WA_CHECK_BATCH_SIZE = int(os.getenv("WA_CHECK_BATCH_SIZE", "50"))
+
+def _number_variants(phone):
     # 1. Clean the input first (remove non-digits)
     clean_phone = re.sub(r'\D', '', phone)
     
@@ -62,35 +57,106 @@ def check_whatsapp_exists(phone):
     # Fallback: if cleaning failed or short, just try the original just in case
     if not numbers_to_check:
         numbers_to_check.append(phone)
-    
-    payload = {
-        "numbers": list(set(numbers_to_check)) # Remove duplicates
+        
+    # Remove duplicates, keep order
+    return list(dict.fromkeys(numbers_to_check))
+
+def _post_whatsapp_numbers(numbers):
+    """
+    One /chat/whatsappNumbers call. Returns {number: jid or None},
+    or None if the API failed (callers treat that as "not found").
+    """
+    url = f"{API_URL}/chat/whatsappNumbers/{INSTANCE}"
+    headers = {
+        "apikey": API_KEY,
+        "Content-Type": "application/json"
     }
     
-    print(f"DEBUG: Checking WhatsApp for numbers: {payload['numbers']}")
-    
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = http_client.post(url, json={"numbers": numbers}, headers=headers, idempotent=True) # lookup only, safe to retry
         data = response.json()
-        print(f"DEBUG: Evolution API Response: {data}")
         
         # Check for API errors
         if isinstance(data, dict) and (data.get('isBoom') or data.get('error')):
             print(f"DEBUG: Evolution API Error: {data.get('output', {}).get('payload', {}).get('message', 'Unknown Error')}")
             return None
+        
+        if not isinstance(data, list):
+            return None
             
-        # Check if any number exists
-        if isinstance(data, list):
-            for item in data:
-                print(f"DEBUG: Item check: {item}")
-                if isinstance(item, dict) and item.get('exists'):
-                    return item.get('jid')
-                
-        return None
+        results = {}
+        for i, item in enumerate(data):
+            if not isinstance(item, dict):
+                continue
+            number = re.sub(r'\D', '', str(item.get('number') or ''))
+            if not number and len(data) == len(numbers):
+                # Older Evolution builds don't echo the number - results follow request order
+                number = numbers[i]
+            jid = item.get('jid') if item.get('exists') else None
+            if number and not results.get(number):
+                # A later variant echoing the same normalized number must not undo a "yes"
+                results[number] = jid
+            if jid:
+                # Evolution may echo a normalized number - also index by the JID digits
+                results.setdefault(jid.split('@')[0], jid)
+        return results
     except Exception as e:
         print(f"Error checking WhatsApp: {e}")
         return None
 
+def check_whatsapp_exists_many(phones, use_cache=True):
+    """
+    Batch version of check_whatsapp_exists.
+    Expands the 8/9-digit variants of every phone, checks them in chunks of
+    WA_CHECK_BATCH_SIZE numbers and maps the results back.
+    Fresh answers come from jid_cache; use_cache=False forces a new check
+    (re-validation). Returns {phone: jid or None (not on WhatsApp)}; phones
+    whose check failed (API error in their chunk) are left out, so callers
+    can tell "unknown" from "no".
+    """
+    phones = list(dict.fromkeys(p for p in phones if p))
+    cached = jid_cache.get_many(phones) if use_cache else {}
+    
+    variants = {phone: _number_variants(phone) for phone in phones if phone not in cached}
+    if not variants:
+        return {phone: cached[phone] for phone in phones}
+    
+    all_numbers = list(dict.fromkeys(n for vs in variants.values() for n in vs))
+    print(f"DEBUG: Checking WhatsApp for {len(variants)} phones ({len(all_numbers)} numbers, {len(cached)} cached)")
+    
+    found = {}
+    checked = set()
+    for i in range(0, len(all_numbers), WA_CHECK_BATCH_SIZE):
+        chunk = all_numbers[i:i + WA_CHECK_BATCH_SIZE]
+        results = _post_whatsapp_numbers(chunk)
+        if results is not None:
+            for number, jid in results.items():
+                if not found.get(number):
+                    found[number] = jid
+            checked.update(chunk)
+    
+    # First variant that exists wins (same order as the single check)
+    resolved = {
+        phone: next((found[n] for n in vs if found.get(n)), None)
+        for phone, vs in variants.items()
+    }
+    
+    # Only answers the API actually gave count (a failed chunk is not a "no")
+    resolved = {
+        phone: jid for phone, jid in resolved.items()
+        if jid or all(n in checked for n in variants[phone])
+    }
+    jid_cache.put_many(resolved)
+    
+    resolved.update(cached)
+    return {phone: resolved[phone] for phone in phones if phone in resolved}
+
+def check_whatsapp_exists(phone, use_cache=True):
+    # Try to check if number exists on WhatsApp
+    # This endpoint might vary based on Evolution API version
+    # Based on n8n workflow, it uses /chat/whatsappNumbers/{instance}
+    return check_whatsapp_exists_many([phone], use_cache=use_cache).get(phone)
+
 def send_message(jid, text):
     url = f"{API_URL}/message/sendText/{INSTANCE}"
     headers = {
@@ -101,14 +167,21 @@ def send_message(jid, text):
     # Extract number from JID
     number = jid.split('@')[0]
     
+    # Every send path goes through the shared instance/recipient token buckets
+    rate_limiter.wait_for_whatsapp_send(INSTANCE, number)
+    
     payload = {
         "number": number,
         "text": text
     }
     
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
+        response = http_client.post(url, json=payload, headers=headers)
+        data = response.json()
+        if (400 <= response.status_code < 500 and response.status_code != 429) or (isinstance(data, dict) and data.get('isBoom')):
+            # Number rejected - forget the cached JID so the next send re-resolves it
+            jid_cache.invalidate(jid)
+        return data
     except Exception as e:
         print(f"Error sending message: {e}")
         return None